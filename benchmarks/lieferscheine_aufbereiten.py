@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+lieferscheine_aufbereiten.py - Laufzeit von husoftm2.lieferscheine.get_ls_kb_data() für viele Lieferscheine.
+
+Verwendet die synthetischen ALK00/ALN00 Zeilen aus LsKbAufbereitenTests, es wird also nicht auf SoftM
+zugegriffen. Gemessen wird die Aufbereitung von Köpfen, Positionen und Texten.
+
+    python benchmarks/lieferscheine_aufbereiten.py [anzahl]
+
+"""
+
+import sys
+import time
+
+from husoftm2.lieferscheine import LsKbAufbereitenTests
+
+
+def main(anzahl=10000):
+    test = LsKbAufbereitenTests('test_batches')
+    test.setUp()
+    try:
+        zeiten = []
+        for _i in range(3):
+            start = time.time()
+            test._lieferscheine(anzahl)
+            zeiten.append(time.time() - start)
+    finally:
+        test.tearDown()
+    print "%d Lieferscheine: %.3fs, %d Abfragen" % (anzahl, min(zeiten), len(test.abfragen))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+texte_klassifizieren.py - Laufzeitvergleich der AAT00 Klassifikation in husoftm2.texte.
+
+Vergleicht `husoftm2.texte._klassifizieren()` mit der ursprünglichen, zeilenweisen Implementierung auf
+synthetischen AAT00 Zeilen. Beide müssen identische Ergebnisse liefern.
+
+    python benchmarks/texte_klassifizieren.py [anzahl]
+
+"""
+
+import sys
+import time
+
+from husoftm2.texte import _klassifizieren, texte_trennen
+from husoftm2.tools import remove_prefix
+
+
+def _klassifizieren_referenz(rows, postexte, kopftexte, posdaten, kopfdaten):
+    """Die ursprüngliche, zeilenweise Klassifikation - Vergleichsbasis für den Benchmark."""
+    for row in rows:
+        row['textart'] = int(row['textart'])
+        auftragsnr = "SO%s" % remove_prefix(row['auftragsnr'], 'SO')
+        if not row['text'].strip('=*_- '):
+            continue
+        if row['andruck_re'] or row['andruck_ls'] or row['andruck_ab']:
+            if row['andruck_re'] > 1 or row['andruck_ls'] > 3:
+                raise NotImplementedError(row)
+            if row['andruck_ab'] > 1:
+                continue
+            if row['textart'] == 5:
+                postexte.setdefault(auftragsnr, {}).setdefault(row['auftragsposition'], []).append(
+                    "Statistische Warennummer: %s" % row['text'].strip())
+            elif row['auftragsposition'] > 0 and row['textart'] in (2, 7, 8):
+                postexte.setdefault(auftragsnr, {}).setdefault(row['auftragsposition'], []).append(
+                    row['text'].strip())
+            elif row['auftragsposition'] == 0 and row['textart'] == 7:
+                pass
+            elif row['auftragsposition'] == 0 and row['textart'] in (8, 9):
+                kopftexte.setdefault(auftragsnr, []).append(row['text'])
+            else:
+                raise NotImplementedError
+        elif row['auftragsposition'] == 0:
+            _erfassungstexte, daten = texte_trennen([row['text']])
+            if daten:
+                kopfdaten.setdefault(auftragsnr, {}).update(daten)
+        else:
+            _erfassungstexte, daten = texte_trennen([row['text']])
+            if daten:
+                posdaten.setdefault(auftragsnr, {}).setdefault(row['auftragsposition'], {}).update(daten)
+
+
+def _aat00_zeilen(anzahl):
+    """Erzeugt AAT00 Zeilen mit einer Verteilung von Textarten und Kennzeichen wie in den Produktivdaten."""
+    muster = [('8', 0, 1, 1, 1, u'Bitte Lieferschein beilegen'),
+              ('7', 0, 1, 1, 1, u'Fax 02191 60912-50'),
+              ('7', 0, 0, 0, 0, u'Kunde hat angerufen'),
+              ('1', 0, 0, 0, 0, u'#:guid:3f2b9c0e-1e2a-4f1c-9a8e-000000000001'),
+              ('8', 2, 1, 1, 1, u'   Ihre Artikelnummer 4711   '),
+              ('2', 3, 1, 1, 1, u'Abweichende Bezeichnung'),
+              ('7', 1, 0, 0, 0, u'#:guid:3f2b9c0e-1e2a-4f1c-9a8e-000000000002'),
+              ('9', 0, 1, 2, 0, u'Zahlbar sofort'),
+              ('8', 0, 0, 0, 2, u'Interne Notiz'),
+              ('8', 0, 1, 1, 1, u'=========='),
+              ('5', 4, 1, 1, 1, u'95030075')]
+    rows = []
+    for i in range(anzahl):
+        textart, position, andruck_re, andruck_ls, andruck_ab, text = muster[i % len(muster)]
+        rows.append(dict(auftragsnr=1160000 + i // 40, auftragsposition=position, textart=textart,
+                         andruck_re=andruck_re, andruck_ls=andruck_ls, andruck_ab=andruck_ab, text=text))
+    return rows
+
+
+def laufzeit(funktion, rows):
+    """Bestes Ergebnis aus drei Durchläufen."""
+    zeiten = []
+    for _i in range(3):
+        kopie = [dict(row) for row in rows]
+        start = time.time()
+        funktion(kopie, {}, {}, {}, {})
+        zeiten.append(time.time() - start)
+    return min(zeiten)
+
+
+def main(anzahl=50000):
+    rows = _aat00_zeilen(anzahl)
+    erwartet = {}, {}, {}, {}
+    _klassifizieren_referenz([dict(row) for row in rows], *erwartet)
+    ergebnis = {}, {}, {}, {}
+    _klassifizieren([dict(row) for row in rows], *ergebnis)
+    if repr(ergebnis) != repr(erwartet):
+        print "Ergebnisse weichen von der Referenz ab"
+        sys.exit(1)
+    print "%d Zeilen" % anzahl
+    print "Referenz:        %.3fs" % laufzeit(_klassifizieren_referenz, rows)
+    print "_klassifizieren: %.3fs" % laufzeit(_klassifizieren, rows)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+aenderungen.py - dauerhafte Änderungs-Cursor für Synchronisationen. Teil von huSoftM.
+
+Statt bei jedem Lauf alles abzuholen, was seit einem Tag geändert wurde, merkt sich jeder Konsument seine
+Position im Änderungsstrom und bekommt nur, was seitdem dazugekommen ist:
+
+    while True:
+        lieferscheinnrs, position = husoftm2.lieferscheine.aenderungen('shop-sync')
+        verarbeiten(lieferscheinnrs)
+        husoftm2.aenderungen.bestaetige('shop-sync', position)
+        time.sleep(60)
+
+Wird eine Position nicht bestätigt (z.B. weil die Verarbeitung abgebrochen ist), liefert der nächste
+Aufruf die selben Datensätze erneut. Die Positionen werden in `speicher` abgelegt: als JSON Dateien in
+CURSORVERZEICHNIS oder - auf App Engine, wo das Dateisystem nur lesbar ist - im memcache. Jedes Objekt mit
+den Methoden laden(schluessel) und speichern(schluessel, position) kann als `speicher` gesetzt werden.
+
+Eine Position besteht aus einem Stempel (z.B. [Datum, Uhrzeit] der letzten Änderung) und den Prüfsummen
+der Datensätze, die genau zu diesem Stempel geändert wurden. SoftM führt Änderungszeiten teilweise nur
+tagesgenau - über die Prüfsummen erkennen wir, welche Datensätze des laufenden Tages wir schon kennen.
+
+Created by agent on 2026-10-19.
+Copyright (c) 2026 HUDORA. All rights reserved.
+"""
+
+import huTools.hujson as hujson
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+
+CURSORVERZEICHNIS = os.environ.get('HUSOFTM_CURSORDIR', os.path.expanduser('~/.husoftm/cursor'))
+
+
+class DateiSpeicher(object):
+    """Legt Positionen als JSON Dateien in `verzeichnis` ab."""
+
+    def __init__(self, verzeichnis):
+        self.verzeichnis = verzeichnis
+
+    def laden(self, schluessel):
+        dateiname = os.path.join(self.verzeichnis, '%s.json' % schluessel)
+        if not os.path.exists(dateiname):
+            return None
+        return hujson.loads(open(dateiname).read())
+
+    def speichern(self, schluessel, position):
+        if not os.path.exists(self.verzeichnis):
+            os.makedirs(self.verzeichnis)
+        handle, tmpname = tempfile.mkstemp(dir=self.verzeichnis, prefix='.cursor')
+        datei = os.fdopen(handle, 'w')
+        datei.write(hujson.dumps(position))
+        datei.close()
+        os.rename(tmpname, os.path.join(self.verzeichnis, '%s.json' % schluessel))
+
+
+class MemcacheSpeicher(object):
+    """Legt Positionen im memcache ab - für App Engine, wo nicht ins Dateisystem geschrieben werden kann."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def laden(self, schluessel):
+        return self.cache.get('husoftm_cursor_%s' % schluessel)
+
+    def speichern(self, schluessel, position):
+        if not self.cache.set('husoftm_cursor_%s' % schluessel, position):
+            raise RuntimeError("Position %s konnte nicht gespeichert werden" % schluessel)
+
+
+try:
+    from google.appengine.api import memcache
+    speicher = MemcacheSpeicher(memcache)
+except ImportError:
+    speicher = DateiSpeicher(CURSORVERZEICHNIS)
+
+
+def _schluessel(feed, konsument):
+    """Schlüssel, unter dem die Position eines Konsumenten gespeichert wird."""
+    if not re.match(r'^[A-Za-z0-9_.-]+$', konsument):
+        raise ValueError("Ungueltiger Name fuer einen Konsumenten: %r" % konsument)
+    return '%s.%s' % (feed, konsument)
+
+
+def lade_position(feed, konsument):
+    """Liefert die zuletzt bestätigte Position eines Konsumenten oder None."""
+    return speicher.laden(_schluessel(feed, konsument))
+
+
+def bestaetige(konsument, position):
+    """Speichert eine von aenderungen() gelieferte Position, nachdem alle Datensätze verarbeitet sind."""
+    speicher.speichern(_schluessel(position['feed'], konsument), position)
+
+
+def neue_aenderungen(position, zeilen):
+    """Ermittelt, welche Datensätze seit `position` neu oder geändert sind.
+
+    `position` ist ein dict mit feed, stempel und pruefsummen. `zeilen` ist eine Liste von
+    (nr, stempel, pruefsumme) Tupeln aller Datensätze, deren Stempel >= position['stempel'] ist.
+    Gibt die Liste der neuen Nummern und die neue Position zurück.
+
+    >>> neue_aenderungen(dict(feed='x', stempel=[1110126], pruefsummen={}), [(1, [1110126], 'a')])
+    ([1], {'feed': 'x', 'stempel': [1110126], 'pruefsummen': {'1': 'a'}})
+    """
+    stempel = list(position['stempel'])
+    bekannt = position.get('pruefsummen', {})
+    neu = []
+    for nr, zeilenstempel, pruefsumme in sorted(zeilen, key=lambda zeile: list(zeile[1])):
+        zeilenstempel = list(zeilenstempel)
+        if zeilenstempel > stempel or bekannt.get(str(nr)) != pruefsumme:
+            neu.append(nr)
+    # Datensätze mit dem höchsten Stempel merken wir uns, damit sie beim nächsten Mal nicht erneut kommen
+    neuer_stempel = max([stempel] + [list(zeile[1]) for zeile in zeilen])
+    pruefsummen = dict([(str(zeile[0]), zeile[2]) for zeile in zeilen if list(zeile[1]) == neuer_stempel])
+    return neu, dict(feed=position['feed'], stempel=neuer_stempel, pruefsummen=pruefsummen)
+
+
+class AenderungenTests(unittest.TestCase):
+    """Positionen und Filterung ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global speicher
+        self._speicher = speicher
+        self._verzeichnis = tempfile.mkdtemp()
+        speicher = DateiSpeicher(self._verzeichnis)
+
+    def tearDown(self):
+        global speicher
+        shutil.rmtree(self._verzeichnis)
+        speicher = self._speicher
+
+    def test_neue_aenderungen(self):
+        position = dict(feed='lieferscheine', stempel=[1110126, 120000], pruefsummen={'7': 'x'})
+        neu, position = neue_aenderungen(position, [(7, [1110126, 120000], 'x'),
+                                                    (8, [1110126, 120000], 'y'),
+                                                    (9, [1110126, 130501], 'z'),
+                                                    (10, [1110126, 130501], 'z')])
+        self.assertEqual(neu, [8, 9, 10])
+        self.assertEqual(position['stempel'], [1110126, 130501])
+        self.assertEqual(position['pruefsummen'], {'9': 'z', '10': 'z'})
+        # Nichts Neues: Position bleibt, nichts wird erneut geliefert
+        neu, position2 = neue_aenderungen(position, [(9, [1110126, 130501], 'z'),
+                                                     (10, [1110126, 130501], 'z')])
+        self.assertEqual((neu, position2), ([], position))
+        # Tagesgenaue Stempel: Änderungen am selben Tag werden über die Prüfsumme erkannt
+        neu, _position = neue_aenderungen(position, [(9, [1110126, 130501], 'z2')])
+        self.assertEqual(neu, [9])
+
+    def test_bestaetige(self):
+        self.assertEqual(lade_position('kunden', 'test'), None)
+        position = dict(feed='kunden', stempel=[1110126], pruefsummen={'SC10001': 'abc'})
+        bestaetige('test', position)
+        self.assertEqual(lade_position('kunden', 'test'), position)
+        self.assertRaises(ValueError, lade_position, 'kunden', '../etc')
+
+    def test_memcache(self):
+        global speicher
+
+        class Cache(dict):
+            def set(self, key, value):
+                self[key] = value
+                return True
+
+        cache = Cache()
+        speicher = MemcacheSpeicher(cache)
+        self.assertEqual(lade_position('kunden', 'test'), None)
+        position = dict(feed='kunden', stempel=[1110126], pruefsummen={})
+        bestaetige('test', position)
+        self.assertEqual(cache, {'husoftm_cursor_kunden.test': position})
+        self.assertEqual(lade_position('kunden', 'test'), position)
+
+
+if __name__ == '__main__':
+    unittest.main()
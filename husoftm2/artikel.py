@@ -7,8 +7,10 @@ Created by Maximillian Dornseif on 2007-04-28.
 Copyright (c) 2007, 2009, 2010 HUDORA GmbH. All rights reserved.
 """
 
-import unittest
 from husoftm2.backend import query
+from husoftm2.tools import sql_quote
+import time
+import unittest
 
 
 def get_artikelnummern():
@@ -18,6 +20,64 @@ def get_artikelnummern():
     return [x[0] for x in rows]
 
 
+# Lokaler Index aller Setartikel: artnr -> [(menge_im_set, komponenten_artnr), ...]
+# Wird durch lade_setartikel() befüllt und von komponentenaufloesung() nach SETARTIKEL_MAXALTER
+# Sekunden erneut geladen. Solange der Index nicht geladen wurde, fragt komponentenaufloesung()
+# die ASK00 direkt ab.
+SETARTIKEL_MAXALTER = 60 * 60 * 72
+_setartikel = {}
+_setartikel_geladen = 0
+
+
+def lade_setartikel():
+    """Lädt alle Stücklisten aus der ASK00 in den lokalen Setartikel-Index.
+
+    Danach werden Artikel, die keine Setartikel sind, ohne Zugriff auf SoftM aufgelöst.
+    """
+    global _setartikel_geladen
+
+    sets = {}
+    for row in query(['ASK00'], fields=['SKARTN', 'SKLFNR', 'SKKART', 'SKMENG'], ordering=['SKARTN', 'SKLFNR'],
+                     cachingtime=SETARTIKEL_MAXALTER, ua='husoftm2.artikel'):
+        sets.setdefault(row['artnr'], []).append((row['menge_im_set'], row['komponenten_artnr']))
+    _setartikel.clear()
+    _setartikel.update(sets)
+    _setartikel_geladen = time.time()
+    return len(_setartikel)
+
+
+def setartikel():
+    """Gibt den Setartikel-Index als dict artnr -> [(menge_im_set, komponenten_artnr), ...] zurück.
+
+    Ist der Index nicht geladen oder älter als SETARTIKEL_MAXALTER, wird er (neu) geladen.
+    """
+    if not _setartikel_geladen or time.time() - _setartikel_geladen > SETARTIKEL_MAXALTER:
+        lade_setartikel()
+    return dict(_setartikel)
+
+
+def _komponenten(artnrs):
+    """Liefert die Stücklisten zu artnrs als dict. Artikel ohne Stückliste fehlen im Ergebnis."""
+
+    if _setartikel_geladen:
+        if time.time() - _setartikel_geladen > SETARTIKEL_MAXALTER:
+            lade_setartikel()
+        return _setartikel
+
+    sets = {}
+    artnrs = sorted(set(artnrs))
+    while artnrs:
+        # In 50er Schritten mit einer einzigen Query pro Batch auflösen
+        batch = artnrs[:50]
+        artnrs = artnrs[50:]
+        condition = "SKARTN IN (%s)" % ','.join([sql_quote(artnr) for artnr in batch])
+        for row in query(['ASK00'], fields=['SKARTN', 'SKLFNR', 'SKKART', 'SKMENG'], condition=condition,
+                         ordering=['SKARTN', 'SKLFNR'], cachingtime=SETARTIKEL_MAXALTER,
+                         ua='husoftm2.artikel'):
+            sets.setdefault(row['artnr'], []).append((row['menge_im_set'], row['komponenten_artnr']))
+    return sets
+
+
 def komponentenaufloesung(mengenliste):
     """Löst Artikel in ihre Komponenten auf.
 
@@ -25,18 +85,41 @@ def komponentenaufloesung(mengenliste):
     [(5, u'A42438'), (5, u'A42439'), (5, u'A42440'), (10, u'A42441'), (4, u'42050/A'), (12, u'42051/A'), (4, u'42052/A')]
     >>> komponentenaufloesung([(2, '00001')])
     [(2, '00001')]
+
+    Alle Artikelnummern der Liste werden mit einer Abfrage aufgelöst. Wurde der Setartikel-Index mit
+    lade_setartikel() geladen, kommt die Funktion ganz ohne Abfrage aus.
     """
 
     # TODO: Wie ist das verhältnis zu cs.masterdata.article.komponentenaufloesung()?
+    mengenliste = list(mengenliste)
+    sets = _komponenten([artnr for menge, artnr in mengenliste])
     ret = []
     for menge, artnr in mengenliste:
-        rows = query(['ASK00'], fields=['SKLFNR', 'SKKART', 'SKMENG'], condition="SKARTN='%s'" % artnr)
-        if not rows:
+        if artnr not in sets:
             # kein Setartikel
             ret.append((int(menge), artnr))
         else:
-            for row in rows:
-                ret.append((int(menge * row['menge_im_set']), row['komponenten_artnr']))
+            for menge_im_set, komponenten_artnr in sets[artnr]:
+                ret.append((int(menge * menge_im_set), komponenten_artnr))
+    return ret
+
+
+def stuecklisten(artnrs):
+    """Liefert für eine Liste von Artikelnummern ein dict, das jeder Artikelnummer das Ergebnis von
+    komponentenaufloesung([(1, artnr)]) zuordnet. Die Auflösung erfolgt für alle Artikel gemeinsam.
+
+    >>> stuecklisten(['00049', '00001'])
+    {'00049': [(1, u'A42438'), (1, u'A42439'), (1, u'A42440'), (2, u'A42441')], '00001': [(1, '00001')]}
+    """
+    artnrs = list(artnrs)
+    sets = _komponenten(artnrs)
+    ret = {}
+    for artnr in artnrs:
+        if artnr not in sets:
+            ret[artnr] = [(1, artnr)]
+        else:
+            ret[artnr] = [(int(menge_im_set), komponenten_artnr)
+                          for menge_im_set, komponenten_artnr in sets[artnr]]
     return ret
 
 
@@ -51,6 +134,37 @@ class KomponentenaufloesungTests(unittest.TestCase):
                          [(0, u'A42438'), (0, u'A42439'), (0, u'A42440'), (0, u'A42441')])
 
 
+class SetartikelIndexTests(unittest.TestCase):
+    """Auflösung über den lokalen Setartikel-Index - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query, _setartikel_geladen
+        self._query = query
+        self._geladen = _setartikel_geladen
+
+        def _keine_query(*args, **kwargs):
+            raise AssertionError("unerwartete Abfrage: %r %r" % (args, kwargs))
+        query = _keine_query
+        _setartikel.clear()
+        _setartikel[u'00049'] = [(1, u'A42438'), (1, u'A42439'), (1, u'A42440'), (2, u'A42441')]
+        _setartikel_geladen = time.time()
+
+    def tearDown(self):
+        global query, _setartikel_geladen
+        query = self._query
+        _setartikel.clear()
+        _setartikel_geladen = self._geladen
+
+    def test_index(self):
+        self.assertEqual(komponentenaufloesung([(5, '00049'), (2, '00001')]),
+                         [(5, u'A42438'), (5, u'A42439'), (5, u'A42440'), (10, u'A42441'), (2, '00001')])
+        self.assertEqual(komponentenaufloesung([]), [])
+        self.assertEqual(stuecklisten(['00049', '00001']),
+                         {'00049': [(1, u'A42438'), (1, u'A42439'), (1, u'A42440'), (2, u'A42441')],
+                          '00001': [(1, '00001')]})
+        self.assertEqual(setartikel().keys(), [u'00049'])
+
+
 def _test():
     """Diverse einfache Tests."""
     print get_artikelnummern()
@@ -7,11 +7,14 @@ Created by Christian Klein on 2010-03-15.
 Copyright (c) 2010 HUDORA GmbH. All rights reserved.
 """
 
-from husoftm2.tools import sql_escape, sql_quote, date2softm, pad, remove_prefix
+from husoftm2.tools import sql_quote, date2softm, softm2date, pad, remove_prefix
 from husoftm2.texte import texte_trennen, txt_auslesen
-from husoftm2.backend import query
+from husoftm2.backend import query, query_pages
+import copy
 import datetime
 import husoftm2.sachbearbeiter
+import time
+import unittest
 
 
 AUFTRAGSARTEN = {
@@ -40,7 +43,7 @@ AUFTRAGSARTEN = {
 
 
 def _auftraege(additional_conditions=None, addtables=None, mindate=None, maxdate=None, limit=None,
-               header_only=False):
+               header_only=False, cachingtime=300):
     """
     Alle Aufträge ermitteln
     `additional_conditions` kann eine Liste von SQL-Bedingungen enthalten, die die Auftragssuche
@@ -51,8 +54,19 @@ def _auftraege(additional_conditions=None, addtables=None, mindate=None, maxdate
 
     Rückgabewert sind dicts nach dem Lieferungprotokoll.
     Wenn header_only == True, werden nur Auftragsköpfe zurück gegeben, was deutlich schneller ist.
+    `cachingtime` wird an die Abfragen der Köpfe, Adressen und Positionen durchgereicht.
     """
 
+    conditions = _auftragsbedingungen(mindate, maxdate)
+    if additional_conditions:
+        conditions.extend(additional_conditions)
+
+    rows = _auftragskoepfe(" AND ".join(conditions), addtables, limit, cachingtime)
+    return _auftraege_aufbereiten(rows, header_only, cachingtime)
+
+
+def _auftragsbedingungen(mindate, maxdate):
+    """Grundbedingungen für die Auftragssuche, ggf. eingeschränkt auf einen Zeitraum der Erfassung."""
     conditions = ["AKSTAT<>'X'"]
     if mindate and maxdate:
         conditions.append("AKDTER BETWEEN %s AND %s" % (date2softm(mindate), date2softm(maxdate)))
@@ -60,20 +74,26 @@ def _auftraege(additional_conditions=None, addtables=None, mindate=None, maxdate
         conditions.append("AKDTER > %s" % date2softm(mindate))
     elif maxdate:
         conditions.append("AKDTER < %s" % date2softm(maxdate))
-    if additional_conditions:
-        conditions.extend(additional_conditions)
+    return conditions
 
-    condition = " AND ".join(conditions)
-    koepfe = {}
-    kopftexte = {}
 
+def _auftragskoepfe(condition, addtables, limit, cachingtime=300):
+    """Liest die Auftragsköpfe (nach AKAUFN absteigend sortiert) für _auftraege() ein."""
     if addtables is None:
         addtables = []
 
     # Köpfe und Adressen einlesen
-    for kopf in query(['AAK00'] + addtables, ordering=['AKAUFN DESC'], condition=condition,
-                      joins=[('XKD00', 'AKKDNR', 'KDKDNR')],
-                             limit=limit, ua='husoftm2.auftraege'):
+    return query(['AAK00'] + addtables, ordering=['AKAUFN DESC'], condition=condition,
+                 joins=[('XKD00', 'AKKDNR', 'KDKDNR')],
+                 limit=limit, ua='husoftm2.auftraege', cachingtime=cachingtime)
+
+
+def _auftraege_aufbereiten(rows, header_only, cachingtime=300):
+    """Baut aus den Kopfzeilen von _auftragskoepfe() die Aufträge samt Positionen und Texten."""
+    koepfe = {}
+    kopftexte = {}
+
+    for kopf in rows:
         d = dict(kundennr="SC%s" % kopf['kundennr_warenempf'],
                  auftragsnr="SO%s" % kopf['auftragsnr'],
                  auftragsnr_kunde=kopf['auftragsnr_kunde'],
@@ -104,11 +124,11 @@ def _auftraege(additional_conditions=None, addtables=None, mindate=None, maxdate
         allauftrnr = allauftrnr[50:]
 
         # Abweichende Lieferadressen
-        for row in query(['XAD00'], ua='husoftm2.lieferscheine',
+        for row in query(['XAD00'], ua='husoftm2.lieferscheine', cachingtime=cachingtime,
                          condition="ADAART=1 AND ADRGNR IN (%s)" % ','.join([str(x) for x in batch])):
-            koepfe[row['nr']]['lieferadresse'] = dict(name1=kopf['name1'],
-                                    name2=kopf['name2'],
-                                    name3=kopf['name3'],
+            koepfe[row['nr']]['lieferadresse'] = dict(name1=row['name1'],
+                                    name2=row['name2'],
+                                    name3=row['name3'],
                                     strasse=row['strasse'],
                                     land=husoftm2.tools.land2iso(row['laenderkennzeichen']),
                                     plz=row['plz'],
@@ -117,7 +137,7 @@ def _auftraege(additional_conditions=None, addtables=None, mindate=None, maxdate
         # Positionen einlesen
         for row in query(['AAP00'], condition="APSTAT<>'X' AND APAUFN IN (%s)" % ','.join([str(x)
                                                                                            for x in batch]),
-                         ua='husoftm2.auftraege'):
+                         ua='husoftm2.auftraege', cachingtime=cachingtime):
             d = dict(menge=int(row['bestellmenge']),
                      artnr=row['artnr'],
                      liefer_date=row['liefer_date'],
@@ -144,23 +164,192 @@ def _auftraege(additional_conditions=None, addtables=None, mindate=None, maxdate
     return koepfe.values()
 
 
+def iter_auftraege(additional_conditions=None, addtables=None, mindate=None, maxdate=None,
+                   header_only=False, page_size=1000):
+    """Liefert Aufträge wie _auftraege(), aber seitenweise als Generator.
+
+    Die Köpfe werden mit husoftm2.backend.query_pages() in Seiten zu `page_size` Aufträgen nach AKAUFN
+    absteigend gelesen (keyset pagination), jede Seite mit Positionen und Texten angereichert und
+    ausgeliefert, bevor die nächste Seite gelesen wird. Der Speicherbedarf bleibt so auch bei Exporten
+    über Monate konstant.
+    """
+    conditions = _auftragsbedingungen(mindate, maxdate) + list(additional_conditions or [])
+    for rows in query_pages(['AAK00'] + (addtables or []), condition=" AND ".join(conditions),
+                            joins=[('XKD00', 'AKKDNR', 'KDKDNR')], key='AKAUFN', page_size=page_size,
+                            ua='husoftm2.auftraege'):
+        for auftrag in _auftraege_aufbereiten(rows, header_only):
+            yield auftrag
+
+
+# Vollständig aufgebaute Aufträge halten wir pro Auftragsnummer vor. Vor jeder Verwendung prüfen wir mit
+# einer kleinen Abfrage auf AKDTAE/AKZTAE, ob sich der Auftrag seitdem geändert hat. Änderungen an den
+# Positionen schlagen sich nicht immer im Kopf nieder, deshalb wird jeder Auftrag spätestens nach
+# AUFTRAGSCACHE_MAXALTER Sekunden neu gelesen.
+AUFTRAGSCACHE_MAXEINTRAEGE = 5000
+AUFTRAGSCACHE_MAXALTER = 60 * 15
+_auftragscache = {}  # (auftragsnr, header_only) -> (aenderungsstempel, zeitpunkt, auftrag)
+
+
+def _aenderungsstempel(auftragsnrs):
+    """Liefert {auftragsnr: (AKDTAE, AKZTAE)} für alle nicht gelöschten Aufträge in auftragsnrs.
+
+    Die Stempel werden immer direkt gelesen, ein Ergebnis aus dem Query-Cache wäre für die Prüfung wertlos.
+    Gibt es eine Auftragsnummer mehrfach, wird ein RuntimeError ausgelöst.
+    """
+    ret = {}
+    auftragsnrs = list(auftragsnrs)
+    while auftragsnrs:
+        batch = auftragsnrs[:200]
+        auftragsnrs = auftragsnrs[200:]
+        condition = "AKSTAT<>'X' AND AKAUFN IN (%s)" % ','.join([str(x) for x in batch])
+        for auftragsnr, datum, uhrzeit in query('AAK00', fields=['AKAUFN', 'AKDTAE', 'AKZTAE'],
+                                                condition=condition, querymappings={}, cachingtime=0,
+                                                ua='husoftm2.auftraege.aenderungsstempel'):
+            if int(auftragsnr) in ret:
+                raise RuntimeError("Mehr als ein Auftrag mit auftragsnr %s vorhanden" % auftragsnr)
+            ret[int(auftragsnr)] = (int(datum), int(uhrzeit))
+    return ret
+
+
+def get_auftraege_by_auftragsnrs(auftragsnrs, header_only=False):
+    """Aufträge zu einer Liste von Auftragsnummern zurückgeben.
+
+    Unveränderte Aufträge kommen aus dem Cache, es werden nur geänderte und noch unbekannte Aufträge
+    gelesen. Rückgabewert ist ein dict von Auftragsnummer (ohne 'SO') auf Auftrag, nicht vorhandene
+    oder gelöschte Aufträge fehlen. Ist eine Auftragsnummer mehrfach vorhanden, wird ein RuntimeError
+    ausgelöst.
+    """
+    auftragsnrs = set([remove_prefix(auftragsnr, 'SO') for auftragsnr in auftragsnrs])
+    stempel = _aenderungsstempel(auftragsnrs)
+    ret = {}
+    fehlend = []
+    jetzt = time.time()
+    for auftragsnr in auftragsnrs:
+        eintrag = _auftragscache.get((auftragsnr, header_only))
+        if auftragsnr not in stempel:
+            _auftragscache.pop((auftragsnr, header_only), None)
+        elif eintrag and eintrag[0] == stempel[auftragsnr] and jetzt - eintrag[1] <= AUFTRAGSCACHE_MAXALTER:
+            ret[auftragsnr] = copy.deepcopy(eintrag[2])
+        else:
+            fehlend.append(auftragsnr)
+
+    if fehlend:
+        if len(_auftragscache) + len(fehlend) > AUFTRAGSCACHE_MAXEINTRAEGE:
+            _auftragscache.clear()
+        condition = "AKAUFN IN (%s)" % ','.join([str(x) for x in fehlend])
+        for auftrag in _auftraege([condition], header_only=header_only, cachingtime=0):
+            auftragsnr = remove_prefix(auftrag['auftragsnr'], 'SO')
+            if auftragsnr in ret:
+                raise RuntimeError("Mehr als ein Auftrag mit auftragsnr %s vorhanden" % auftragsnr)
+            # Wurde der Auftrag zwischen den Abfragen geändert, ist er neuer als der Stempel und wird beim
+            # nächsten Mal erneut gelesen.
+            _auftragscache[(auftragsnr, header_only)] = (stempel[auftragsnr], jetzt, auftrag)
+            ret[auftragsnr] = copy.deepcopy(auftrag)
+    return ret
+
+
 def get_auftrag_by_auftragsnr(auftragsnr, header_only=False):
-    """Auftrag mit Auftragsnummer auftragsnr zurueckgeben"""
+    """Auftrag mit Auftragsnummer auftragsnr zurueckgeben
+
+    Gibt es mehr als einen Auftrag mit dieser Nummer, wird ein RuntimeError ausgelöst.
+    """
 
     auftragsnr = remove_prefix(auftragsnr, 'SO')
-    auftraege = _auftraege(["AKAUFN=%s" % sql_escape(auftragsnr)], header_only=header_only)
-    if len(auftraege) > 1:
-        raise RuntimeError("Mehr als ein Auftrag mit auftragsnr %s vorhanden" % auftragsnr)
-    if not auftraege:
-        return None
-    return auftraege[0]
+    return get_auftraege_by_auftragsnrs([auftragsnr], header_only=header_only).get(auftragsnr)
+
+
+# GUIDs stehen als '#:guid:...' Text in der AAT00. ATTX60 ist nicht indiziert, eine Suche nach einer GUID
+# dauert deshalb Sekunden. Wir halten daher einen Index GUID -> Auftragsnummern im Speicher. Neue Aufträge
+# (mit höherer Auftragsnummer) werden nach GUIDINDEX_INTERVALL Sekunden nachgeladen, nach GUIDINDEX_MAXALTER
+# Sekunden wird der Index komplett neu aufgebaut.
+GUIDINDEX_INTERVALL = 60
+GUIDINDEX_MAXALTER = 60 * 60 * 12
+_guidindex = {}  # guid -> [auftragsnr, ...]
+_guids = {}  # auftragsnr -> guid
+_guidindex_geladen = 0
+_guidindex_stand = 0
+_guidindex_maxauftragsnr = 0
+
+
+def _guid_eintragen(auftragsnr, guid):
+    """Nimmt die GUID eines Auftrags in den Index auf."""
+    auftragsnrs = _guidindex.setdefault(guid, [])
+    if auftragsnr not in auftragsnrs:
+        auftragsnrs.append(auftragsnr)
+    _guids.setdefault(auftragsnr, guid)
+
+
+def _guidindex_lesen(condition):
+    """Liest GUID-Texte aus der AAT00 in den Index ein."""
+    global _guidindex_maxauftragsnr
+    condition = "ATTART=8 AND ATAUPO=0 AND ATTX60 LIKE '#:guid:%%' AND %s" % condition
+    rows = query('AAT00', fields=['ATAUFN', 'ATTX60'], condition=condition, querymappings={}, cachingtime=0,
+                 ua='husoftm2.auftraege.guidindex')
+    for auftragsnr, text in rows:
+        auftragsnr = int(auftragsnr)
+        _guid_eintragen(auftragsnr, text.strip().replace('#:guid:', ''))
+        _guidindex_maxauftragsnr = max(_guidindex_maxauftragsnr, auftragsnr)
+    return len(rows)
+
+
+def _guid_live(guid):
+    """Sucht die Aufträge zu einer GUID direkt in der AAT00 und nimmt sie in den Index auf.
+
+    Das findet auch GUIDs, die nachträglich an ältere Aufträge geschrieben wurden und deshalb beim
+    Nachladen über die Auftragsnummer fehlen. Die Abfrage ist langsam, weil ATTX60 nicht indiziert ist.
+    """
+    condition = "ATTX60 = %s AND ATAUPO = 0 AND ATTART = 8" % sql_quote("#:guid:" + guid)
+    rows = query('AAT00', fields=['ATAUFN'], condition=condition, querymappings={}, cachingtime=0,
+                 ua='husoftm2.auftraege.guidindex')
+    for row in rows:
+        _guid_eintragen(int(row[0]), guid)
+    return _guidindex.get(guid)
+
+
+def lade_guidindex():
+    """Baut den GUID-Index komplett neu auf."""
+    global _guidindex_geladen, _guidindex_stand, _guidindex_maxauftragsnr
+
+    jetzt = time.time()
+    _guidindex.clear()
+    _guids.clear()
+    _guidindex_maxauftragsnr = 0
+    _guidindex_lesen("ATAUFN>0")
+    _guidindex_geladen = _guidindex_stand = jetzt
+
+
+def aktualisiere_guidindex():
+    """Lädt die GUIDs aller Aufträge nach, die seit dem letzten Stand angelegt wurden."""
+    global _guidindex_stand
+
+    jetzt = time.time()
+    anzahl = _guidindex_lesen("ATAUFN>%d" % _guidindex_maxauftragsnr)
+    _guidindex_stand = jetzt
+    return anzahl
+
+
+def _guidindex_aktuell(laden=True):
+    """Sorgt dafür, dass der GUID-Index aktuell ist. Gibt False zurück, wenn er nicht geladen ist."""
+    if not _guidindex_geladen or time.time() - _guidindex_geladen > GUIDINDEX_MAXALTER:
+        if not laden and not _guidindex_geladen:
+            return False
+        lade_guidindex()
+    elif time.time() - _guidindex_stand > GUIDINDEX_INTERVALL:
+        aktualisiere_guidindex()
+    return True
 
 
 def get_auftrag_by_guid(guid, header_only=False):
     """Auftrag mit GUID guid zurueckgeben. ACHTUNG guids sind cniht zwingend eindeutig!"""
-    # TO BE FIXED
-    condition = "ATTX60 = %s AND ATAUPO = 0 AND ATTART = 8 AND ATAUFN=AKAUFN" % sql_quote("#:guid:" + guid)
-    auftraege = _auftraege([condition], addtables=['AAT00'], header_only=header_only)
+    _guidindex_aktuell()
+    if guid not in _guidindex:
+        # Vielleicht ist der Auftrag gerade erst angelegt worden.
+        aktualisiere_guidindex()
+    auftragsnrs = _guidindex.get(guid) or _guid_live(guid)
+    if not auftragsnrs:
+        return None
+    condition = "AKAUFN IN (%s)" % ','.join([str(auftragsnr) for auftragsnr in auftragsnrs])
+    auftraege = _auftraege([condition], header_only=header_only)
     if len(auftraege) > 1:
         raise RuntimeError("Mehr als ein Auftrag mit guid %s vorhanden" % guid)
     if not auftraege:
@@ -186,11 +375,22 @@ def get_guid(auftragsnr):
     Gibt den GUID zu einer Auftragsnr zurück, sofern vorhanden.
     """
     auftragsnr = remove_prefix(auftragsnr, 'SO')
+    # Den Index verwenden wir nur, wenn er ohnehin geladen ist. Für einzelne Aufträge ist die Abfrage
+    # über ATAUFN schneller als das Laden des Index.
+    indiziert = _guidindex_aktuell(laden=False)
+    if indiziert:
+        if auftragsnr > _guidindex_maxauftragsnr:
+            aktualisiere_guidindex()
+        if auftragsnr in _guids:
+            return _guids[auftragsnr]
     condition = "ATTX60 LIKE %s AND ATAUFN = %s AND ATAUPO = 0 AND ATTART = 8" % (sql_quote("#:guid:%%"),
                                                                                   sql_quote(auftragsnr))
     rows = query('AAT00', fields=['ATTX60'], condition=condition)
     if rows:
-        return rows[0][0].replace('#:guid:', '')
+        guid = rows[0][0].replace('#:guid:', '')
+        if indiziert:
+            _guid_eintragen(auftragsnr, guid.strip())
+        return guid
     return ''
 
 
@@ -202,9 +402,17 @@ def auftraege_kunde(kundennr, limit=None, header_only=False):
     return auftraege
 
 
-def verspaetete_auftraege(datum=None):
+def verspaetete_auftraege(datum=None, details=False):
     """Gibt eine Liste von Auftragsnummern zurück, die vor <datum> ausgeliefert hätten werden müssen,
     aber noch nicht ausgeliefert sind.
+
+    Mit `details=True` werden statt der Auftragsnummern Auftragsköpfe (wie bei header_only) geliefert,
+    ergänzt um
+     * kundenname - name1 des Warenempfängers
+     * verspaetete_positionen - Liste von dicts mit position, artnr, liefer_date und menge_offen
+     * verspaetung_tage - Tage seit dem frühesten überschrittenen Liefertermin
+    Die Liste ist nach verspaetung_tage absteigend sortiert. Dafür werden unabhängig von der Zahl der
+    Aufträge nur wenige Abfragen benötigt.
     """
 
     if not datum:
@@ -217,13 +425,176 @@ def verspaetete_auftraege(datum=None):
                   "APSTAT<>'X'",  # Position nicht gelöscht
                   'APDTLT < %s' % date2softm(datum),
                   ]
+    if details:
+        return _verspaetete_auftraege_details(" AND ".join(conditions), datum)
     rows = query(['AAK00'],
                      condition=' AND '.join(conditions),
                      grouping=['AKAUFN'], fields=['AKAUFN'], ordering=['AKAUFN DESC'],
                      joins=[('AAP00', 'AKAUFN', 'APAUFN')],
                      ua='husoftm2.auftraege.verspaetete_auftraege')
     return ["SO%s" % row[0] for row in rows]
-    return _auftraege(conditions, addtables=['AAT00'], header_only=False)
+
+
+def _verspaetete_auftraege_details(condition, datum):
+    """Liest Köpfe, verspätete Positionen und Kundennamen für verspaetete_auftraege(details=True)."""
+    positionen = {}
+    for auftragsnr, position, artnr, liefer_date, menge_offen in query(
+            ['AAK00'], condition=condition, querymappings={},
+            fields=['AKAUFN', 'APAUPO', 'APARTN', 'APDTLT', 'APMNG-APMNGF-APMNGG'],
+            joins=[('AAP00', 'AKAUFN', 'APAUFN')], ua='husoftm2.auftraege.verspaetete_auftraege'):
+        positionen.setdefault(int(auftragsnr), []).append(dict(position=int(position), artnr=artnr,
+                                                               liefer_date=softm2date(liefer_date),
+                                                               menge_offen=int(menge_offen)))
+
+    # Köpfe in Batches über _auftraege() lesen
+    auftraege = []
+    auftragsnrs = sorted(positionen.keys())
+    while auftragsnrs:
+        batch = auftragsnrs[:200]
+        auftragsnrs = auftragsnrs[200:]
+        auftraege.extend(_auftraege(["AKAUFN IN (%s)" % ','.join([str(x) for x in batch])],
+                                    header_only=True))
+
+    # Namen der Warenempfänger
+    namen = {}
+    kundennrs = sorted(set([remove_prefix(auftrag['kundennr'], 'SC') for auftrag in auftraege]))
+    while kundennrs:
+        batch = kundennrs[:200]
+        kundennrs = kundennrs[200:]
+        for kundennr, name in query('XKD00', fields=['KDKDNR', 'KDNAME'], querymappings={},
+                                    condition="KDKDNR IN (%s)" % ','.join([pad('KDKDNR', x) for x in batch]),
+                                    ua='husoftm2.auftraege.verspaetete_auftraege'):
+            namen["SC%s" % str(kundennr).strip()] = name.strip()
+
+    for auftrag in auftraege:
+        auftrag['verspaetete_positionen'] = sorted(positionen[remove_prefix(auftrag['auftragsnr'], 'SO')],
+                                                   key=lambda position: position['position'])
+        # Positionen ohne Liefertermin (APDTLT=0) zählen nicht zur Verspätung
+        termine = [position['liefer_date'] for position in auftrag['verspaetete_positionen']
+                   if position['liefer_date']]
+        auftrag['verspaetung_tage'] = termine and (datum - min(termine)).days or 0
+        auftrag['kundenname'] = namen.get(auftrag['kundennr'], '')
+    auftraege.sort(key=lambda auftrag: (-auftrag['verspaetung_tage'], auftrag['auftragsnr']))
+    return auftraege
+
+
+class AuftragscacheTests(unittest.TestCase):
+    """get_auftraege_by_auftragsnrs() mit synthetischen Köpfen - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query, _auftraege
+        self._original = (query, _auftraege)
+        self.koepfe = [(1000, 1110126, 120000), (1001, 1110126, 120000)]
+        self.gelesen = []
+
+        def antwort(table, condition='', **kwargs):
+            auftragsnrs = condition.split('IN (')[1].rstrip(')').split(',')
+            return [kopf for kopf in self.koepfe if str(kopf[0]) in auftragsnrs]
+
+        def auftraege(additional_conditions, header_only=False, **kwargs):
+            auftragsnrs = [int(nr) for nr in additional_conditions[0].split('IN (')[1].rstrip(')').split(',')]
+            self.gelesen.extend(sorted(auftragsnrs))
+            return [dict(auftragsnr='SO%d' % kopf[0], stempel=kopf[1:]) for kopf in self.koepfe
+                    if kopf[0] in auftragsnrs]
+
+        query, _auftraege = antwort, auftraege
+
+    def tearDown(self):
+        global query, _auftraege
+        query, _auftraege = self._original
+        _auftragscache.clear()
+
+    def test_cache(self):
+        auftraege = get_auftraege_by_auftragsnrs(['SO1000', 'SO1001', 'SO1002'])
+        self.assertEqual(sorted(auftraege), [1000, 1001])
+        self.assertEqual(self.gelesen, [1000, 1001])
+        # Unverändert: alles aus dem Cache
+        self.assertEqual(get_auftraege_by_auftragsnrs(['SO1000', 'SO1001']), auftraege)
+        self.assertEqual(self.gelesen, [1000, 1001])
+        # Geänderter Stempel: nur der geänderte Auftrag wird gelesen
+        self.koepfe[1] = (1001, 1110126, 130501)
+        self.assertEqual(get_auftrag_by_auftragsnr('SO1001')['stempel'], (1110126, 130501))
+        self.assertEqual(self.gelesen, [1000, 1001, 1001])
+        # Gelöscht: fehlt im Ergebnis und im Cache
+        del self.koepfe[0]
+        self.assertEqual(get_auftrag_by_auftragsnr('SO1000'), None)
+        self.assertFalse((1000, False) in _auftragscache)
+        # Doppelt vorhanden
+        self.koepfe.append((1001, 1110126, 130501))
+        self.assertRaises(RuntimeError, get_auftrag_by_auftragsnr, 'SO1001')
+
+    def test_maxalter(self):
+        get_auftrag_by_auftragsnr('SO1000')
+        stempel, zeitpunkt, auftrag = _auftragscache[(1000, False)]
+        _auftragscache[(1000, False)] = (stempel, zeitpunkt - AUFTRAGSCACHE_MAXALTER - 1, auftrag)
+        get_auftrag_by_auftragsnr('SO1000')
+        self.assertEqual(self.gelesen, [1000, 1000])
+        get_auftrag_by_auftragsnr('SO1000')
+        self.assertEqual(self.gelesen, [1000, 1000])
+
+
+class GuidindexTests(unittest.TestCase):
+    """GUID-Index mit synthetischen AAT00 Zeilen - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query, _auftraege
+        self._original = (query, _auftraege)
+        self.texte = {1000: '#:guid:alt', 1001: '#:guid:doppelt', 1002: '#:guid:doppelt'}
+        self.abfragen = []
+
+        def antwort(table, fields=None, condition='', **kwargs):
+            self.abfragen.append(condition)
+            ret = []
+            for auftragsnr, text in sorted(self.texte.items()):
+                if 'ATAUFN>' in condition and auftragsnr <= int(condition.split('ATAUFN>')[1]):
+                    continue
+                if "ATTX60 = '" in condition and text != condition.split("ATTX60 = '")[1].split("'")[0]:
+                    continue
+                if "ATAUFN = '" in condition and "ATAUFN = '%d'" % auftragsnr not in condition:
+                    continue
+                ret.append([dict(ATAUFN=auftragsnr, ATTX60=text)[feld] for feld in fields])
+            return ret
+
+        def auftraege(additional_conditions, header_only=False, **kwargs):
+            auftragsnrs = additional_conditions[0].split('IN (')[1].rstrip(')').split(',')
+            return [dict(auftragsnr='SO%s' % auftragsnr) for auftragsnr in auftragsnrs]
+
+        query, _auftraege = antwort, auftraege
+        lade_guidindex()
+
+    def tearDown(self):
+        global query, _auftraege, _guidindex_geladen, _guidindex_stand, _guidindex_maxauftragsnr
+        query, _auftraege = self._original
+        _guidindex.clear()
+        _guids.clear()
+        _guidindex_geladen = _guidindex_stand = _guidindex_maxauftragsnr = 0
+
+    def test_index(self):
+        self.assertEqual(_guidindex, {'alt': [1000], 'doppelt': [1001, 1002]})
+        self.assertEqual(get_auftrag_by_guid('alt'), dict(auftragsnr='SO1000'))
+        self.assertRaises(RuntimeError, get_auftrag_by_guid, 'doppelt')
+        self.assertEqual(len(self.abfragen), 1)
+
+    def test_aktualisieren(self):
+        self.texte[1003] = '#:guid:neu'
+        self.assertEqual(get_auftrag_by_guid('neu'), dict(auftragsnr='SO1003'))
+        self.assertEqual(self.abfragen[-1].split(' AND ')[-1], 'ATAUFN>1002')
+        self.assertEqual(get_guid('SO1003'), 'neu')
+        self.assertEqual(len(self.abfragen), 2)
+
+    def test_fehlt_im_index(self):
+        # Nachträglich an einen älteren Auftrag geschriebene GUID
+        self.texte[999] = '#:guid:nachgetragen'
+        self.assertEqual(get_auftrag_by_guid('nachgetragen'), dict(auftragsnr='SO999'))
+        self.assertEqual(len(self.abfragen), 3)
+        self.assertEqual(_guidindex['nachgetragen'], [999])
+        self.assertEqual(get_auftrag_by_guid('nachgetragen'), dict(auftragsnr='SO999'))
+        self.assertEqual(get_guid('999'), 'nachgetragen')
+        self.assertEqual(len(self.abfragen), 3)
+        self.assertEqual(get_auftrag_by_guid('unbekannt'), None)
+        self.texte[998] = '#:guid:auch_nachgetragen'
+        self.assertEqual(get_guid('998'), 'auch_nachgetragen')
+        self.assertEqual(_guidindex['auch_nachgetragen'], [998])
 
 
 def _selftest():
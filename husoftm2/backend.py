@@ -15,7 +15,7 @@ Copyright (c) 2006, 2008, 2009, 2010 HUDORA. All rights reserved.
 
 from decimal import Decimal
 from husoftm2.fields import MAPPINGDIR, DATETIMEDIR, DECIMALIZE2
-from husoftm2.tools import softm2date
+from husoftm2.tools import softm2date, sql_quote
 import datetime
 import doctest
 import hashlib
@@ -349,13 +349,72 @@ def query(tables=None, condition=None, fields=None, querymappings=None,
     return rows
 
 
-def x_en(tablename, condition, ua=''):
+def query_pages(tables=None, condition=None, fields=None, querymappings=None, joins=None,
+                key='LKSANK', page_size=1000, ua='', cachingtime=300):
+    """Like query() but reads large results page by page using keyset pagination.
+
+    Rows are ordered by `key` descending. Each page is fetched with `limit=page_size`, the next page
+    continues with "key < <last key of the previous page>". The function is a generator yielding one
+    list of rows per page, so no single request gets big enough to run into timeouts and callers can
+    process huge results with constant memory.
+
+    `key` has to be unique (e.g. a Satznummer like LKSANK or a document number like AKAUFN) and must
+    be part of the result - either in `fields` or via the field mappings.
+
+    >>> for rows in query_pages('ALK00', condition="LKLFSN<>0", key='LKSANK', page_size=500):
+    ...     process(rows)
+    """
+    if isinstance(tables, basestring):
+        tables = [tables]
+    if isinstance(fields, basestring):
+        fields = [fields]
+
+    # Where do we find the key in the rows query() returns?
+    if querymappings == {} or (querymappings is None and fields and len(fields) == 1):
+        if key not in (fields or []):
+            raise RuntimeError("key %s has to be part of fields" % key)
+        key_position = list(fields).index(key)
+    else:
+        mappings = querymappings
+        if mappings is None:
+            mappings = {}
+            for table in tables + [table for table, _a, _b in (joins or [])]:
+                mappings.update(MAPPINGDIR.get(table, {}))
+        if key not in mappings or (fields and key not in fields):
+            raise RuntimeError("key %s has to be part of the result, check fields.py" % key)
+        key_position = mappings[key]
+
+    last = None
+    while True:
+        conditions = []
+        if condition:
+            conditions.append("(%s)" % condition)
+        if last is not None:
+            if isinstance(last, basestring):
+                conditions.append("%s<%s" % (key, sql_quote(last)))
+            else:
+                conditions.append("%s<%s" % (key, last))
+        rows = query(tables, condition=' AND '.join(conditions), fields=fields, querymappings=querymappings,
+                     joins=joins, ordering=['%s DESC' % key], limit=page_size, ua=ua, cachingtime=cachingtime)
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            break
+        last = rows[-1][key_position]
+
+
+def x_en(tablename, condition, ua='', multiple=False):
     """Setze Status in Tabelle auf 'X'
 
     Kann auch andere Tabellenzustände setzen, wenn SoftMexpress dies vorsieht.
 
     >>> x_en('ISR00', 'IRKBNR=930429 AND IRAUPO=13')
     '1'
+
+    Mit multiple=True darf die Bedingung beliebig viele Zeilen treffen. Zurückgegeben wird dann die
+    Anzahl der geänderten Zeilen als int.
+    >>> x_en('ALK00', 'LKLFSN IN (4034544, 4034545) AND LKKZ02=0', multiple=True)
+    2
     """
 
     args = dict(tablename=tablename,
@@ -363,6 +422,11 @@ def x_en(tablename, condition, ua=''):
                 tag=ua)
 
     result = execute('x_en', args, ua=ua)
+    if multiple:
+        try:
+            return int(result.strip())
+        except ValueError:
+            raise RuntimeError("UPDATE Problem: %s %s %r" % (tablename, condition, result))
     if result != '1\n':
         if result.strip() == '0':
             logging.info("No columns updated: %s %s %r", tablename, condition, result)
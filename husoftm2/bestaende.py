@@ -14,16 +14,25 @@ Für die Frage, ob ein bestimmter Artikel in einem bestimmten Lager ist, ist bes
 
     bestellmengen(artnr)                          von uns bei Lieferanten bestellte Mengen
     auftragsmengen(artnr, lager=0)                bei uns von Kunden bestellte Mengen
+    lade_auftragsbuch()                           offene Aufträge lokal halten statt jedesmal abzufragen
     umlagermenge(artnr, lager)                    Menge, die zur Zeit von einem Lager ans andere
                                                   unterwegs ist
     buchbestand(artnr, lager=0)                   Artikel am Lager
     buchbestaende(lager=0)                        Alle Artikel an einem Lager
+    bestandsmatrix(artnrs=None, lager=None)       Buchbestände und Umlagerungen aller Artikel und Läger
     bestandsentwicklung(artnr)                    Prognose der Bestandsänderungen
     freie_menge(artnr)                            Menge, die Verkauft werden kann
     ist_frei_am(menge, artnr, date)               Ist eine bestimmte menge an date zu haben?
+    pruefe_auftrag_verfuegbarkeit(lines, date)    ist_frei_am() für alle Positionen eines Auftrags
     frei_ab(menge, artnr, dateformat="%Y-%m-%d")  ab wann ist eine bestimmte Menge frühstens verfügbar?
     bestand(artnr, lager)                         Wieviel ist zur Zeit an einem Lager oder trifft
                                                   kurzum ein?
+    erzeuge_snapshot(dateiname)                   Verfügbarkeiten aller Artikel in eine Datei schreiben
+    lade_snapshot(dateiname)                      Snapshot für die snapshot_*() Funktionen öffnen
+    snapshot_freie_menge(artnr, lager=0)          freie_menge() aus dem Snapshot
+    snapshot_frei_ab(menge, artnr, lager=0)       frei_ab() aus dem Snapshot
+    snapshot_buchbestand(artnr, lager=0)          buchbestand() aus dem Snapshot
+    aktualisiere_snapshot()                       Artikel mit Bewegungen seit dem Snapshot neu berechnen
 
 
 Es gibt verschiedene Mengen von denen wir reden.
@@ -42,9 +51,14 @@ Es gibt verschiedene Mengen von denen wir reden.
 
 from husoftm.tools import sql_quote
 from husoftm2.backend import query, as400_2_int
+from husoftm2.tools import date2softm
+import bisect
 import datetime
 import husoftm2.artikel
-import itertools
+import husoftm2.bestandssnapshot
+import os
+import sys
+import tempfile
 import time
 import unittest
 
@@ -76,12 +90,51 @@ def buchbestand(artnr, lager=0):
     return 0
 
 
-def bestellmengen(artnr, lager=0):
+def _datumsspalte(feld, granularity='day'):
+    """Liefert einen SQL-Ausdruck, der das CYYMMDD Datumsfeld `feld` bei granularity 'month' auf den
+    Monatsersten abbildet - ebenfalls im CYYMMDD Format. So kann die AS/400 schon im GROUP BY monatsweise
+    summieren, statt jeden einzelnen Tag zu übertragen.
+
+    Wochen lassen sich nur mit den Datumsfunktionen der AS/400 bilden, und die brechen bei einem einzigen
+    kaputten Datum die ganze Abfrage ab. Bei 'week' wird daher tageweise abgefragt und erst in Python
+    mit _periode() zu Wochen zusammengefasst.
+
+    >>> _datumsspalte('APDTLT', 'week')
+    'APDTLT'
+    >>> _datumsspalte('APDTLT', 'month')
+    'CASE WHEN APDTLT<=0 OR MOD(APDTLT, 1000000)=999999 THEN APDTLT ELSE INTEGER(APDTLT/100)*100+1 END'
+    """
+    if granularity in ('day', 'week'):
+        return feld
+    elif granularity != 'month':
+        raise ValueError("Unbekannte Granularitaet: %r" % granularity)
+    # Leere und unbestimmte (999999) Daten lassen wir unverändert.
+    return "CASE WHEN %s<=0 OR MOD(%s, 1000000)=999999 THEN %s ELSE INTEGER(%s/100)*100+1 END" % (
+        feld, feld, feld, feld)
+
+
+def _periode(datum, granularity):
+    """Bildet ein Datum aus einer der Abfragen auf den Beginn seines Zeitraums ab, siehe _bucket().
+
+    Leere und unbestimmte Liefertermine bleiben unverändert.
+
+    >>> _periode(datetime.date(2010, 12, 16), 'week')
+    datetime.date(2010, 12, 13)
+    """
+    if datum and datum != datetime.date(9999, 12, 31):
+        return datetime.date.fromordinal(_bucket(datum.toordinal(), granularity))
+    return datum
+
+
+def bestellmengen(artnr, lager=0, granularity='day'):
     """Liefert eine Liste mit allen Bestellten aber noch nicht gelieferten Wareneingängen.
 
     >>> bestellmengen('14865')
     {datetime.date(2009, 2, 20): 1200,
      datetime.date(2009, 5, 5): 300}
+
+    Mit granularity='week' bzw. 'month' wird pro Woche (Montag) bzw. Monat (Monatserster) summiert,
+    monatsweise schon auf der AS/400.
     """
     conditions = ["BPSTAT<>'X'",
                   "BPKZAK=0",
@@ -90,13 +143,49 @@ def bestellmengen(artnr, lager=0):
         conditions += ["BPLGNR=%s" % sql_quote(lager)]
 
     # detailierte Informationen gibts in EWZ00
-    rows = query('EBP00', fields=['BPDTLT', 'SUM(BPMNGB-BPMNGL)'], ordering='BPDTLT',
-                 grouping='BPDTLT', condition=' AND '.join(conditions))
-    return dict([(x['liefer_date'], as400_2_int(x['SUM(BPMNGB-BPMNGL)']))
-                 for x in rows if as400_2_int(x['SUM(BPMNGB-BPMNGL)']) > 0])
+    datumsspalte = _datumsspalte('BPDTLT', granularity)
+    rows = query('EBP00', fields=[datumsspalte, 'SUM(BPMNGB-BPMNGL)'], ordering=datumsspalte,
+                 grouping=datumsspalte, condition=' AND '.join(conditions),
+                 querymappings={datumsspalte: 'liefer_date', 'SUM(BPMNGB-BPMNGL)': 'menge_offen'})
+    ret = {}
+    for row in rows:
+        menge = as400_2_int(row['menge_offen'])
+        if menge > 0:
+            datum = _periode(row['liefer_date'], granularity)
+            ret[datum] = ret.get(datum, 0) + menge
+    return ret
+
+
+def bestellmengen_alle_artikel(artnrs=None, lager=0, granularity='day'):
+    """Wie bestellmengen(), aber für einige oder alle Artikel mit einer einzigen Abfrage.
+
+    >>> bestellmengen_alle_artikel(['14865'])
+    {u'14865': {datetime.date(2009, 2, 20): 1200,
+                datetime.date(2009, 5, 5): 300}}
+    """
+    conditions = ["BPSTAT<>'X'",
+                  "BPKZAK=0"]
+    if artnrs:
+        conditions += ["BPARTN IN (%s)" % ','.join([sql_quote(artnr) for artnr in artnrs])]
+    if lager:
+        conditions += ["BPLGNR=%s" % sql_quote(lager)]
+
+    datumsspalte = _datumsspalte('BPDTLT', granularity)
+    rows = query('EBP00', fields=['BPARTN', datumsspalte, 'SUM(BPMNGB-BPMNGL)'], ordering=datumsspalte,
+                 grouping=['BPARTN', datumsspalte], condition=' AND '.join(conditions),
+                 querymappings={'BPARTN': 'artnr', datumsspalte: 'liefer_date',
+                                'SUM(BPMNGB-BPMNGL)': 'menge_offen'})
+    ret = {}
+    for row in rows:
+        menge = as400_2_int(row['menge_offen'])
+        if menge > 0:
+            mengen = ret.setdefault(row['artnr'], {})
+            datum = _periode(row['liefer_date'], granularity)
+            mengen[datum] = mengen.get(datum, 0) + menge
+    return ret
 
 
-def auftragsmengen(artnr, lager=0):
+def auftragsmengen(artnr, lager=0, granularity='day'):
     """Liefert eine Liste offener Aufträge (Warenausgänge) für einen Artikel OHNE UMLAGERUNGEN.
 
     >>> auftragsmengen(14865)
@@ -104,7 +193,14 @@ def auftragsmengen(artnr, lager=0):
      datetime.date(2009, 4, 1): 300,
      datetime.date(2009, 5, 4): 260,
      datetime.date(2009, 6, 2): 300}
+
+    granularity siehe bestellmengen(). Ist das Auftragsbuch geladen (siehe lade_auftragsbuch()), wird
+    die Frage ohne Abfrage aus dem lokalen Index beantwortet.
     """
+    if _auftragsbuch_aktuell():
+        return dict([(datum, menge) for (datum, (menge, _positionen))
+                     in _auftragsbuch_mengen(artnr, lager, granularity).items()])
+
     conditions = [
         "APARTN=%s" % (sql_quote(artnr)),  # Artikelnummer
         "AKAUFN=APAUFN",
@@ -118,16 +214,26 @@ def auftragsmengen(artnr, lager=0):
     if lager:
         # Achtung, hier gibt es KEIN Lager 0 in der Tabelle. D.h. APLGNR=0 gibt nix
         conditions = conditions + ["APLGNR=%d" % lager]
-    rows = query(['AAP00', 'AAK00'], fields=['APDTLT', 'SUM(APMNG-APMNGF)'],
+    datumsspalte = _datumsspalte('APDTLT', granularity)
+    rows = query(['AAP00', 'AAK00'], fields=[datumsspalte, 'SUM(APMNG-APMNGF)'],
                    condition=' AND '.join(conditions),
-                   ordering='APDTLT', grouping='APDTLT',
-                   querymappings={'SUM(APMNG-APMNGF)': 'menge_offen', 'APDTLT': 'liefer_date'})
-    return dict([(x['liefer_date'], as400_2_int(x['menge_offen'])) for x in rows if x['menge_offen'] > 0])
+                   ordering=datumsspalte, grouping=datumsspalte,
+                   querymappings={'SUM(APMNG-APMNGF)': 'menge_offen', datumsspalte: 'liefer_date'})
+    ret = {}
+    for row in rows:
+        if row['menge_offen'] > 0:
+            datum = _periode(row['liefer_date'], granularity)
+            ret[datum] = ret.get(datum, 0) + as400_2_int(row['menge_offen'])
+    return ret
 
 
-def auftragsmengen_alle_artikel():
+def auftragsmengen_alle_artikel(artnrs=None, lager=0, granularity='day'):
     """Liefert eine Liste offener Aufträge aller Artikel furu alle Läger.
 
+    Die Werte sind Tupel aus offener Menge und Anzahl der Auftragspositionen. Mit `artnrs` und `lager`
+    kann die Abfrage auf einige Artikel bzw. ein Lager eingeschränkt werden. granularity siehe
+    bestellmengen() - bei 'month' wird nur noch ein Bruchteil der Zeilen übertragen.
+
     >>> auftragsmengen_alle_artikel(34)
     {'14550': {datetime.date(2008, 11, 30): 3450,
                datetime.date(2008, 12, 1): 8,
@@ -140,8 +246,19 @@ def auftragsmengen_alle_artikel():
      '14635': {datetime.date(2008, 11, 19): 20,
                datetime.date(2008, 11, 24): 763,
                datetime.date(2008, 11, 27): 200}}
+
+    Ist das Auftragsbuch geladen (siehe lade_auftragsbuch()), wird ohne Abfrage aus dem lokalen Index
+    geantwortet.
     """
 
+    if _auftragsbuch_aktuell():
+        ret = {}
+        for artnr in (artnrs or _auftragsbuch_index.keys()):
+            mengen = _auftragsbuch_mengen(artnr, lager, granularity)
+            if mengen:
+                ret[str(artnr)] = mengen
+        return ret
+
     conditions = [
     "AKAUFN=APAUFN",
     "AKAUFA<>'U'",               # keine Umlagerungen
@@ -150,18 +267,146 @@ def auftragsmengen_alle_artikel():
     "(APMNG-APMNGF) > 0",        # (noch) zu liefernde menge ist positiv
     "AKSTAT<>'X'",               # Auftrag nicht logisch gelöscht
     "AKKZVA=0"]                  # Auftrag nicht als 'voll ausgeliefert' markiert
+    if artnrs:
+        conditions.append("APARTN IN (%s)" % ','.join([sql_quote(artnr) for artnr in artnrs]))
+    if lager:
+        # Achtung, hier gibt es KEIN Lager 0 in der Tabelle. D.h. APLGNR=0 gibt nix
+        conditions.append("APLGNR=%d" % int(lager))
 
+    datumsspalte = _datumsspalte('APDTLT', granularity)
     rows = query(['AAP00', 'AAK00'],
-            fields=['APARTN', 'APDTLT', 'SUM(APMNG-APMNGF)', 'COUNT(*)'],
+            fields=['APARTN', datumsspalte, 'SUM(APMNG-APMNGF)', 'COUNT(*)'],
             condition=' AND '.join(conditions),
-            ordering='APDTLT', grouping=['APARTN', 'APDTLT'],
+            ordering=datumsspalte, grouping=['APARTN', datumsspalte],
             querymappings={'SUM(APMNG-APMNGF)': 'menge_offen', 'APARTN': 'artnr',
-                           'COUNT(*)': 'orderlines', 'APDTLT': 'liefer_date'})
+                           'COUNT(*)': 'orderlines', datumsspalte: 'liefer_date'})
     ret = {}
     for row in rows:
         if row['menge_offen']:
-            ret.setdefault(str(row['artnr']), {})[row['liefer_date']] = (as400_2_int(row['menge_offen']),
-                                                                         row['orderlines'])
+            mengen = ret.setdefault(str(row['artnr']), {})
+            datum = _periode(row['liefer_date'], granularity)
+            menge, orderlines = mengen.get(datum, (0, 0))
+            mengen[datum] = (menge + as400_2_int(row['menge_offen']), orderlines + row['orderlines'])
+    return ret
+
+
+# Lokales Auftragsbuch: alle offenen Auftragspositionen (ohne Umlagerungen) und daraus summierte
+# Auftragsmengen. Wird durch lade_auftragsbuch() befüllt und danach von auftragsmengen() und
+# auftragsmengen_alle_artikel() statt der AAP00/AAK00 Abfragen verwendet. Nach AUFTRAGSBUCH_INTERVALL
+# Sekunden werden seit dem letzten Stand geänderte Aufträge nachgeladen, nach AUFTRAGSBUCH_MAXALTER
+# Sekunden wird das ganze Auftragsbuch neu geladen und damit mit SoftM abgeglichen.
+AUFTRAGSBUCH_INTERVALL = 60 * 5
+AUFTRAGSBUCH_MAXALTER = 60 * 60 * 12
+_auftragsbuch = {}        # (auftragsnr, position) -> (artnr, lager, liefer_date, menge)
+_auftragsbuch_index = {}  # artnr -> {(lager, liefer_date): (menge, positionen)}
+_auftragsbuch_geladen = 0
+_auftragsbuch_stand = 0
+
+_AUFTRAGSBUCH_FELDER = {'APAUFN': 'auftragsnr', 'APAUPO': 'position', 'APARTN': 'artnr', 'APLGNR': 'lager',
+                        'APDTLT': 'liefer_date', 'APMNG-APMNGF': 'menge_offen', 'AKAUFA': 'art',
+                        'APSTAT': 'position_status', 'APKZVA': 'position_voll_ausgeliefert',
+                        'AKSTAT': 'status', 'AKKZVA': 'voll_ausgeliefert'}
+
+
+def _auftragsbuch_buchen(key, position):
+    """Ersetzt eine Position im Auftragsbuch (None entfernt sie) und pflegt die Summen im Index."""
+    alt = _auftragsbuch.pop(key, None)
+    if alt:
+        artnr, lager, liefer_date, menge = alt
+        summen = _auftragsbuch_index[artnr]
+        summe, anzahl = summen.pop((lager, liefer_date))
+        if anzahl > 1:
+            summen[(lager, liefer_date)] = (summe - menge, anzahl - 1)
+        elif not summen:
+            del _auftragsbuch_index[artnr]
+    if position:
+        _auftragsbuch[key] = position
+        artnr, lager, liefer_date, menge = position
+        summen = _auftragsbuch_index.setdefault(artnr, {})
+        summe, anzahl = summen.get((lager, liefer_date), (0, 0))
+        summen[(lager, liefer_date)] = (summe + menge, anzahl + 1)
+
+
+def _auftragsbuch_position(row):
+    """Wandelt eine Zeile der Auftragsbuch-Abfrage in einen Eintrag oder None, wenn sie nicht offen ist."""
+    menge = as400_2_int(row['menge_offen'])
+    if row['art'] == 'U' or row['status'] == 'X' or row['position_status'] == 'X':
+        return None
+    if int(row['voll_ausgeliefert']) or int(row['position_voll_ausgeliefert']) or menge <= 0:
+        return None
+    return (unicode(row['artnr']), int(row['lager']), row['liefer_date'], menge)
+
+
+def _auftragsbuch_lesen(conditions):
+    """Liest Auftragspositionen und bucht sie ins Auftragsbuch. Gibt die Anzahl der Zeilen zurück."""
+    rows = query(['AAP00', 'AAK00'], fields=_AUFTRAGSBUCH_FELDER.keys(), querymappings=_AUFTRAGSBUCH_FELDER,
+                 condition=' AND '.join(["AKAUFN=APAUFN"] + conditions), cachingtime=0,
+                 ua='husoftm2.bestaende')
+    for row in rows:
+        _auftragsbuch_buchen((row['auftragsnr'], row['position']), _auftragsbuch_position(row))
+    return len(rows)
+
+
+def lade_auftragsbuch():
+    """Lädt alle offenen Auftragspositionen in das lokale Auftragsbuch.
+
+    Danach beantworten auftragsmengen() und auftragsmengen_alle_artikel() Anfragen aus dem Speicher.
+    Gibt die Anzahl der offenen Positionen zurück.
+    """
+    global _auftragsbuch_geladen, _auftragsbuch_stand
+
+    jetzt = time.time()
+    _auftragsbuch.clear()
+    _auftragsbuch_index.clear()
+    _auftragsbuch_lesen(["AKAUFA<>'U'",         # keine Umlagerungen
+                         "APSTAT<>'X'",         # Position nicht logisch gelöscht
+                         "APKZVA=0",            # Position nicht als 'voll ausgeliefert' markiert
+                         "(APMNG-APMNGF) > 0",  # (noch) zu liefernde menge ist positiv
+                         "AKSTAT<>'X'",         # Auftrag nicht logisch gelöscht
+                         "AKKZVA=0"])           # Auftrag nicht als 'voll ausgeliefert' markiert
+    _auftragsbuch_geladen = _auftragsbuch_stand = jetzt
+    return len(_auftragsbuch)
+
+
+def aktualisiere_auftragsbuch():
+    """Lädt alle Auftragspositionen nach, die sich seit dem letzten Stand geändert haben.
+
+    SoftM führt Änderungsdaten nur tagesgenau (AKDTAE, APDTAE, APDTER). Wir lesen deshalb ab dem Tag des
+    letzten Stands - Positionen werden ersetzt, doppelt gelesene Zeilen schaden also nicht.
+    Gibt die Anzahl der gelesenen Positionen zurück.
+    """
+    global _auftragsbuch_stand
+
+    jetzt = time.time()
+    seit = date2softm(datetime.date.fromtimestamp(_auftragsbuch_stand))
+    anzahl = _auftragsbuch_lesen(["(AKDTAE>=%s OR APDTAE>=%s OR APDTER>=%s)" % (seit, seit, seit)])
+    _auftragsbuch_stand = jetzt
+    return anzahl
+
+
+def _auftragsbuch_aktuell():
+    """Gibt True zurück, wenn das Auftragsbuch geladen ist, und hält es dann aktuell."""
+    if not _auftragsbuch_geladen:
+        return False
+    if time.time() - _auftragsbuch_geladen > AUFTRAGSBUCH_MAXALTER:
+        lade_auftragsbuch()
+    elif time.time() - _auftragsbuch_stand > AUFTRAGSBUCH_INTERVALL:
+        aktualisiere_auftragsbuch()
+    return True
+
+
+def _auftragsbuch_mengen(artnr, lager=0, granularity='day'):
+    """Offene Auftragsmengen eines Artikels aus dem Auftragsbuch als {datum: (menge, positionen)}.
+
+    Wie bei _periode() bleiben leere und unbestimmte Liefertermine unverändert.
+    """
+    ret = {}
+    for (lgnr, liefer_date), (menge, anzahl) in _auftragsbuch_index.get(unicode(artnr), {}).items():
+        if lager and lgnr != int(lager):
+            continue
+        datum = _periode(liefer_date, granularity)
+        alt_menge, alt_anzahl = ret.get(datum, (0, 0))
+        ret[datum] = (alt_menge + menge, alt_anzahl + anzahl)
     return ret
 
 
@@ -201,6 +446,351 @@ def bestand(artnr, lager=0):
     return buchbestand(artnr, lager) + umlagermenge(artnr, lager)
 
 
+def bestandsmatrix(artnrs=None, lager=None):
+    """Buchbestände und unterwegs befindliche Umlagerungen vieler Artikel in vielen Lägern.
+
+    Statt buchbestaende() und umlagermenge() pro Lager und Artikel aufzurufen, werden XLF00 und die
+    offenen Umlagerungen mit je einer gruppierten Abfrage gelesen. `artnrs` und `lager` (eine Lagernummer
+    oder eine Liste davon) schränken die Abfrage ein, ohne Angabe werden alle Artikel und Läger geliefert.
+
+    Rückgabe ist ein dict mit den sortierten Indexvektoren `artnrs` und `laeger` sowie den Matrizen
+    `buchbestand`, `umlagermenge` und `bestand` (Summe wie bei bestand()) als Listen von Zeilen.
+    matrix[i][j] ist der Wert für artnrs[i] in laeger[j], fehlende Kombinationen sind 0.
+
+    >>> m = bestandsmatrix(['14600', '76095'], [0, 100])
+    >>> m['laeger'], m['artnrs']
+    ([0, 100], [u'14600', u'76095'])
+    >>> m['bestand']
+    [[2345, 1200], [53, 53]]
+    """
+    if lager is not None and not isinstance(lager, (list, tuple)):
+        lager = [lager]
+
+    conditions = ["LFMGLP<>0",
+                  "LFSTAT<>'X'"]
+    if artnrs:
+        conditions.append("LFARTN IN (%s)" % ','.join([sql_quote(artnr) for artnr in artnrs]))
+    if lager is not None:
+        conditions.append("LFLGNR IN (%s)" % ','.join([str(int(lgnr)) for lgnr in lager]))
+    bestaende = query(['XLF00'], fields=['LFLGNR', 'LFARTN', 'SUM(LFMGLP)'], grouping=['LFLGNR', 'LFARTN'],
+                      condition=' AND '.join(conditions), querymappings={})
+
+    # siehe umlagermenge(): Das Ziellager steht in AKLGN2
+    conditions = ["AKAUFN=APAUFN",
+                  "AKAUFA='U'",                 # Umlagerungsauftrag
+                  "APSTAT<>'X'",                # Position nicht logisch gelöscht
+                  "APKZVA=0",                   # Position nicht als 'voll ausgeliefert' markiert
+                  "AKSTAT<>'X'",                # Auftrag nicht logisch gelöscht
+                  "AKKZVA=0"]                   # Auftrag nicht als 'voll ausgeliefert' markiert
+    if artnrs:
+        conditions.append("APARTN IN (%s)" % ','.join([sql_quote(artnr) for artnr in artnrs]))
+    if lager is not None:
+        conditions.append("AKLGN2 IN (%s)" % ','.join([str(int(lgnr)) for lgnr in lager]))
+    umlagerungen = query(['AAP00', 'AAK00'], fields=['AKLGN2', 'APARTN', 'SUM(APMNG)'],
+                         grouping=['AKLGN2', 'APARTN'], condition=' AND '.join(conditions), querymappings={})
+
+    laeger = set(lager or [])
+    alle_artnrs = set(artnrs or [])
+    for lgnr, artnr, _menge in bestaende + umlagerungen:
+        laeger.add(int(lgnr))
+        alle_artnrs.add(artnr)
+    laeger = sorted(laeger)
+    alle_artnrs = sorted(alle_artnrs)
+    spalte = dict([(lgnr, j) for (j, lgnr) in enumerate(laeger)])
+    zeile = dict([(artnr, i) for (i, artnr) in enumerate(alle_artnrs)])
+
+    ret = dict(artnrs=alle_artnrs, laeger=laeger)
+    for name, rows in [('buchbestand', bestaende), ('umlagermenge', umlagerungen)]:
+        matrix = [[0] * len(laeger) for _artnr in alle_artnrs]
+        for lgnr, artnr, menge in rows:
+            matrix[zeile[artnr]][spalte[int(lgnr)]] = as400_2_int(menge)
+        ret[name] = matrix
+    ret['bestand'] = [[buchbestand + umlagermenge for (buchbestand, umlagermenge) in zip(*zeilen)]
+                      for zeilen in zip(ret['buchbestand'], ret['umlagermenge'])]
+    return ret
+
+
+# Interne Darstellung der Bestandskurven
+#
+# Intern rechnen wir nicht mit per strftime() erzeugten Datumsstrings, sondern mit Ordinalzahlen
+# (siehe datetime.date.toordinal()). Bei wochenweiser Auflösung steht jede Woche für die Ordinalzahl
+# ihres Montags. Eine Kurve ist eine nach Datum sortierte Liste von (ordinal, menge) Tupeln.
+# In das vom Aufrufer gewünschte `dateformat` wird erst an der API-Grenze umgewandelt.
+
+def _granularity(dateformat):
+    """Ermittelt aus einem dateformat die Auflösung der internen Kurven: 'week', 'month' oder 'day'.
+
+    >>> _granularity('%Y-w%W')
+    'week'
+    >>> _granularity('%Y-%m')
+    'month'
+    >>> _granularity('%Y-%m-%d')
+    'day'
+    """
+    if '%W' in dateformat:
+        return 'week'
+    if '%m' in dateformat and '%d' not in dateformat and '%j' not in dateformat:
+        return 'month'
+    return 'day'
+
+
+def _bucket(ordinal, granularity):
+    """Bildet eine Ordinalzahl auf den Beginn ihres Zeitraums ab - bei 'week' den Montag, bei 'month'
+    den Monatsersten.
+
+    Ordinalzahl 1 (der 1.1.0001) ist ein Montag.
+
+    >>> datetime.date.fromordinal(_bucket(datetime.date(2010, 12, 16).toordinal(), 'week'))
+    datetime.date(2010, 12, 13)
+    """
+    if granularity == 'week':
+        return ordinal - (ordinal - 1) % 7
+    if granularity == 'month':
+        return ordinal - datetime.date.fromordinal(ordinal).day + 1
+    return ordinal
+
+
+def _ordinal2str(ordinal, dateformat):
+    """Wandelt eine Ordinalzahl an der API-Grenze in das Datumsformat des Aufrufers."""
+    return datetime.date.fromordinal(ordinal).strftime(dateformat)
+
+
+def _str2ordinal(datum, dateformat):
+    """Wandelt ein Datum (datetime.date oder String im dateformat) in eine Ordinalzahl.
+
+    >>> _str2ordinal('2010-w50', '%Y-w%W') == datetime.date(2010, 12, 13).toordinal()
+    True
+    """
+    if isinstance(datum, (datetime.date, datetime.datetime)):
+        return datum.toordinal()
+    if '%W' in dateformat and '%w' not in dateformat and '%a' not in dateformat:
+        # Ohne Wochentag ignoriert strptime() die Wochennummer. Wir legen uns deshalb auf den Montag fest.
+        return datetime.datetime.strptime(datum + ' 1', dateformat + ' %w').toordinal()
+    return datetime.datetime.strptime(datum, dateformat).toordinal()
+
+
+def _ordinal_bewegungen(bestand, zugaenge, abgaenge, granularity, heute=None):
+    """Erzeugt eine sortierte Liste von (ordinal, bewegung) Tupeln.
+
+    `bestand` ist der Buchbestand heute, `zugaenge` und `abgaenge` sind dicts von datetime.date auf
+    Mengen, wie sie bestellmengen() und auftragsmengen() liefern.
+    """
+    if heute is None:
+        heute = datetime.date.today().toordinal()
+    # Startwert ist der Buchbestand, Bestellmengen positiv, Auftragsmengen negativ
+    bewegungen = [(_bucket(heute, granularity), int(bestand))]
+    bewegungen.extend([(_bucket(datum.toordinal(), granularity), int(menge))
+                       for (datum, menge) in zugaenge.items()])
+    bewegungen.extend([(_bucket(datum.toordinal(), granularity), -1 * int(menge))
+                       for (datum, menge) in abgaenge.items()])
+    bewegungen.sort()
+    return bewegungen
+
+
+def _kurve(bewegungen):
+    """Summiert (ordinal, bewegung) Tupel zu einer Bestandskurve auf.
+
+    >>> _kurve([(3, -5), (1, 10), (3, 2)])
+    [(1, 10), (3, 7)]
+    """
+    kurve = []
+    menge = 0
+    for ordinal, bewegung in sorted(bewegungen):
+        menge += bewegung
+        if kurve and kurve[-1][0] == ordinal:
+            kurve[-1] = (ordinal, menge)
+        else:
+            kurve.append((ordinal, menge))
+    return kurve
+
+
+def _kurve2bewegungen(kurve):
+    """Umkehrung von _kurve(): erster Wert als Startmenge, danach die Differenzen.
+
+    >>> _kurve2bewegungen([(1, 10), (3, 7)])
+    [(1, 10), (3, -3)]
+    """
+    bewegungen = []
+    menge = 0
+    for ordinal, bestand in kurve:
+        bewegungen.append((ordinal, bestand - menge))
+        menge = bestand
+    return bewegungen
+
+
+def _minimum_kurve(kurven):
+    """Punktweises Minimum mehrerer Kurven.
+
+    Zwischen zwei Stützstellen gilt der Wert der vorherigen. Vor ihrer ersten Stützstelle schränkt eine
+    Kurve das Minimum nicht ein.
+
+    >>> _minimum_kurve([[(1, 10), (5, 4)], [(3, 6)]])
+    [(1, 10), (3, 6), (5, 4)]
+    """
+    if len(kurven) == 1:
+        return list(kurven[0])
+    ordinals = sorted(set(ordinal for kurve in kurven for ordinal, _menge in kurve))
+    positionen = [0] * len(kurven)
+    aktuell = [None] * len(kurven)
+    ret = []
+    for ordinal in ordinals:
+        for i, kurve in enumerate(kurven):
+            while positionen[i] < len(kurve) and kurve[positionen[i]][0] <= ordinal:
+                aktuell[i] = kurve[positionen[i]][1]
+                positionen[i] += 1
+        ret.append((ordinal, min(menge for menge in aktuell if menge is not None)))
+    return ret
+
+
+def _setkurve(artnr, komponenten, bewegungen_fuer):
+    """Bestandskurve für einen Artikel unter Berücksichtigung von Setartikeln.
+
+    `komponenten` ist das Ergebnis von komponentenaufloesung([(1, artnr)]), `bewegungen_fuer` eine
+    Funktion, die zu einer Artikelnummer die Liste der (ordinal, bewegung) Tupel liefert.
+    """
+
+    # Auflösung von Set-Artikeln in ihre Unterartikel. Die Bestandsentwicklung des Sets entspricht der
+    # Bestandsentwicklung der Unterartikel dividiert durch die jeweilige Anzahl der Unterartikel pro Set.
+    kurven = []
+    for komponente_menge, komponente_artnr in komponenten:
+        kurve = _kurve(bewegungen_fuer(komponente_artnr))
+        # Auf "Anteil" am Endprodukt umrechnen
+        kurven.append([(ordinal, menge // komponente_menge) for (ordinal, menge) in kurve])
+
+    # Die kleinste Menge eines Sub-Artikels ist die an diesem Datum verfügbare Menge
+    entwicklung = _minimum_kurve(kurven)
+
+    # Bei Setartikeln werden die Auftragsmengen (evtl. auch die Bestellmengen) mal für den Set,
+    # und mal für die Subartikel behandelt.
+    # Darum hier noch die Bewegungen des Setartikels überlagern
+    if len(komponenten) > 1 and entwicklung:  # Handelt es sich um einen Setartikel
+        # TODO: auch set-komponenten erfassen
+        entwicklung = _kurve(_kurve2bewegungen(entwicklung) + bewegungen_fuer(artnr))
+    return entwicklung
+
+
+def _bestandskurve(artnr, granularity='day', lager=0):
+    """Liefert die Bestandskurve eines Artikels als Liste von (ordinal, menge) Tupeln."""
+
+    def bewegungen_fuer(artnr):
+        return _ordinal_bewegungen(buchbestand(artnr, lager), bestellmengen(artnr, lager, granularity),
+                                   auftragsmengen(artnr, lager, granularity), granularity)
+
+    komponenten = husoftm2.artikel.komponentenaufloesung([(1, artnr)])
+    return _setkurve(artnr, komponenten, bewegungen_fuer)
+
+
+def _bestandskurven(artnrs, granularity='day', lager=0, bestaende=None):
+    """Wie _bestandskurve(), aber für viele Artikel mit einer festen Anzahl von Abfragen.
+
+    Gibt ein dict von Artikelnummer auf Bestandskurve zurück. Ist `artnrs` None, werden alle Artikel mit
+    Bestand oder Bewegungen sowie alle Setartikel aus dem Setartikel-Index berechnet. Sonst werden die
+    Artikel (samt Komponenten) in 50er Schritten abgefragt.
+
+    Wird für `bestaende` ein dict übergeben, landen darin die dabei gelesenen Buchbestände - so müssen
+    Aufrufer, die auch diese brauchen, buchbestaende() nicht noch einmal abfragen.
+    """
+
+    if bestaende is None:
+        bestaende = {}
+    if artnrs is not None and not artnrs:
+        # Ohne Artikelnummern würden die *_alle_artikel() Funktionen die ganzen Tabellen lesen
+        return {}
+    if artnrs is None:
+        bestaende.update(buchbestaende(None, lager))
+        zugaenge = bestellmengen_alle_artikel(None, lager, granularity)
+        abgaenge = auftragsmengen_alle_artikel(None, lager, granularity)
+        artnrs = set(bestaende.keys()) | set(zugaenge.keys()) | set(abgaenge.keys())
+        artnrs.update(husoftm2.artikel.setartikel().keys())
+        stuecklisten = husoftm2.artikel.stuecklisten(artnrs)
+    else:
+        stuecklisten = husoftm2.artikel.stuecklisten(set(artnrs))
+        alle_artnrs = set(stuecklisten.keys())
+        for komponenten in stuecklisten.values():
+            alle_artnrs.update(komponenten_artnr for _menge, komponenten_artnr in komponenten)
+        alle_artnrs = sorted(alle_artnrs)
+
+        zugaenge, abgaenge = {}, {}
+        while alle_artnrs:
+            batch = alle_artnrs[:50]
+            alle_artnrs = alle_artnrs[50:]
+            bestaende.update(buchbestaende(batch, lager))
+            zugaenge.update(bestellmengen_alle_artikel(batch, lager, granularity))
+            abgaenge.update(auftragsmengen_alle_artikel(batch, lager, granularity))
+
+    def bewegungen_fuer(artnr):
+        return _ordinal_bewegungen(bestaende.get(artnr, 0), zugaenge.get(artnr, {}),
+                                   dict([(datum, menge) for (datum, (menge, _positionen))
+                                         in abgaenge.get(artnr, {}).items()]),
+                                   granularity)
+
+    return dict([(artnr, _setkurve(artnr, komponenten, bewegungen_fuer))
+                 for (artnr, komponenten) in stuecklisten.items()])
+
+
+def _zukunft(kurve, granularity, heute=None):
+    """Entfernt historische Daten aus einer Kurve, da diese gerne negativ sind.
+
+    Der Zeitraum, in den `heute` fällt, bleibt erhalten.
+    """
+    if heute is None:
+        heute = datetime.date.today().toordinal()
+    return kurve[bisect.bisect_left(kurve, (_bucket(heute, granularity), )):]
+
+
+def _verfuegbar_am(kurve, ordinal):
+    """Menge, die ab ordinal dauerhaft frei ist: das Minimum der Kurve ab der letzten Stützstelle
+    vor oder an ordinal.
+
+    >>> _verfuegbar_am([(1, 10), (3, 4), (5, 8)], 4)
+    4
+    >>> _verfuegbar_am([(1, 10), (3, 4), (5, 8)], 5)
+    8
+    """
+    if not kurve:
+        return 0
+    start = max(0, bisect.bisect_right(kurve, (ordinal, sys.maxint)) - 1)
+    return min(menge for _ordinal, menge in kurve[start:])
+
+
+def _frei_ab(kurve, menge):
+    """Findet in einer (zukünftigen) Kurve die Ordinalzahl, ab der `menge` frei ist.
+
+    Gibt None zurück, wenn die Kurve leer ist, und False, wenn die Menge nie frei wird.
+
+    >>> _frei_ab([(1, 10), (3, 4), (5, 8)], 6)
+    5
+    >>> _frei_ab([(1, 10), (3, 4), (5, 8)], 9)
+    False
+    """
+    # Algorythmus: vom Ende der Bestandskurve nach hinten gehen, bis wir an einen punkt Kommen, wo die
+    # Kurve niedriger ist, als die geforderte Menge - ab da ist die Menge frei.
+    previous = None
+    for ordinal, menge_frei in reversed(kurve):
+        if menge_frei < menge:
+            if previous is None:
+                return False
+            return previous
+        previous = ordinal
+    return previous
+
+
+def _frei_ab_datum(kurve, menge, granularity):
+    """Ermittelt für eine vollständige Kurve das Datum, ab dem `menge` frei ist. Siehe frei_ab()."""
+
+    # remove historic data, since this tends to be negative
+    kurve = _zukunft(kurve, granularity)
+
+    # shortcut: the bestand never drops below menge
+    if kurve and min(x[1] for x in kurve) >= int(menge):
+        return datetime.date.today()
+
+    ordinal = _frei_ab(kurve, int(menge))
+    if ordinal:
+        return datetime.date.fromordinal(ordinal)
+    return ordinal
+
+
 def bewegungen(artnr, dateformat="%Y-%m-%d", lager=0):
     """Sammeln aller Bewegungen zu einem Artikel - ein Bisschen wie das Artikelkonto.
 
@@ -213,15 +803,10 @@ def bewegungen(artnr, dateformat="%Y-%m-%d", lager=0):
     für eine wochenweise Auflösung, "%Y-%m-%d" für tageweise.
 
     """
-
-    # Startwert ist der Buchbestand
-    bewegungen = [(datetime.date.today().strftime(dateformat), int(buchbestand(artnr, lager)))]
-    # Bestellmengen positiv
-    bewegungen.extend([(x[0].strftime(dateformat), int(x[1])) for x in bestellmengen(artnr, lager).items()])
-    # Auftragsmengen negativ
-    bewegungen.extend([(x[0].strftime(dateformat), -1 * x[1]) for x in auftragsmengen(artnr, lager).items()])
-    bewegungen.sort()
-    return bewegungen
+    granularity = _granularity(dateformat)
+    bewegungen = _ordinal_bewegungen(buchbestand(artnr, lager), bestellmengen(artnr, lager, granularity),
+                                     auftragsmengen(artnr, lager, granularity), granularity)
+    return [(_ordinal2str(ordinal, dateformat), menge) for (ordinal, menge) in bewegungen]
 
 
 def bewegungen_to_bestaende(bewegungen):
@@ -259,46 +844,10 @@ def bestandsentwicklung(artnr, dateformat="%Y-%m-%d", lager=0):
      '2009-05-04': 300}
     """
 
-    # Auflösung von Set-Artikeln in ihre Unterartikel. Die Bestandsentwicklung des Sets entspricht der
-    # Bestandsentwicklung der Unterartikel dividiert durch die jeweilige Anzahl der Unterartikel pro Set.
-    komponenten = husoftm2.artikel.komponentenaufloesung([(1, artnr)])
-    bestentw_all = []  # list of dicts
-    for komponente_menge, komponente_artnr in komponenten:
-        bewegungen_komponente = bewegungen(komponente_artnr, dateformat, lager)
-        bestaende_komponente = bewegungen_to_bestaende(bewegungen_komponente)
-        # Auf "Anteil" am Endprodukt umrechnen
-        bestaende_komponente = dict([(datum, mng / komponente_menge)
-                                     for (datum, mng) in bestaende_komponente.items()])
-        bestentw_all.append(bestaende_komponente)
-
-    # Die kleinste Menge eines Sub-Artikels ist die an diesem Datum verfügbare Menge
-    alldays = [komponentenentwicklung.keys() for komponentenentwicklung in bestentw_all]
-    alldays = set(itertools.chain(*alldays))
-    entwicklung = {}
-    for datum in alldays:
-        entwicklung[datum] = min(entwicklung.get(datum, 99999999) for entwicklung in bestentw_all)
-
-    # Bei Setartikeln werden die Auftragsmengen (evtl. auch die Bestellmengen) mal für den Set,
-    # und mal für die Subartikel behandelt.
-    # Darum hier noch die Bewegungen des Setartikels überlagern
-    if len(komponenten) > 1:  # Handelt es sich um einen Setartikel
-        # TODO: auch set-komponenten erfassen
-        bewegungen_set = bewegungen(artnr, dateformat, lager)
-
-        # Bewegungsmengen aus der gerade ermittelten Bestandsendwicklung der Unterartikel erzeugen
-        entwicklung = sorted(entwicklung.items())
-        startdate, startmenge = entwicklung[0]
-        bewegungen_komponenten = [(startdate, startmenge)]
-        menge = startmenge
-        for date, mengenaenderung in entwicklung[1:]:
-            bewegungen_set.append((date, mengenaenderung - menge))
-            menge = mengenaenderung
-
-        # Bewegungen mit denen des Setartikels kombinieren und erneut eine Bestandsentwicklung
-        # daraus berechnen
-        entwicklung = bewegungen_to_bestaende(bewegungen_komponenten + bewegungen_set)
-
-    return entwicklung
+    # Da die Kurve aufsteigend sortiert ist, gewinnt bei gröberen Formaten (z.B. "%Y-%m") jeweils der
+    # letzte Wert eines Zeitraums.
+    return dict([(_ordinal2str(ordinal, dateformat), menge)
+                 for (ordinal, menge) in _bestandskurve(artnr, _granularity(dateformat), lager)])
 
 
 def freie_menge(artnr, dateformat="%Y-w%W"):
@@ -315,12 +864,11 @@ def freie_menge(artnr, dateformat="%Y-w%W"):
 
     """
 
-    today = datetime.date.today().strftime("%Y-w%W")
-    bestandse = bestandsentwicklung(artnr, dateformat)
+    granularity = _granularity(dateformat)
     # remove historic data, since this tends to be negative
-    bestandse = [x[1] for x in bestandse.items() if x[0] >= today]
+    bestandse = _zukunft(_bestandskurve(artnr, granularity), granularity)
     if bestandse:
-        return max([min(bestandse), 0])
+        return max([min(menge for _ordinal, menge in bestandse), 0])
     else:
         return 0
 
@@ -328,19 +876,15 @@ def freie_menge(artnr, dateformat="%Y-w%W"):
 def ist_frei_am(menge, artnr, date, dateformat="%Y-%m-%d"):
     """Ermittelt, ob die Menge für einen Artikel zu dem Datum date frei ist.
 
+    date kann ein datetime.date oder ein String im Format dateformat sein.
+
     Rückgabewert ist ein Tupel. Dessen erster Eintrag gibt an, ob die Menge vorhanden ist,
     der zweite Eintrag entspricht der gesamt freien Menge zu diesem Datum.
     """
-    bentwicklung = bestandsentwicklung(artnr, dateformat).items()
-    if bentwicklung:
-        bentwicklung.sort()
-        # date should not be bigger than last date in bentwicklung
-        mindate = min((date, bentwicklung[-1][0]))
-        for index in range(len(bentwicklung)):
-            if bentwicklung[index][0] > mindate:
-                break
-        bentwicklung = bentwicklung[max(0, index - 1):]
-        verfuegbar = min(quantity for dummy, quantity in bentwicklung)
+    granularity = _granularity(dateformat)
+    kurve = _bestandskurve(artnr, granularity)
+    if kurve:
+        verfuegbar = _verfuegbar_am(kurve, _bucket(_str2ordinal(date, dateformat), granularity))
         return (verfuegbar >= menge), verfuegbar
     return False, 0
 
@@ -348,35 +892,240 @@ def ist_frei_am(menge, artnr, date, dateformat="%Y-%m-%d"):
 def frei_ab(menge, artnr, dateformat="%Y-%m-%d", lager=0):
     """Finds the earliest date when menge is frei (available) or None if it isn't available at all.
 
+    Bei wochenweiser Auflösung wird der Montag der entsprechenden Woche zurückgegeben.
+
     >>> frei_ab(50, '76095')
     None
     >>> frei_ab(500, '01104')
     datetime.date(2008, 11, 22)
     """
 
-    # Algorythmus: vom Ende der Bestandskurve nach hinten gehen, bis wir an einen punkt Kommen, wo die
-    # Kurve niedriger ist, als die geforderte Menge - ab da ist die Menge frei.
+    granularity = _granularity(dateformat)
+    return _frei_ab_datum(_bestandskurve(artnr, granularity, lager), menge, granularity)
 
-    today = datetime.date.today().strftime("%Y-%m-%d")
-    bentwicklung = bestandsentwicklung(artnr, dateformat, lager)
-    # remove historic data, since this tends to be negative
-    bentwicklung = dict([x for x in bentwicklung.items() if x[0] >= today])
 
-    # shortcut: the bestand never drops below menge
-    if bentwicklung and min(bentwicklung.values()) >= int(menge):
+def pruefe_auftrag_verfuegbarkeit(lines, date, lager=0, dateformat="%Y-%m-%d"):
+    """Prüft die Verfügbarkeit aller Positionen eines Auftrags zu einem Datum.
+
+    `lines` ist eine Liste von (menge, artnr) Tupeln, `date` ein datetime.date oder ein String im Format
+    dateformat. Die Bestandskurven aller Artikel werden gemeinsam geladen. Kommt ein Artikel auf mehreren
+    Positionen vor, werden die Mengen in der Reihenfolge der Positionen aufaddiert - eine spätere Position
+    ist also nur verfügbar, wenn auch alle vorhergehenden Positionen des Artikels bedient werden können.
+
+    Rückgabewert ist ein dict mit den Einträgen
+     * positionen - eine Liste von dicts (menge, artnr, verfuegbar, frei_ab) in der Reihenfolge von lines.
+       frei_ab ist das Datum, ab dem die Position (samt vorhergehender Positionen des Artikels) frei ist,
+       oder False/None wie bei frei_ab().
+     * verfuegbar - True, wenn alle Positionen zu `date` verfügbar sind.
+     * komplett_ab - frühestes Datum, an dem alle Positionen geliefert werden können oder None.
+
+    >>> pruefe_auftrag_verfuegbarkeit([(10, '14600'), (5, '76095'), (20, '14600')],
+    ...                               datetime.date(2010, 12, 20))
+    {'verfuegbar': False,
+     'komplett_ab': None,
+     'positionen': [{'menge': 10, 'artnr': '14600', 'verfuegbar': True,
+                     'frei_ab': datetime.date(2010, 12, 16)}, ...]}
+    """
+
+    if not lines:
+        return dict(positionen=[], verfuegbar=True, komplett_ab=None)
+    granularity = _granularity(dateformat)
+    ordinal = _bucket(_str2ordinal(date, dateformat), granularity)
+    lines = [(int(menge), artnr) for (menge, artnr) in lines]
+    kurven = _bestandskurven([artnr for (_menge, artnr) in lines], granularity, lager)
+
+    bedarf = {}
+    positionen = []
+    for menge, artnr in lines:
+        bedarf[artnr] = bedarf.get(artnr, 0) + menge
+        kurve = kurven.get(artnr, [])
+        verfuegbar = bool(kurve) and _verfuegbar_am(kurve, ordinal) >= bedarf[artnr]
+        positionen.append(dict(menge=menge, artnr=artnr, verfuegbar=verfuegbar,
+                               frei_ab=_frei_ab_datum(kurve, bedarf[artnr], granularity)))
+
+    komplett_ab = None
+    if positionen and all(position['frei_ab'] for position in positionen):
+        komplett_ab = max(position['frei_ab'] for position in positionen)
+    return dict(positionen=positionen,
+                verfuegbar=all(position['verfuegbar'] for position in positionen),
+                komplett_ab=komplett_ab)
+
+
+# Nächtlicher Snapshot der Verfügbarkeiten für Abfragen ohne SoftM-Zugriff (z.B. Produktseiten im Shop).
+# erzeuge_snapshot() schreibt die Datei, lade_snapshot() öffnet sie per mmap und die snapshot_*()
+# Funktionen beantworten Abfragen daraus. aktualisiere_snapshot() berechnet Artikel mit Bewegungen seit
+# Erstellung des Snapshots neu und legt sie in _snapshot_delta über die Datei.
+_snapshot = None
+_snapshot_delta = {}
+
+
+def _wochenkurve(kurve):
+    """Vergröbert eine tageweise Kurve auf Wochen: pro Woche gilt der letzte Wert.
+
+    >>> _wochenkurve([(734120, 10), (734122, 4), (734128, 8)])
+    [(734119, 4), (734126, 8)]
+    """
+    ret = []
+    for ordinal, menge in kurve:
+        woche = _bucket(ordinal, 'week')
+        if ret and ret[-1][0] == woche:
+            ret[-1] = (woche, menge)
+        else:
+            ret.append((woche, menge))
+    return ret
+
+
+def _snapshot_eintrag(buchbestand, kurve, heute=None):
+    """Verdichtet eine tageweise Bestandskurve zu (buchbestand, freie_menge, frei_ab_kurve).
+
+    freie_menge entspricht freie_menge() mit wochenweiser Auflösung. Die frei_ab_kurve enthält nur noch
+    die Stützstellen, ab denen dauerhaft mehr frei ist als zuvor - also (ordinal, Minimum der restlichen
+    Kurve) Paare. Damit lässt sich frei_ab() mit einer binären Suche beantworten.
+
+    >>> _snapshot_eintrag(30, [(734120, 10), (734122, 4), (734128, 8)], heute=734120)
+    (30, 4, [(734120, 4), (734128, 8)])
+    """
+    wochen = _zukunft(_wochenkurve(kurve), 'week', heute)
+    freie_menge = 0
+    if wochen:
+        freie_menge = max([min(menge for _ordinal, menge in wochen), 0])
+
+    frei = []
+    minimum = None
+    for ordinal, menge in reversed(_zukunft(kurve, 'day', heute)):
+        if minimum is None or menge < minimum:
+            minimum = menge
+        if frei and frei[-1][1] == minimum:
+            # das gleiche Minimum gilt schon ab diesem früheren Datum
+            frei[-1] = (ordinal, minimum)
+        else:
+            frei.append((ordinal, minimum))
+    frei.reverse()
+    return int(buchbestand), freie_menge, frei
+
+
+def erzeuge_snapshot(dateiname, lager=None):
+    """Berechnet Buchbestand, freie Menge und die frei_ab()-Kurve aller Artikel und schreibt sie nach
+    `dateiname`. Ohne `lager` werden alle Läger (und Lager 0 für die Summe aller Läger) berechnet.
+
+    Pro Lager sind nur eine Handvoll Abfragen nötig. Gedacht ist das für einen nächtlichen Cronjob.
+    Gibt die Anzahl der geschriebenen Einträge zurück.
+    """
+    husoftm2.artikel.lade_setartikel()
+    if lager is None:
+        lager = [0] + [int(row[0]) for row in query(['XLF00'], fields=['LFLGNR'], grouping=['LFLGNR'],
+                                                    condition="LFLGNR<>0 AND LFSTAT<>'X'")]
+    elif not isinstance(lager, (list, tuple)):
+        lager = [lager]
+
+    eintraege = []
+    for lgnr in lager:
+        bestaende = {}
+        for artnr, kurve in _bestandskurven(None, 'day', lgnr, bestaende).items():
+            eintraege.append((artnr, lgnr) + _snapshot_eintrag(bestaende.get(artnr, 0), kurve))
+    husoftm2.bestandssnapshot.schreibe_snapshot(dateiname, eintraege)
+    return len(eintraege)
+
+
+def lade_snapshot(dateiname):
+    """Öffnet einen mit erzeuge_snapshot() geschriebenen Snapshot für die snapshot_*() Funktionen."""
+    global _snapshot
+    if _snapshot:
+        _snapshot.close()
+    _snapshot = husoftm2.bestandssnapshot.Bestandssnapshot(dateiname)
+    _snapshot_delta.clear()
+    return _snapshot.anzahl
+
+
+def _snapshot_key(artnr, lager):
+    """Schlüssel für _snapshot_delta. Byte-Strings sind wie in der Snapshot-Datei latin-1 kodiert."""
+    if not isinstance(artnr, unicode):
+        artnr = str(artnr).decode('latin-1')
+    return artnr, int(lager)
+
+
+def _snapshot_lookup(artnr, lager):
+    """Liefert (buchbestand, freie_menge, frei_ab_kurve) aus dem Snapshot oder None."""
+    if not _snapshot:
+        raise RuntimeError("Kein Bestandssnapshot geladen, siehe lade_snapshot()")
+    key = _snapshot_key(artnr, lager)
+    if key in _snapshot_delta:
+        return _snapshot_delta[key]
+    return _snapshot.eintrag(artnr, lager)
+
+
+def snapshot_buchbestand(artnr, lager=0):
+    """Wie buchbestand(), aber aus dem Snapshot."""
+    eintrag = _snapshot_lookup(artnr, lager)
+    if eintrag:
+        return eintrag[0]
+    return 0
+
+
+def snapshot_freie_menge(artnr, lager=0):
+    """Wie freie_menge(), aber aus dem Snapshot."""
+    eintrag = _snapshot_lookup(artnr, lager)
+    if eintrag:
+        return eintrag[1]
+    return 0
+
+
+def snapshot_frei_ab(menge, artnr, lager=0):
+    """Wie frei_ab() mit tageweiser Auflösung, aber aus dem Snapshot."""
+    eintrag = _snapshot_lookup(artnr, lager)
+    if not eintrag or not eintrag[2]:
+        return None
+    kurve = eintrag[2]
+    if kurve[0][1] >= int(menge):
         return datetime.date.today()
+    # Die Kurve ist in beiden Werten aufsteigend sortiert
+    idx = bisect.bisect_left([frei for _ordinal, frei in kurve], int(menge))
+    if idx == len(kurve):
+        return False
+    return datetime.date.fromordinal(kurve[idx][0])
 
-    bentwicklung = bentwicklung.items()
-    bentwicklung.sort(reverse=True)
-    previous_date = None
-    for datum, menge_frei in bentwicklung:
-        if menge_frei < int(menge):
-            if previous_date:
-                return datetime.date.fromtimestamp(time.mktime(time.strptime(previous_date, dateformat)))
-            else:
-                return False
-        previous_date = datum
-    return None
+
+def aktualisiere_snapshot():
+    """Berechnet alle Artikel neu, die seit Erstellung des Snapshots Bewegungen hatten.
+
+    Gesucht wird nach Änderungen in Lagerbeständen (XLF00), Auftragspositionen (AAP00) und
+    Bestellpositionen (EBP00). Setartikel, deren Komponenten betroffen sind, werden mit berechnet.
+    Die Ergebnisse überlagern den Snapshot, bis der nächste Snapshot geladen wird.
+    Gibt die Anzahl der neu berechneten Einträge zurück.
+    """
+    if not _snapshot:
+        raise RuntimeError("Kein Bestandssnapshot geladen, siehe lade_snapshot()")
+    seit = date2softm(datetime.date.fromtimestamp(_snapshot.erstellt))
+
+    aenderungen = [('XLF00', 'LFARTN', 'LFLGNR', "LFDTAE>=%s" % seit),
+                   ('AAP00', 'APARTN', 'APLGNR', "(APDTAE>=%s OR APDTER>=%s)" % (seit, seit)),
+                   ('EBP00', 'BPARTN', 'BPLGNR', "(BPDTAE>=%s OR BPDTER>=%s)" % (seit, seit))]
+    geaendert = {}
+    for table, artnrfeld, lagerfeld, condition in aenderungen:
+        for artnr, lgnr in query([table], fields=[artnrfeld, lagerfeld], condition=condition,
+                                 grouping=[artnrfeld, lagerfeld], querymappings={}, cachingtime=0):
+            # Lager 0 steht für die Summe aller Läger und ist immer mit betroffen
+            for betroffen in set([0, int(lgnr)]):
+                geaendert.setdefault(betroffen, set()).add(artnr)
+
+    husoftm2.artikel.lade_setartikel()
+    for setartnr, komponenten in husoftm2.artikel.setartikel().items():
+        for artnrs in geaendert.values():
+            if artnrs.intersection(komponenten_artnr for _menge, komponenten_artnr in komponenten):
+                artnrs.add(setartnr)
+
+    anzahl = 0
+    for lgnr, artnrs in geaendert.items():
+        artnrs = sorted(artnrs)
+        while artnrs:
+            batch = artnrs[:50]
+            artnrs = artnrs[50:]
+            bestaende = {}
+            for artnr, kurve in _bestandskurven(batch, 'day', lgnr, bestaende).items():
+                eintrag = _snapshot_eintrag(bestaende.get(artnr, 0), kurve)
+                _snapshot_delta[_snapshot_key(artnr, lgnr)] = eintrag
+                anzahl += 1
+    return anzahl
 
 
 def _test():
@@ -408,6 +1157,246 @@ def _test():
     return frei_ab(1000, '14600/03')
 
 
+class BestandskurvenTests(unittest.TestCase):
+    """Tests der internen Kurvendarstellung ohne Zugriff auf SoftM."""
+
+    def test_wochen(self):
+        montag = datetime.date(2010, 12, 13).toordinal()
+        for tag in range(7):
+            self.assertEqual(_bucket(montag + tag, 'week'), montag)
+        self.assertEqual(_bucket(montag + 7, 'week'), montag + 7)
+        self.assertEqual(_ordinal2str(montag, '%Y-w%W'), '2010-w50')
+        self.assertEqual(_str2ordinal('2010-w50', '%Y-w%W'), montag)
+        self.assertEqual(_str2ordinal('2010-12-15', '%Y-%m-%d'), montag + 2)
+        self.assertEqual(_bucket(montag + 2, 'month'), datetime.date(2010, 12, 1).toordinal())
+
+    def test_wochen_abfrage(self):
+        global query
+        abfragen = []
+        unbestimmt = datetime.date(9999, 12, 31)
+        dienstag, freitag, sonntag = [datetime.date(2010, 12, tag) for tag in (14, 17, 19)]
+        antworten = {'EBP00': [dict(artnr=u'a', liefer_date=dienstag, menge_offen=u'5.000'),
+                               dict(artnr=u'a', liefer_date=freitag, menge_offen=u'7.000'),
+                               dict(artnr=u'a', liefer_date=unbestimmt, menge_offen=u'1.000')],
+                     'AAP00': [dict(artnr=u'a', liefer_date=dienstag, menge_offen=u'2.000', orderlines=1),
+                               dict(artnr=u'a', liefer_date=sonntag, menge_offen=u'3.000', orderlines=2),
+                               dict(artnr=u'a', liefer_date=None, menge_offen=u'4.000', orderlines=1)]}
+
+        def query_aufzeichnen(tables, **kwargs):
+            if not isinstance(tables, list):
+                tables = [tables]
+            abfragen.append(kwargs['fields'])
+            return antworten[tables[0]]
+        original = query
+        query = query_aufzeichnen
+        try:
+            montag = datetime.date(2010, 12, 13)
+            self.assertEqual(bestellmengen_alle_artikel(['a'], granularity='week'),
+                             {u'a': {montag: 12, unbestimmt: 1}})
+            self.assertEqual(bestellmengen('a', granularity='week'), {montag: 12, unbestimmt: 1})
+            self.assertEqual(auftragsmengen_alle_artikel(['a'], granularity='week'),
+                             {'a': {montag: (5, 3), None: (4, 1)}})
+            self.assertEqual(auftragsmengen('a', granularity='week'), {montag: 5, None: 4})
+        finally:
+            query = original
+        # Wochen werden in Python gebildet, die AS/400 gruppiert nur nach dem rohen Datumsfeld
+        for fields in abfragen:
+            self.assertTrue('BPDTLT' in fields or 'APDTLT' in fields)
+
+    def test_bewegungen(self):
+        heute = datetime.date(2010, 12, 15)
+        bewegungen = _ordinal_bewegungen(100, {datetime.date(2010, 12, 20): 50},
+                                         {datetime.date(2010, 12, 14): 30, datetime.date(2010, 12, 17): 80},
+                                         'day', heute.toordinal())
+        self.assertEqual(_kurve(bewegungen), [(heute.toordinal() - 1, -30), (heute.toordinal(), 70),
+                                              (heute.toordinal() + 2, -10), (heute.toordinal() + 5, 40)])
+        bewegungen = _ordinal_bewegungen(100, {datetime.date(2010, 12, 20): 50},
+                                         {datetime.date(2010, 12, 14): 30, datetime.date(2010, 12, 17): 80},
+                                         'week', heute.toordinal())
+        montag = datetime.date(2010, 12, 13).toordinal()
+        self.assertEqual(_kurve(bewegungen), [(montag, -10), (montag + 7, 40)])
+
+    def test_setkurve(self):
+        bewegungen = {'set': [(10, 5), (20, -2)],
+                      'a': [(10, 10), (14, -4)],
+                      'b': [(12, 30), (16, 12)]}
+        kurve = _setkurve('set', [(1, 'a'), (3, 'b')], bewegungen.get)
+        # Komponenten: a = [(10, 10), (14, 6)], b/3 = [(12, 10), (16, 14)]
+        # Minimum = [(10, 10), (12, 10), (14, 6), (16, 6)] plus eigene Bewegungen des Sets
+        self.assertEqual(kurve, [(10, 15), (12, 15), (14, 11), (16, 11), (20, 9)])
+        self.assertEqual(_setkurve('a', [(1, 'a')], bewegungen.get), [(10, 10), (14, 6)])
+
+    def test_verfuegbarkeit(self):
+        kurve = [(1, 10), (3, 4), (5, 8)]
+        self.assertEqual(_verfuegbar_am(kurve, 0), 4)
+        self.assertEqual(_verfuegbar_am(kurve, 9), 8)
+        self.assertEqual(_frei_ab(kurve, 4), 1)
+        self.assertEqual(_frei_ab(kurve, 8), 5)
+        self.assertEqual(_frei_ab(kurve, 10), False)
+        self.assertEqual(_frei_ab([], 10), None)
+        self.assertEqual(_zukunft(kurve, 'day', 3), [(3, 4), (5, 8)])
+
+    def test_pruefe_auftrag_verfuegbarkeit(self):
+        global _bestandskurven
+        heute = datetime.date.today().toordinal()
+        kurven = {'a': [(heute, 30), (heute + 10, 10), (heute + 20, 50)],
+                  'b': [(heute, 5)]}
+
+        def bestandskurven(artnrs, granularity, lager):
+            return kurven
+        original = _bestandskurven
+        _bestandskurven = bestandskurven
+        try:
+            ret = pruefe_auftrag_verfuegbarkeit([(10, 'a'), (5, 'b'), (20, 'a'), (1, 'c')],
+                                                datetime.date.fromordinal(heute + 15))
+        finally:
+            _bestandskurven = original
+        self.assertEqual([(p['verfuegbar'], p['frei_ab']) for p in ret['positionen']],
+                         [(True, datetime.date.today()),
+                          (True, datetime.date.today()),
+                          (False, datetime.date.fromordinal(heute + 20)),
+                          (False, None)])
+        self.assertEqual(ret['verfuegbar'], False)
+        self.assertEqual(ret['komplett_ab'], None)
+
+    def test_bestandskurven_batches(self):
+        global query
+        abfragen = []
+
+        def query_aufzeichnen(tables, **kwargs):
+            abfragen.append((tables, kwargs.get('condition')))
+            return []
+        original = query
+        query = query_aufzeichnen
+        husoftm2.artikel.query = query_aufzeichnen
+        try:
+            self.assertEqual(pruefe_auftrag_verfuegbarkeit([], datetime.date.today()),
+                             dict(positionen=[], verfuegbar=True, komplett_ab=None))
+            self.assertEqual(_bestandskurven([]), {})
+            self.assertEqual(abfragen, [])
+            kurven = _bestandskurven(['%05d' % i for i in range(120)])
+        finally:
+            query = husoftm2.artikel.query = original
+        self.assertEqual(len(kurven), 120)
+        # ASK00 sowie XLF00, EBP00 und AAP00/AAK00 in je drei Batches
+        self.assertEqual(len(abfragen), 12)
+        for _tables, condition in abfragen:
+            self.assertTrue(' IN (' in condition)
+            self.assertTrue(condition.count(',') < 50)
+
+    def test_bestandsmatrix(self):
+        global query
+        antworten = {'XLF00': [(0, u'a', u'30.000'), (100, u'a', u'20.000'), (100, u'b', u'5.000')],
+                     'AAP00': [(34, u'b', u'7.000')]}
+
+        def antwort(tables, **kwargs):
+            return antworten[tables[0]]
+        original = query
+        query = antwort
+        try:
+            ret = bestandsmatrix()
+        finally:
+            query = original
+        self.assertEqual(ret['artnrs'], [u'a', u'b'])
+        self.assertEqual(ret['laeger'], [0, 34, 100])
+        self.assertEqual(ret['buchbestand'], [[30, 0, 20], [0, 0, 5]])
+        self.assertEqual(ret['umlagermenge'], [[0, 0, 0], [0, 7, 0]])
+        self.assertEqual(ret['bestand'], [[30, 0, 20], [0, 7, 5]])
+
+    def test_auftragsbuch(self):
+        global query, _auftragsbuch_geladen, _auftragsbuch_stand
+
+        def zeile(auftragsnr, position, artnr, liefer_date, menge, status=' '):
+            return dict(auftragsnr=auftragsnr, position=position, artnr=artnr, lager=100,
+                        liefer_date=liefer_date, menge_offen=menge, art='', position_status=status,
+                        position_voll_ausgeliefert=0, status=' ', voll_ausgeliefert=0)
+
+        montag = datetime.date(2010, 12, 13)
+        mittwoch = datetime.date(2010, 12, 15)
+        antworten = [[zeile(1, 1, u'a', montag, 10), zeile(1, 2, u'a', mittwoch, 5),
+                      zeile(2, 1, u'a', mittwoch, 7), zeile(2, 2, u'b', mittwoch, 3)],
+                     [zeile(1, 2, u'a', mittwoch, 5, 'X'), zeile(2, 2, u'b', montag, 4)]]
+
+        def antwort(tables, **kwargs):
+            return antworten.pop(0)
+        original = query
+        query = antwort
+        try:
+            self.assertEqual(lade_auftragsbuch(), 4)
+            self.assertEqual(auftragsmengen('a', 100), {montag: 10, mittwoch: 12})
+            self.assertEqual(auftragsmengen('a', 34), {})
+            self.assertEqual(auftragsmengen_alle_artikel(granularity='week'),
+                             {'a': {montag: (22, 3)}, 'b': {montag: (3, 1)}})
+            self.assertEqual(aktualisiere_auftragsbuch(), 2)
+            self.assertEqual(auftragsmengen_alle_artikel(),
+                             {'a': {montag: (10, 1), mittwoch: (7, 1)}, 'b': {montag: (4, 1)}})
+        finally:
+            query = original
+            _auftragsbuch.clear()
+            _auftragsbuch_index.clear()
+            _auftragsbuch_geladen = _auftragsbuch_stand = 0
+
+    def test_snapshot(self):
+        global _snapshot
+        heute = datetime.date.today().toordinal()
+        kurve = [(heute - 3, -20), (heute, 30), (heute + 10, 10), (heute + 20, 50)]
+        self.assertEqual(_snapshot_eintrag(30, kurve)[2], [(heute, 10), (heute + 20, 50)])
+        handle, dateiname = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            husoftm2.bestandssnapshot.schreibe_snapshot(dateiname, [('a', 0) + _snapshot_eintrag(30, kurve)])
+            lade_snapshot(dateiname)
+            self.assertEqual(snapshot_buchbestand('a'), 30)
+            self.assertEqual(snapshot_freie_menge('b'), 0)
+            self.assertEqual(snapshot_frei_ab(10, 'a'), datetime.date.today())
+            self.assertEqual(snapshot_frei_ab(40, 'a'), datetime.date.fromordinal(heute + 20))
+            self.assertEqual(snapshot_frei_ab(60, 'a'), False)
+            self.assertEqual(snapshot_frei_ab(1, 'a', 100), None)
+            _snapshot_delta[(u'a', 0)] = (0, 0, [])
+            self.assertEqual(snapshot_frei_ab(10, 'a'), None)
+        finally:
+            _snapshot.close()
+            _snapshot = None
+            _snapshot_delta.clear()
+            os.unlink(dateiname)
+
+    def test_snapshot_abfragen(self):
+        global query, _snapshot
+        abfragen = []
+
+        def query_aufzeichnen(tables, **kwargs):
+            if not isinstance(tables, list):
+                tables = [tables]
+            abfragen.append(tables[0])
+            if kwargs.get('fields') == ['LFARTN', 'LFMGLP']:
+                return [(u'a', 30), ('\xc4b', 5)]
+            if kwargs.get('fields') == ['LFARTN', 'LFLGNR']:
+                return [('\xc4b', 100)]
+            return []
+        original = query
+        query = husoftm2.artikel.query = query_aufzeichnen
+        handle, dateiname = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            self.assertEqual(erzeuge_snapshot(dateiname, 100), 2)
+            # Buchbestände werden pro Lager nur einmal gelesen
+            self.assertEqual(abfragen.count('XLF00'), 1)
+            lade_snapshot(dateiname)
+            del abfragen[:]
+            # Lager 100 und Lager 0 (Summe aller Läger)
+            self.assertEqual(aktualisiere_snapshot(), 2)
+            # Änderungsabfrage plus ein Mal Buchbestände pro Lager
+            self.assertEqual(abfragen.count('XLF00'), 3)
+            self.assertEqual(snapshot_buchbestand('\xc4b', 100), 5)
+            self.assertEqual(snapshot_buchbestand(u'\xc4b', 100), 5)
+        finally:
+            query = husoftm2.artikel.query = original
+            _snapshot.close()
+            _snapshot = None
+            _snapshot_delta.clear()
+            os.unlink(dateiname)
+
+
 if __name__ == '__main__':
     _test()
     unittest.main()
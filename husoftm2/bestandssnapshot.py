@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bestandssnapshot.py - kompaktes Dateiformat für Verfügbarkeits-Snapshots. Teil von huSoftM.
+
+Ein Snapshot enthält für jede Kombination aus Artikel und Lager den Buchbestand, die freie Menge und die
+"frei ab"-Kurve. Die Datei wird per mmap gelesen, gesucht wird binär in einem nach (artnr, lager)
+sortierten Index. Damit kosten Abfragen weder SoftM-Zugriffe noch das Einlesen der ganzen Datei.
+
+Erzeugt und gelesen werden Snapshots normalerweise über husoftm2.bestaende (erzeuge_snapshot(),
+lade_snapshot() und die snapshot_*() Funktionen). Dieses Modul kümmert sich nur um das Dateiformat:
+
+    Kopf      MAGIC, Anzahl Einträge, Erstellungszeitpunkt (Unix-Zeit)
+    Index     pro Eintrag: artnr (20 Byte, latin-1), lager, buchbestand, freie_menge,
+              Position und Länge der Kurve
+    Kurven    (ordinal, menge) Paare. menge ist die Menge, die ab ordinal dauerhaft frei ist,
+              die Kurve ist also monoton steigend.
+
+Alle Zahlen sind vorzeichenbehaftete 32 Bit Integer in little endian.
+
+Created by agent on 2026-10-19.
+Copyright (c) 2026 HUDORA. All rights reserved.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+
+MAGIC = 'HUSMBS01'
+KOPF = struct.Struct('<8sii')
+INDEX = struct.Struct('<20siiiii')
+PUNKT = struct.Struct('<ii')
+
+
+def _artnr2key(artnr):
+    """Artikelnummer für den Index kodieren."""
+    if isinstance(artnr, unicode):
+        artnr = artnr.encode('latin-1')
+    artnr = str(artnr)
+    if len(artnr) > 20:
+        raise ValueError("Artikelnummer zu lang: %r" % artnr)
+    return artnr.ljust(20, '\0')
+
+
+def schreibe_snapshot(dateiname, eintraege, erstellt=None):
+    """Schreibt einen Snapshot.
+
+    `eintraege` ist eine Liste von (artnr, lager, buchbestand, freie_menge, kurve) Tupeln, wobei kurve
+    eine Liste von (ordinal, menge_frei_ab) Paaren ist. Die Datei wird erst unter einem temporären Namen
+    geschrieben und dann umbenannt, so dass Leser nie eine halbfertige Datei sehen.
+    """
+    if erstellt is None:
+        erstellt = time.time()
+    eintraege = sorted((_artnr2key(artnr), int(lager), int(buchbestand), int(freie_menge), kurve)
+                       for (artnr, lager, buchbestand, freie_menge, kurve) in eintraege)
+    position = 0
+    index = []
+    kurven = []
+    for key, lager, buchbestand, freie_menge, kurve in eintraege:
+        index.append(INDEX.pack(key, lager, buchbestand, freie_menge, position, len(kurve)))
+        kurven.extend(PUNKT.pack(int(ordinal), int(menge)) for (ordinal, menge) in kurve)
+        position += len(kurve)
+
+    verzeichnis = os.path.dirname(os.path.abspath(dateiname))
+    handle, tmpname = tempfile.mkstemp(dir=verzeichnis, prefix='.bestandssnapshot')
+    try:
+        datei = os.fdopen(handle, 'wb')
+        datei.write(KOPF.pack(MAGIC, len(index), int(erstellt)))
+        datei.write(''.join(index))
+        datei.write(''.join(kurven))
+        datei.close()
+        os.rename(tmpname, dateiname)
+    except:
+        os.unlink(tmpname)
+        raise
+
+
+class Bestandssnapshot(object):
+    """Lesezugriff auf einen mit schreibe_snapshot() erzeugten Snapshot."""
+
+    def __init__(self, dateiname):
+        datei = open(dateiname, 'rb')
+        try:
+            self._daten = mmap.mmap(datei.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            datei.close()
+        magic, self.anzahl, self.erstellt = KOPF.unpack_from(self._daten, 0)
+        if magic != MAGIC:
+            raise ValueError("%s ist kein Bestandssnapshot" % dateiname)
+        self._kurvenstart = KOPF.size + self.anzahl * INDEX.size
+
+    def close(self):
+        """Gibt das mmap frei."""
+        self._daten.close()
+
+    def _index(self, i):
+        """Liest den i-ten Indexeintrag."""
+        return INDEX.unpack_from(self._daten, KOPF.size + i * INDEX.size)
+
+    def eintrag(self, artnr, lager=0):
+        """Liefert (buchbestand, freie_menge, kurve) für einen Artikel oder None."""
+        gesucht = (_artnr2key(artnr), int(lager))
+        unten, oben = 0, self.anzahl
+        while unten < oben:
+            mitte = (unten + oben) // 2
+            if self._index(mitte)[:2] < gesucht:
+                unten = mitte + 1
+            else:
+                oben = mitte
+        if unten == self.anzahl:
+            return None
+        key, lagernr, buchbestand, freie_menge, position, laenge = self._index(unten)
+        if (key, lagernr) != gesucht:
+            return None
+        start = self._kurvenstart + position * PUNKT.size
+        kurve = [PUNKT.unpack_from(self._daten, start + i * PUNKT.size) for i in range(laenge)]
+        return buchbestand, freie_menge, kurve
+
+    def __iter__(self):
+        """Liefert alle Einträge als (artnr, lager, buchbestand, freie_menge, kurve) Tupel."""
+        for i in range(self.anzahl):
+            key, lager, buchbestand, freie_menge, position, laenge = self._index(i)
+            start = self._kurvenstart + position * PUNKT.size
+            kurve = [PUNKT.unpack_from(self._daten, start + j * PUNKT.size) for j in range(laenge)]
+            yield key.rstrip('\0').decode('latin-1'), lager, buchbestand, freie_menge, kurve
+
+
+class BestandssnapshotTests(unittest.TestCase):
+    """Schreiben und Lesen eines Snapshots."""
+
+    def test_roundtrip(self):
+        handle, dateiname = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            schreibe_snapshot(dateiname, [(u'14600', 100, 30, 20, [(734000, 20), (734010, 50)]),
+                                          ('14600', 0, 40, 25, [(734000, 25)]),
+                                          (u'76095', 0, 0, 0, [])], erstellt=1295000000)
+            snapshot = Bestandssnapshot(dateiname)
+            self.assertEqual(snapshot.anzahl, 3)
+            self.assertEqual(snapshot.erstellt, 1295000000)
+            self.assertEqual(snapshot.eintrag('14600', 100), (30, 20, [(734000, 20), (734010, 50)]))
+            self.assertEqual(snapshot.eintrag(u'14600'), (40, 25, [(734000, 25)]))
+            self.assertEqual(snapshot.eintrag('76095'), (0, 0, []))
+            self.assertEqual(snapshot.eintrag('14600', 34), None)
+            self.assertEqual(snapshot.eintrag('99999'), None)
+            self.assertEqual([x[:2] for x in snapshot], [(u'14600', 0), (u'14600', 100), (u'76095', 0)])
+            snapshot.close()
+        finally:
+            os.unlink(dateiname)
+
+
+if __name__ == '__main__':
+    unittest.main()
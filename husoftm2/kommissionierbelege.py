@@ -9,16 +9,21 @@ Copyright (c) 2011 HUDORA. All rights reserved.
 
 from husoftm2.lieferscheine import get_ls_kb_data
 from husoftm2.tools import remove_prefix, sql_quote
-from husoftm2.backend import query
+from husoftm2.backend import query, _get_tablename
+
+
+def _komminr(komminr):
+    """Entfernt das Präfix 'KA' oder 'KB' von einer Kommissionierbelegnummer."""
+    prefix = 'KA'
+    if str(komminr).startswith('KB'):
+        prefix = 'KB'
+    return remove_prefix(komminr, prefix)
 
 
 def get_kommibeleg(komminr, header_only=False):
     """Gibt einen Kommissionierbeleg zurück"""
 
-    prefix = 'KA'
-    if komminr.startswith('KB'):
-        prefix = 'KB'
-    komminr = remove_prefix(komminr, prefix)
+    komminr = _komminr(komminr)
 
     # In der Tabelle ALK00 stehen Kommissionierbelege und Lieferscheine.
     # Die Kommissionierbelege haben '0' als Lieferscheinnr.
@@ -32,12 +37,62 @@ def get_kommibeleg(komminr, header_only=False):
 
     if belege:
         beleg = belege[0]
-        # Falls es bereits einen Lieferschein gibt, die Lieferscheinnr in das dict schreiben.
-        # Ansonsten die Eintrag 'lieferscheinnr' entfernen (wäre sonst SL0)
-        rows = query(['ALK00'], condition="LKLFSN <> 0 AND LKKBNR = %s" % sql_quote(komminr))
-        if rows:
-            beleg['lieferscheinnr'] = rows[0]['lieferscheinnr']
-        else:
-            beleg.pop('lieferscheinnr', None)
+        _lieferscheinnrs_zuordnen([beleg])
         return beleg
     return {}
+
+
+def _lieferscheinnrs_zuordnen(belege):
+    """Schreibt die Lieferscheinnummern zu den Kommissionierbelegen in deren dicts.
+
+    Falls es bereits einen Lieferschein gibt, wird die Lieferscheinnr in das dict geschrieben.
+    Ansonsten wird der Eintrag 'lieferscheinnr' entfernt (wäre sonst SL0).
+    Alle Belege werden mit einer gruppierten Abfrage pro 200 Belege aufgelöst.
+    """
+    komminrs = [remove_prefix(beleg['kommiauftragnr'], 'KA') for beleg in belege]
+    lieferscheinnrs = {}
+    while komminrs:
+        batch = komminrs[:200]
+        komminrs = komminrs[200:]
+        condition = "LKLFSN <> 0 AND LKKBNR IN (%s)" % ','.join([sql_quote(x) for x in batch])
+        for komminr, lieferscheinnr in query(['ALK00'], fields=['LKKBNR', 'MAX(LKLFSN)'], grouping=['LKKBNR'],
+                                             condition=condition, querymappings={},
+                                             ua='husoftm2.kommissionierbelege'):
+            lieferscheinnrs[int(komminr)] = int(lieferscheinnr)
+    for beleg in belege:
+        komminr = remove_prefix(beleg['kommiauftragnr'], 'KA')
+        if komminr in lieferscheinnrs:
+            beleg['lieferscheinnr'] = lieferscheinnrs[komminr]
+        else:
+            beleg.pop('lieferscheinnr', None)
+
+
+def get_kommibelege(lager=None, komminrs=None, header_only=False):
+    """Gibt mehrere Kommissionierbelege zurück.
+
+    Mit `komminrs` werden genau diese Belege geliefert. Mit `lager` (z.B. 100 oder 'LG100') alle
+    offenen Belege dieses Lagers, also die, zu denen es noch keinen Lieferschein gibt. Beides lässt
+    sich kombinieren. Die Belege werden gemeinsam über get_ls_kb_data() gelesen und ohne Cache,
+    damit auch gerade erst erzeugte Belege dabei sind. Belege mit Lieferschein schließt bei `lager`
+    bereits die Abfrage aus, es wird also nicht die ganze Historie des Lagers gelesen.
+    """
+    if lager is None and komminrs is None:
+        raise ValueError("get_kommibelege() braucht lager oder komminrs")
+
+    conditions = ["LKLFSN = 0", "LKSTAT<>'X'"]
+    if lager is not None:
+        conditions.append("LKLGNR = %d" % remove_prefix(lager, 'LG'))
+    if komminrs is None:
+        conditions.append("LKKBNR NOT IN (SELECT LKKBNR FROM %s WHERE LKLFSN <> 0)" % _get_tablename('ALK00'))
+    else:
+        komminrs = [_komminr(komminr) for komminr in komminrs]
+        if not komminrs:
+            return []
+        conditions.append("LKKBNR IN (%s)" % ','.join([sql_quote(komminr) for komminr in komminrs]))
+    belege = get_ls_kb_data(conditions, header_only=header_only, is_lieferschein=False, cachingtime=0)
+    if komminrs is None:
+        for beleg in belege:
+            beleg.pop('lieferscheinnr', None)
+    else:
+        _lieferscheinnrs_zuordnen(belege)
+    return belege
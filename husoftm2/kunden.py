@@ -8,9 +8,16 @@ Copyright (c) 2007, 2010 HUDORA GmbH. All rights reserved.
 """
 
 from husoftm2.backend import query
+from husoftm2.fields import MAPPINGDIR
 import datetime
+import hashlib
+import husoftm2.aenderungen
 import husoftm2.tools
 import logging
+import shutil
+import tempfile
+import time
+import unittest
 
 
 betreuerdict = {
@@ -46,6 +53,36 @@ def get_changed_after(date):
     return list(set(["SC%s" % int(x[0]) for x in rows1]) | set(["SC%s" % int(x[0]) for x in rows2]))
 
 
+def aenderungen(konsument, seit=None):
+    """Liefert die Kundennummern, die seit der letzten bestätigten Position von `konsument` geändert
+    wurden, und die neue Position. Siehe husoftm2.aenderungen.
+
+    SoftM führt für Kunden nur ein Änderungsdatum (KDDTER, KDDTAE, KZDTAE). Welche Kunden des laufenden
+    Tages schon geliefert wurden, erkennen wir deshalb an einer Prüfsumme über die Kundendaten.
+    Gibt es noch keine Position, wird ab `seit` (ein datetime.date, default heute) geliefert.
+    """
+    position = husoftm2.aenderungen.lade_position('kunden', konsument)
+    if position is None:
+        seit = seit or datetime.date.today()
+        position = dict(feed='kunden', stempel=[int(husoftm2.tools.date2softm(seit))], pruefsummen={})
+    datum = position['stempel'][0]
+
+    stempel = {}
+    daten = {}
+    for row in query('XKD00', condition="KDDTER>=%d OR KDDTAE>=%d" % (datum, datum), cachingtime=0):
+        kundennr = "SC%s" % int(row['kundennr'])
+        stempel[kundennr] = max([int(husoftm2.tools.date2softm(row[feld]))
+                                 for feld in ['erfassung_date', 'aenderung_date'] if row[feld]])
+        daten.setdefault(kundennr, []).append(sorted(row.items()))
+    for row in query('AKZ00', condition="KZDTAE>=%d" % datum, cachingtime=0):
+        kundennr = "SC%s" % int(row['Kunden-nr'])
+        stempel[kundennr] = max([stempel.get(kundennr, 0), int(row['updated_at'])])
+        daten.setdefault(kundennr, []).append(sorted(row.items()))
+
+    zeilen = [(nr, [stempel[nr]], hashlib.md5(repr(daten[nr])).hexdigest()) for nr in stempel]
+    return husoftm2.aenderungen.neue_aenderungen(position, zeilen)
+
+
 def get_kunde(kundennr):
     """Get the Kunde object representing Kundennummer <kundennr>.
 
@@ -67,27 +104,194 @@ def get_kunde(kundennr):
     return _softm_to_dict(rows[0])
 
 
+def get_kunden(kundennrs):
+    """Wie get_kunde(), aber für viele Kunden auf einmal.
+
+    Gibt ein Tupel (kunden, fehlend) zurück. kunden ist ein dict von 'SC...' auf Kunden-dicts,
+    fehlend die Liste der Kundennummern, zu denen keine Daten gefunden wurden.
+    Es wird eine Abfrage pro 100 Kundennummern gestellt.
+    """
+    kundennrs = sorted(set([int(husoftm2.tools.remove_prefix(kundennr, 'SC')) for kundennr in kundennrs]))
+    kunden = {}
+    rest = kundennrs
+    while rest:
+        batch = rest[:100]
+        rest = rest[100:]
+        rows = query(['XKD00'],
+                     condition="KDKDNR IN (%s) AND KDSTAT<>'X'" % ','.join(["'%8d'" % x for x in batch]),
+                     joins=[('XKS00', 'KDKDNR', 'KSKDNR'),
+                            ('AKZ00', 'KDKDNR', 'KZKDNR')])
+        for row in rows:
+            kunde = _softm_to_dict(row)
+            if kunde['kundennr'] in kunden:
+                raise RuntimeError("Mehr als einen Kunden gefunden: %r" % kunde['kundennr'])
+            kunden[kunde['kundennr']] = kunde
+    fehlend = ["SC%s" % kundennr for kundennr in kundennrs if "SC%s" % kundennr not in kunden]
+    return kunden, fehlend
+
+
+# GLN/ILN Index: ILN -> ('kunde', kundennr) für Stammadressen (XKS00.KCE2IL) oder
+# ('lieferadresse', kundennr, versandadressnr, satznr) für abweichende Lieferadressen (AVA00.VAILN).
+# Nach ILNINDEX_INTERVALL Sekunden werden Stamm- und Lieferadressen der über get_changed_after()
+# gemeldeten Kunden neu eingelesen, nach ILNINDEX_MAXALTER Sekunden der ganze Index. Die AVA00 führt kein
+# Änderungsdatum, sonstige Änderungen an Lieferadressen kommen deshalb erst mit dem kompletten Neuaufbau
+# an - neue ILNs findet get_kunde_by_iln() vorher schon über die direkte Suche in SoftM.
+# Aufgelöste Kunden-dicts halten wir in _ilnkunden vor.
+ILNINDEX_INTERVALL = 60 * 5
+ILNINDEX_MAXALTER = 60 * 60 * 12
+_ilnindex = {}
+_ilnkunden = {}
+_ilnindex_geladen = 0
+_ilnindex_stand = 0
+
+
+def _iln(wert):
+    """ILN aus SoftM als int, leere und ungültige Werte werden zu None."""
+    try:
+        return int(str(wert).strip()) or None
+    except ValueError:
+        return None
+
+
+def _ilnindex_lieferadressen(condition=None):
+    """Liest ILNs von Lieferadressen (AVA00) in den Index ein, sofern keine Stammadresse die ILN hat."""
+    rows = query('AVA00', fields=['VAKDNR', 'VAVANR', 'VASANR', 'VAILN'], condition=condition,
+                 querymappings={}, cachingtime=0)
+    for kundennr, vanr, sanr, iln in rows:
+        iln = _iln(iln)
+        if iln:
+            _ilnindex.setdefault(iln, ('lieferadresse', int(kundennr), int(vanr), int(sanr)))
+
+
+def _ilnindex_stammadressen(condition=None):
+    """Liest ILNs von Stammadressen (XKS00) in den Index ein. Sie haben Vorrang vor Lieferadressen."""
+    for kundennr, iln in query('XKS00', fields=['KSKDNR', 'KCE2IL'], condition=condition,
+                               querymappings={}, cachingtime=0):
+        iln = _iln(iln)
+        if iln and _ilnindex.get(iln) != ('kunde', int(kundennr)):
+            _ilnindex[iln] = ('kunde', int(kundennr))
+            _ilnkunden.pop(iln, None)
+
+
+def lade_ilnindex():
+    """Baut den GLN/ILN Index komplett neu auf."""
+    global _ilnindex_geladen, _ilnindex_stand
+
+    jetzt = time.time()
+    _ilnindex.clear()
+    _ilnkunden.clear()
+    _ilnindex_stammadressen()
+    _ilnindex_lieferadressen()
+    _ilnindex_geladen = _ilnindex_stand = jetzt
+
+
+def aktualisiere_ilnindex():
+    """Liest die ILNs aller Kunden neu ein, die seit dem letzten Stand geändert wurden."""
+    global _ilnindex_stand
+
+    jetzt = time.time()
+    kundennrs = set([husoftm2.tools.remove_prefix(kundennr, 'SC') for kundennr
+                     in get_changed_after(datetime.date.fromtimestamp(_ilnindex_stand))])
+    if kundennrs:
+        for iln, ziel in _ilnindex.items():
+            if ziel[1] in kundennrs:
+                del _ilnindex[iln]
+                _ilnkunden.pop(iln, None)
+        kundennrs = sorted(kundennrs)
+        while kundennrs:
+            batch = ','.join(["'%8s'" % kundennr for kundennr in kundennrs[:100]])
+            kundennrs = kundennrs[100:]
+            _ilnindex_stammadressen("KSKDNR IN (%s)" % batch)
+            _ilnindex_lieferadressen("VAKDNR IN (%s)" % batch)
+    _ilnindex_stand = jetzt
+
+
+def _ilnindex_aktuell():
+    """Lädt den GLN/ILN Index bei Bedarf bzw. hält ihn aktuell."""
+    if time.time() - _ilnindex_geladen > ILNINDEX_MAXALTER:
+        lade_ilnindex()
+    elif time.time() - _ilnindex_stand > ILNINDEX_INTERVALL:
+        aktualisiere_ilnindex()
+
+
+def _ilnziel_live(iln):
+    """Sucht eine ILN ohne Index direkt in XKS00 und AVA00."""
+    rows = query(['XKS00'], condition="KCE2IL='%s'" % (iln, ))
+    if rows:
+        # stammadresse
+        return ('kunde', int(rows[0]['kundennr']))
+    # abweichende Lieferadresse
+    rows = query(['AVA00'], condition="VAILN='%s'" % (iln, ))
+    if rows:
+        return ('lieferadresse', int(rows[0]['kundennr']), int(rows[0]['versandadresssnr']),
+                int(rows[0]['satznr']))
+    return None
+
+
+def _ilnziel_aufloesen(ziel):
+    """Liest den Kunden bzw. die Lieferadresse zu einem Eintrag des ILN Index oder gibt None zurück."""
+    if ziel[0] == 'kunde':
+        try:
+            return get_kunde(ziel[1])
+        except ValueError:
+            return None
+    _art, _kundennr, vanr, sanr = ziel
+    rows2 = query(['XXA00'], condition="XASANR='%s'" % (sanr, ))
+    if rows2:
+        kunde = _softm_to_dict(rows2[0])
+        kunde['kundennr'] = kunde['kundennr'] + ('/%03d' % vanr)
+        return kunde
+    return None
+
+
 def get_kunde_by_iln(iln):
     """Get Kunden Address based on ILN.
 
     See http://cybernetics.hudora.biz/projects/wiki/AddressProtocol for the structure of returned data.
     <iln> must be an valit GLN/ILN encoded as an String.
     If no data exists for that GLN/ILN ValueError is raised.
+
+    ILNs werden über einen lokalen Index aufgelöst, unbekannte ILNs direkt in SoftM gesucht.
     """
-    rows = query(['XKS00'], condition="KCE2IL='%s'" % (int(iln), ))
-    if rows:
-        # stammadresse
-        return get_kunde(rows[0]['kundennr'])
-    else:
-        # abweichende Lieferadresse
-        rows = query(['AVA00'], condition="VAILN='%s'" % (int(iln), ))
-        if rows:
-            rows2 = query(['XXA00'], condition="XASANR='%s'" % (int(rows[0]['satznr']), ))
-            if rows2:
-                kunde = _softm_to_dict(rows2[0])
-                kunde['kundennr'] = kunde['kundennr'] + ('/%03d' % int(rows[0]['versandadresssnr']))
-                return kunde
-    raise ValueError("Keine Daten für GLN/ILN %r gefunden" % iln)
+    iln = int(iln)
+    _ilnindex_aktuell()
+    if iln not in _ilnkunden:
+        ziel = _ilnindex.get(iln)
+        kunde = ziel and _ilnziel_aufloesen(ziel)
+        if not kunde:
+            ziel = _ilnziel_live(iln)
+            kunde = ziel and _ilnziel_aufloesen(ziel)
+            if not kunde:
+                raise ValueError("Keine Daten für GLN/ILN %r gefunden" % iln)
+            _ilnindex[iln] = ziel
+        _ilnkunden[iln] = kunde
+    return dict(_ilnkunden[iln])
+
+
+# Für AVA00 JOIN XXA00 benennen wir die AVA00-Felder um, sonst überschreiben sie sich gegenseitig
+# (kundennr, satznr) mit den Feldern der XXA00.
+_LIEFERADRESSEN_MAPPINGS = dict(MAPPINGDIR['XXA00'], VAKDNR='ava_kundennr', VAVANR='versandadresssnr',
+                                VASANR='ava_satznr')
+
+
+def _lieferadressen(condition):
+    """Liest Lieferadressen mit einer AVA00/XXA00 Abfrage und liefert (kundennr, Kunden-dict) Paare."""
+    rows = query(['AVA00'], joins=[('XXA00', 'VASANR', 'XASANR')], querymappings=_LIEFERADRESSEN_MAPPINGS,
+                 condition="%s AND VASTAT <>'X'" % condition, ordering=['VAKDNR', 'VAVANR'])
+    ret = []
+    gesehen = set()
+    for row in rows:
+        # Lieferadressen ohne Satz in der XXA00 ignorieren wir (LEFT OUTER JOIN)
+        if row.get('satznr') is None:
+            continue
+        kundennr = int(row['ava_kundennr'])
+        if (kundennr, row['ava_satznr']) in gesehen:
+            raise RuntimeError("Kunden-Lieferadresse inkonsistent: %s/%s" % (kundennr, row['ava_satznr']))
+        gesehen.add((kundennr, row['ava_satznr']))
+        kunde = _softm_to_dict(row)
+        kunde['kundennr'] = '%s.%03d' % (kunde['kundennr'], int(row['versandadresssnr']))
+        ret.append((kundennr, kunde))
+    return ret
 
 
 def get_lieferadressen(kundennr):
@@ -97,17 +301,24 @@ def get_lieferadressen(kundennr):
     """
 
     kundennr = husoftm2.tools.remove_prefix(kundennr, 'SC')
-    avrows = query(['AVA00'], condition="VAKDNR='%8s' AND VASTAT <>'X'" % int(kundennr))
-    kunden = []
-    for row in avrows:
-        xarows = query(['XXA00'], condition="XASANR='%s'" % int(row['satznr']))
-        if xarows:
-            if len(xarows) != 1:
-                raise RuntimeError("Kunden-Lieferadresse inkonsistent: %s/%s" % (kundennr, row['satznr']))
-            kunde = _softm_to_dict(xarows[0])
-            kunde['kundennr'] = '%s.%03d' % (kunde['kundennr'], int(row['versandadresssnr']))
-            kunden.append(kunde)
-    return kunden
+    return [kunde for _kundennr, kunde in _lieferadressen("VAKDNR='%8s'" % int(kundennr))]
+
+
+def get_lieferadressen_many(kundennrs):
+    """Wie get_lieferadressen(), aber für viele Kunden auf einmal.
+
+    Gibt ein dict von 'SC...' auf die Liste der Lieferadressen zurück, Kunden ohne zusätzliche
+    Lieferadressen bekommen eine leere Liste. Es wird eine Abfrage pro 100 Kundennummern gestellt.
+    """
+    kundennrs = sorted(set([int(husoftm2.tools.remove_prefix(kundennr, 'SC')) for kundennr in kundennrs]))
+    ret = dict([("SC%s" % kundennr, []) for kundennr in kundennrs])
+    while kundennrs:
+        batch = kundennrs[:100]
+        kundennrs = kundennrs[100:]
+        condition = "VAKDNR IN (%s)" % ','.join(["'%8s'" % kundennr for kundennr in batch])
+        for kundennr, kunde in _lieferadressen(condition):
+            ret["SC%s" % kundennr].append(kunde)
+    return ret
 
 
 def get_lieferadresse(warenempfaenger):
@@ -180,6 +391,228 @@ def _softm_to_dict(row):
 # def kredit_limit(kundennr):
 
 
+class AenderungenTests(unittest.TestCase):
+    """aenderungen() mit synthetischen XKD00/AKZ00 Zeilen - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query
+        self._original = (query, husoftm2.aenderungen.speicher)
+        self._verzeichnis = tempfile.mkdtemp()
+        husoftm2.aenderungen.speicher = husoftm2.aenderungen.DateiSpeicher(self._verzeichnis)
+        self.zeilen = dict(XKD00=[], AKZ00=[])
+
+        def antwort(table, condition=None, **kwargs):
+            return self.zeilen[table]
+
+        query = antwort
+
+    def tearDown(self):
+        global query
+        query, husoftm2.aenderungen.speicher = self._original
+        shutil.rmtree(self._verzeichnis)
+
+    def _kunde(self, kundennr, name, aenderung_date=None):
+        return dict(kundennr=kundennr, name1=name, erfassung_date=datetime.date(2011, 1, 3),
+                    aenderung_date=aenderung_date)
+
+    def test_aenderungen(self):
+        self.zeilen['XKD00'] = [self._kunde(17200, 'Alpha', datetime.date(2011, 1, 26)),
+                                self._kunde(17201, 'Beta', datetime.date(2011, 1, 26))]
+        self.zeilen['AKZ00'] = [{'Kunden-nr': 17202, 'updated_at': 1110126}]
+        kundennrs, position = aenderungen('test', seit=datetime.date(2011, 1, 26))
+        self.assertEqual(sorted(kundennrs), ['SC17200', 'SC17201', 'SC17202'])
+        self.assertEqual(position['stempel'], [1110126])
+        husoftm2.aenderungen.bestaetige('test', position)
+
+        # Am selben Tag erneut geändert wird nur der Kunde, dessen Daten sich unterscheiden
+        self.zeilen['XKD00'][1] = self._kunde(17201, 'Beta GmbH', datetime.date(2011, 1, 26))
+        kundennrs, position = aenderungen('test')
+        self.assertEqual(kundennrs, ['SC17201'])
+        husoftm2.aenderungen.bestaetige('test', position)
+        self.assertEqual(aenderungen('test')[0], [])
+
+
+class KundenTests(unittest.TestCase):
+    """get_kunden() mit synthetischen XKD00 Zeilen - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query
+        self._original = query
+        self.abfragen = []
+        self.doppelt = None
+
+        def antwort(tables, condition=None, **kwargs):
+            self.abfragen.append(condition)
+            kundennrs = [int(nr.strip("' ")) for nr in condition.split('IN (')[1].split(')')[0].split(',')]
+            # Kundennummern, die auf 7 enden, gibt es nicht
+            kundennrs = [kundennr for kundennr in kundennrs if kundennr % 10 != 7]
+            if self.doppelt in kundennrs:
+                kundennrs.append(self.doppelt)
+            return [dict(kundennr=kundennr, name1='Kunde %d' % kundennr, laenderkennzeichen='D',
+                         betreuer='verkauf', erfassung_date=datetime.date(2011, 1, 3))
+                    for kundennr in kundennrs]
+
+        query = antwort
+
+    def tearDown(self):
+        global query
+        query = self._original
+
+    def test_get_kunden(self):
+        kunden, fehlend = get_kunden(['SC%d' % (17000 + i) for i in range(250)] + [17000, 'SC17001'])
+        self.assertEqual(len(self.abfragen), 3)
+        self.assertTrue("KDKDNR IN ('   17000','   17001'," in self.abfragen[0])
+        self.assertEqual(len(kunden), 225)
+        self.assertEqual(kunden['SC17000']['name1'], 'Kunde 17000')
+        self.assertEqual(fehlend, ['SC%d' % (17007 + i) for i in range(0, 250, 10)])
+        self.assertEqual(get_kunden([]), ({}, []))
+        self.assertEqual(len(self.abfragen), 3)
+
+    def test_doppelt(self):
+        self.doppelt = 17001
+        self.assertRaises(RuntimeError, get_kunden, ['SC17000', 'SC17001'])
+
+
+class LieferadressenTests(unittest.TestCase):
+    """get_lieferadressen_many() mit synthetischen AVA00/XXA00 Zeilen - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query
+        self._original = query
+        self.abfragen = []
+        self.adressen = [self._adresse(17000, 1, 501), self._adresse(17000, 2, 502),
+                         self._adresse(17001, 1, 503, xxa00=False), self._adresse(17150, 1, 504)]
+
+        def antwort(tables, joins=None, querymappings=None, condition=None, **kwargs):
+            self.abfragen.append(condition)
+            self.assertEqual((tables, joins), (['AVA00'], [('XXA00', 'VASANR', 'XASANR')]))
+            self.assertEqual(querymappings, _LIEFERADRESSEN_MAPPINGS)
+            kundennrs = [int(nr.strip("' ")) for nr in condition.split('IN (')[1].split(')')[0].split(',')]
+            return [adresse for adresse in self.adressen if adresse['ava_kundennr'] in kundennrs]
+
+        query = antwort
+
+    def tearDown(self):
+        global query
+        query = self._original
+
+    def _adresse(self, kundennr, vanr, satznr, xxa00=True):
+        adresse = dict(ava_kundennr=kundennr, versandadresssnr=vanr, ava_satznr=satznr, satznr=None)
+        if xxa00:
+            adresse.update(satznr=satznr, kundennr=kundennr, name1='Lager %d' % vanr, laenderkennzeichen='D',
+                           betreuer='verkauf', erfassung_date=datetime.date(2011, 1, 3))
+        return adresse
+
+    def test_get_lieferadressen_many(self):
+        lieferadressen = get_lieferadressen_many(['SC%d' % (17000 + i) for i in range(250)])
+        self.assertEqual(len(self.abfragen), 3)
+        self.assertTrue("VAKDNR IN ('   17000','   17001'," in self.abfragen[0])
+        self.assertEqual(len(lieferadressen), 250)
+        self.assertEqual([kunde['kundennr'] for kunde in lieferadressen['SC17000']],
+                         ['SC17000.001', 'SC17000.002'])
+        self.assertEqual(lieferadressen['SC17000'][1]['name1'], 'Lager 2')
+        # Lieferadressen ohne XXA00 Satz werden übergangen
+        self.assertEqual(lieferadressen['SC17001'], [])
+        self.assertEqual(lieferadressen['SC17002'], [])
+        self.assertEqual([kunde['kundennr'] for kunde in lieferadressen['SC17150']], ['SC17150.001'])
+
+    def test_inkonsistent(self):
+        self.adressen.append(self._adresse(17000, 2, 502))
+        self.assertRaises(RuntimeError, get_lieferadressen_many, ['SC17000'])
+
+
+class IlnindexTests(unittest.TestCase):
+    """GLN/ILN Index mit synthetischen XKS00/AVA00 Zeilen - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query, get_kunde, get_changed_after
+        self._original = (query, get_kunde, get_changed_after)
+        self.stammadressen = {17000: '4005998000007', 17001: ''}
+        self.lieferadressen = [(17000, 1, 501, '4005998000014'), (17001, 1, 502, '4005998000021')]
+        self.geaendert = []
+        self.abfragen = []
+
+        def kunde(kundennr):
+            return dict(kundennr='SC%s' % kundennr)
+
+        def changed_after(date):
+            return self.geaendert
+
+        query, get_kunde, get_changed_after = self._query, kunde, changed_after
+        self._zuruecksetzen()
+
+    def tearDown(self):
+        global query, get_kunde, get_changed_after
+        query, get_kunde, get_changed_after = self._original
+        self._zuruecksetzen()
+
+    def _zuruecksetzen(self):
+        global _ilnindex_geladen, _ilnindex_stand
+        _ilnindex.clear()
+        _ilnkunden.clear()
+        _ilnindex_geladen = _ilnindex_stand = 0
+
+    def _query(self, tables, fields=None, condition=None, **kwargs):
+        if not isinstance(tables, list):
+            tables = [tables]
+        self.abfragen.append((tables[0], condition))
+        condition = condition or ''
+        kundennrs = None
+        if ' IN (' in condition:
+            kundennrs = [int(nr.strip("' ")) for nr in condition.split('IN (')[1].split(')')[0].split(',')]
+        if tables[0] == 'XKS00':
+            rows = [(kundennr, iln) for kundennr, iln in sorted(self.stammadressen.items())
+                    if kundennrs is None or kundennr in kundennrs]
+            if condition.startswith('KCE2IL='):
+                return [dict(kundennr=kundennr) for kundennr, iln in rows if "KCE2IL='%s'" % iln == condition]
+            return rows
+        if tables[0] == 'AVA00':
+            rows = [adresse for adresse in self.lieferadressen
+                    if kundennrs is None or adresse[0] in kundennrs]
+            if condition.startswith('VAILN='):
+                return [dict(kundennr=kundennr, versandadresssnr=vanr, satznr=sanr)
+                        for kundennr, vanr, sanr, iln in rows if "VAILN='%s'" % iln == condition]
+            return rows
+        if tables[0] == 'XXA00':
+            return [dict(kundennr=kundennr, satznr=sanr, name1='Lager', laenderkennzeichen='D',
+                         betreuer='verkauf', erfassung_date=datetime.date(2011, 1, 3))
+                    for kundennr, vanr, sanr, iln in self.lieferadressen if "XASANR='%s'" % sanr == condition]
+        self.fail("Unerwartete Abfrage: %s %s" % (tables, condition))
+
+    def test_aufbau(self):
+        self.assertEqual(get_kunde_by_iln('4005998000007'), dict(kundennr='SC17000'))
+        self.assertEqual(self.abfragen, [('XKS00', None), ('AVA00', None)])
+        self.assertEqual(get_kunde_by_iln('4005998000021')['kundennr'], 'SC17001/001')
+        self.assertEqual(get_kunde_by_iln('4005998000021')['kundennr'], 'SC17001/001')
+        self.assertEqual(self.abfragen[2:], [('XXA00', "XASANR='502'")])
+
+    def test_aktualisieren(self):
+        global _ilnindex_stand
+        lade_ilnindex()
+        self.stammadressen[17001] = '4005998000038'
+        self.lieferadressen[1] = (17001, 1, 502, '4005998000045')
+        self.geaendert = ['SC17001']
+        _ilnindex_stand -= ILNINDEX_INTERVALL + 1
+        del self.abfragen[:]
+        self.assertEqual(get_kunde_by_iln('4005998000038'), dict(kundennr='SC17001'))
+        # Nur die geänderten Kunden werden gelesen, nicht die ganze AVA00
+        self.assertEqual(self.abfragen, [('XKS00', "KSKDNR IN ('   17001')"),
+                                         ('AVA00', "VAKDNR IN ('   17001')")])
+        self.assertEqual(_ilnindex[4005998000045], ('lieferadresse', 17001, 1, 502))
+        self.assertFalse(4005998000021 in _ilnindex)
+        self.assertEqual(_ilnindex[4005998000014], ('lieferadresse', 17000, 1, 501))
+
+    def test_direkte_suche(self):
+        lade_ilnindex()
+        # Neue Lieferadresse ohne gemeldete Änderung am Kunden
+        self.lieferadressen.append((17000, 2, 503, '4005998000052'))
+        self.assertEqual(get_kunde_by_iln('4005998000052')['kundennr'], 'SC17000/002')
+        self.assertEqual(self.abfragen[2:], [('XKS00', "KCE2IL='4005998000052'"),
+                                             ('AVA00', "VAILN='4005998000052'"), ('XXA00', "XASANR='503'")])
+        self.assertEqual(_ilnindex[4005998000052], ('lieferadresse', 17000, 2, 503))
+        self.assertRaises(ValueError, get_kunde_by_iln, '4005998000069')
+
+
 def _selftest():
     """Test basic functionality"""
     from pprint import pprint
@@ -7,34 +7,111 @@ Created by Maximillian Dornseif on 2007-03-17.
 Copyright (c) 2007, 2010, 2011 HUDORA GmbH. All rights reserved.
 """
 
+import datetime
+import huTools.async
+import husoftm2.aenderungen
 import husoftm2.sachbearbeiter
-from husoftm2.backend import query, x_en
-from husoftm2.tools import sql_quote, remove_prefix
+import husoftm2.texte
+import logging
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from husoftm2.backend import query, query_pages, x_en
+from husoftm2.tools import date2softm, softm2date, sql_quote, remove_prefix
 from husoftm2.texte import txt_auslesen
 
 
+# Anzahl der Threads, die Abfragen beim Einlesen von Lieferscheinpositionen parallel abarbeiten.
+# Alle Abfragen landen in einer Queue, es gibt also nie mehr als MAX_PARALLELE_ABFRAGEN Threads.
+MAX_PARALLELE_ABFRAGEN = 8
+_abfragequeue = Queue.Queue()
+_abfragethreads = []
+_abfragethreads_lock = threading.Lock()
+
+
+class _Abfrage(object):
+    """Eine Abfrage für den Abfrage-Pool. Wie bei huTools.async.Future wartet ein Aufruf auf das Ergebnis."""
+
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self._fertig = threading.Event()
+        self._ergebnis = None
+        self._fehler = None
+
+    def ausfuehren(self):
+        """Führt die Abfrage aus, Exceptions werden beim Aufruf erneut ausgelöst."""
+        try:
+            self._ergebnis = query(**self.kwargs)
+        except:
+            self._fehler = sys.exc_info()
+        self._fertig.set()
+
+    def __call__(self):
+        self._fertig.wait()
+        if self._fehler:
+            raise self._fehler[0], self._fehler[1], self._fehler[2]
+        return self._ergebnis
+
+
+def _abfragen_abarbeiten():
+    """Hauptschleife der Threads im Abfrage-Pool."""
+    while True:
+        _abfragequeue.get().ausfuehren()
+
+
+def _parallele_query(**kwargs):
+    """Reiht query(**kwargs) in den Abfrage-Pool ein und gibt ein _Abfrage-Objekt zurück."""
+    if len(_abfragethreads) < MAX_PARALLELE_ABFRAGEN:
+        _abfragethreads_lock.acquire()
+        try:
+            while len(_abfragethreads) < MAX_PARALLELE_ABFRAGEN:
+                thread = threading.Thread(target=_abfragen_abarbeiten, name='husoftm2.lieferscheine')
+                thread.setDaemon(True)
+                thread.start()
+                _abfragethreads.append(thread)
+        finally:
+            _abfragethreads_lock.release()
+    abfrage = _Abfrage(kwargs)
+    _abfragequeue.put(abfrage)
+    return abfrage
+
+
 def get_ls_kb_data(conditions, additional_conditions=None, limit=None, header_only=False,
-                   is_lieferschein=True):
+                   is_lieferschein=True, cachingtime=60 * 60 * 12):
     """Lieferscheindaten oder Kommsissionierbelegdaten entsprechend dem Lieferungsprotokoll.
 
     Wenn is_lieferschein = False, dann werden Kommiauftragsdaten zurückgebeben (Kommimengen)
 
+    Alle Abfragen werden `cachingtime` Sekunden gecached.
     """
 
-    cachingtime = 60 * 60 * 12
-
     if additional_conditions:
         conditions.extend(additional_conditions)
-    condition = " AND ".join(conditions)
+    rows = _ls_kb_koepfe(" AND ".join(conditions), limit, cachingtime)
+    return _ls_kb_aufbereiten(rows, header_only, is_lieferschein, cachingtime)
+
+
+# Lieferscheinkopf JOIN Kundenadresse um die Anzahl der Queries zu minimieren
+# JOIN Lieferadresse geht nicht, weil wir "ADAART=1" mit DB2/400 nicht klappt
+_LS_KB_JOINS = [('XKD00', 'LKKDNR', 'KDKDNR'), ('AAK00', 'LKAUFS', 'AKAUFN')]
+
+
+def _ls_kb_koepfe(condition, limit, cachingtime):
+    """Liest die Lieferscheinköpfe (nach LKSANK absteigend sortiert) für get_ls_kb_data() ein."""
+    return query(['ALK00'], ordering=['LKSANK DESC'], condition=condition, limit=limit,
+                 joins=_LS_KB_JOINS, cachingtime=cachingtime, ua='husoftm2.lieferscheine')
+
+
+def _ls_kb_aufbereiten(rows, header_only, is_lieferschein, cachingtime):
+    """Baut aus den Kopfzeilen von _ls_kb_koepfe() die Lieferscheine samt Positionen und Texten."""
     koepfe = {}
     auftragsnr2satznr = {}
     satznr2auftragsnr = {}
 
-    # Lieferscheinkopf JOIN Kundenadresse um die Anzahl der Queries zu minimieren
-    # JOIN Lieferadresse geht nicht, weil wir "ADAART=1" mit DB2/400 nicht klappt
-    for row in query(['ALK00'], ordering=['LKSANK DESC'], condition=condition, limit=limit,
-                      joins=[('XKD00', 'LKKDNR', 'KDKDNR'), ('AAK00', 'LKAUFS', 'AKAUFN')],
-                      cachingtime=cachingtime, ua='husoftm2.lieferscheine'):
+    for row in rows:
         kopf = dict(positionen=[],
                     auftragsnr="SO%s" % row['auftragsnr'],
                     auftragsnr_kunde=row['auftragsnr_kunde'],
@@ -93,18 +170,29 @@ def get_ls_kb_data(conditions, additional_conditions=None, limit=None, header_on
 
     satznr = koepfe.keys()
     allauftrnr = koepfe.keys()
-    # Alle texte einlesen
-    postexte, kopftexte, posdaten, kopfdaten = txt_auslesen([satznr2auftragsnr[x] for x in allauftrnr])
+    # Alle texte einlesen - parallel zu den Abfragen der Positionen
+    texte_future = huTools.async.Future(txt_auslesen, [satznr2auftragsnr[x] for x in allauftrnr])
+
+    # In 50er Schritten Lieferadressen und Auftragspositionen lesen. Alle Abfragen werden sofort
+    # eingereiht und von den MAX_PARALLELE_ABFRAGEN Threads des Abfrage-Pools abgearbeitet.
+    batches = []
     while satznr:
-        # In 50er Schritten Auftragspositionen & Texte lesen und den 50 Aufträgen zuordnen
         batch = satznr[:50]
         satznr = satznr[50:]
-
         # Abweichende Lieferadressen
         condition = "ADAART=1 AND ADRGNR IN (%s) AND ADRGNR=AKAUFN" % ','.join([str(satznr2auftragsnr[x])
                                                                                 for x in batch])
-        for row in query(['XAD00', 'AAK00'], cachingtime=cachingtime, ua='husoftm2.lieferscheine',
-                         condition=condition):
+        adressen = _parallele_query(tables=['XAD00', 'AAK00'], cachingtime=cachingtime,
+                                    ua='husoftm2.lieferscheine', condition=condition)
+        condition = "LNSTAT<>'X' AND LNSANK IN (%s)" % ','.join([str(x) for x in batch])
+        positionen = _parallele_query(tables=['ALN00'], condition=condition, cachingtime=cachingtime,
+                                      ua='husoftm2.lieferscheine')
+        batches.append((adressen, positionen))
+
+    postexte, kopftexte, posdaten, kopfdaten = texte_future()
+    for adressen, positionen in batches:
+        # Die Ergebnisse der 50er Schritte den Aufträgen zuordnen
+        for row in adressen():
             aktsatznr = auftragsnr2satznr[row['nr']]
             koepfe[aktsatznr]['lieferadresse'].update(dict(name1=row['name1'],
                             name2=row['name2'],
@@ -120,9 +208,7 @@ def get_ls_kb_data(conditions, additional_conditions=None, limit=None, header_on
             koepfe[aktsatznr]['lieferadresse']['warenempfaenger'] = warenempfaenger
 
         # Positionen & Positionstexte zuordnen
-        for row in query(['ALN00'], condition="LNSTAT<>'X' AND LNSANK IN (%s)" % ','.join([str(x)
-                                                                                           for x in batch]),
-                         cachingtime=cachingtime, ua='husoftm2.lieferscheine'):
+        for row in positionen():
             if is_lieferschein == True:
                 lsmenge = int(row['menge'])
                 if row['ALN00_dfsl']:
@@ -156,26 +242,33 @@ def get_ls_kb_data(conditions, additional_conditions=None, limit=None, header_on
             # die (oder der), die für den Kunden zusändig ist.
             lieferung['sachbearbeiter'] = husoftm2.sachbearbeiter.resolve(row['sachbearbeiter_bearbeitung'])
 
-        # Kopftexte zuordnen
-        for auftragsnr, texte in kopftexte.items():
+    _koepfe_nachbearbeiten(koepfe, auftragsnr2satznr, kopftexte, kopfdaten)
+    return koepfe.values()
+
+
+def _koepfe_nachbearbeiten(koepfe, auftragsnr2satznr, kopftexte, kopfdaten):
+    """Ordnet Kopftexte und -daten den Lieferscheinköpfen zu und entfernt überflüssige Lieferadressen.
+
+    Läuft einmal nach dem Einlesen aller Positionen - der Aufwand ist linear in der Zahl der Köpfe.
+    """
+    # Kopftexte zuordnen
+    for auftragsnr, texte in kopftexte.items():
+        pos_key = auftragsnr2satznr[remove_prefix(auftragsnr, 'SO')]
+        koepfe[pos_key]['infotext_kunde'] = texte
+    for auftragsnr, werte in kopfdaten.items():
+        if 'guid' in werte:
             pos_key = auftragsnr2satznr[remove_prefix(auftragsnr, 'SO')]
-            koepfe[pos_key]['infotext_kunde'] = texte
-        for auftragsnr, werte in kopfdaten.items():
-            if 'guid' in werte:
-                pos_key = auftragsnr2satznr[remove_prefix(auftragsnr, 'SO')]
-                koepfe[pos_key]['guid_auftrag'] = werte['guid']
-
-        for aktsatznr in koepfe.keys():
-            # Entfernt Konstrukte wie das:
-            #     "kundennr": "SC19971",
-            #      "lieferadresse": {
-            #       "kundennr": "SC19971"
-            #      }
-            if len(koepfe[aktsatznr]['lieferadresse']) == 1:
-                if koepfe[aktsatznr]['lieferadresse']['kundennr'] == koepfe[aktsatznr]['kundennr']:
-                    del(koepfe[aktsatznr]['lieferadresse'])
+            koepfe[pos_key]['guid_auftrag'] = werte['guid']
 
-    return koepfe.values()
+    for kopf in koepfe.values():
+        # Entfernt Konstrukte wie das:
+        #     "kundennr": "SC19971",
+        #      "lieferadresse": {
+        #       "kundennr": "SC19971"
+        #      }
+        if len(kopf['lieferadresse']) == 1:
+            if kopf['lieferadresse']['kundennr'] == kopf['kundennr']:
+                del(kopf['lieferadresse'])
 
 
 def _lieferscheine(additional_conditions=None, limit=None, header_only=False):
@@ -186,6 +279,25 @@ def _lieferscheine(additional_conditions=None, limit=None, header_only=False):
     return get_ls_kb_data(conditions, additional_conditions, limit, header_only)
 
 
+def iter_lieferscheine(conditions=None, header_only=False, page_size=1000):
+    """Liefert Lieferscheine wie _lieferscheine(), aber seitenweise als Generator.
+
+    Die Köpfe werden mit husoftm2.backend.query_pages() in Seiten zu `page_size` Lieferscheinen nach
+    LKSANK absteigend gelesen (keyset pagination). Jede Seite wird mit Positionen und Texten angereichert
+    und ausgeliefert, bevor die nächste gelesen wird - so bleibt der Speicherbedarf auch bei Exporten
+    über Monate konstant.
+
+    >>> for lieferschein in iter_lieferscheine(["LKDTLF>=1110101"]):
+    ...     export(lieferschein)
+    """
+    cachingtime = 60 * 60 * 12
+    condition = " AND ".join(["LKLFSN<>0", "LKSTAT<>'X'"] + list(conditions or []))
+    for rows in query_pages(['ALK00'], condition=condition, joins=_LS_KB_JOINS, key='LKSANK',
+                            page_size=page_size, cachingtime=cachingtime, ua='husoftm2.lieferscheine'):
+        for lieferschein in _ls_kb_aufbereiten(rows, header_only, True, cachingtime):
+            yield lieferschein
+
+
 def get_changed_after(date, limit=None):
     """Liefert die Lieferscheinnummern zurück, die nach <date> geändert wurden."""
     date = int(date.strftime('1%y%m%d'))
@@ -201,6 +313,36 @@ def get_changed_after(date, limit=None):
     return ret
 
 
+def aenderungen(konsument, seit=None):
+    """Liefert die Lieferscheinnummern, die seit der letzten bestätigten Position von `konsument` neu
+    erfasst oder geändert wurden, und die neue Position.
+
+    Anders als get_changed_after() arbeitet die Funktion sekundengenau (LKDTER/LKZTER, LKDTAE/LKZTAE).
+    Nach der Verarbeitung muss die Position mit husoftm2.aenderungen.bestaetige() gespeichert werden.
+    Gibt es noch keine Position, wird ab `seit` (ein datetime.date, default heute) geliefert.
+
+    >>> lieferscheinnrs, position = aenderungen('shop-sync')
+    >>> husoftm2.aenderungen.bestaetige('shop-sync', position)
+    """
+    position = husoftm2.aenderungen.lade_position('lieferscheine', konsument)
+    if position is None:
+        position = dict(feed='lieferscheine', stempel=[int(date2softm(seit or datetime.date.today())), 0],
+                        pruefsummen={})
+    datum, zeit = position['stempel']
+    conditions = ["LKLFSN<>0",
+                  "LKSTAT<>'X'",
+                  "(LKDTER>%d OR (LKDTER=%d AND LKZTER>=%d) OR LKDTAE>%d OR (LKDTAE=%d AND LKZTAE>=%d))"
+                  % (datum, datum, zeit, datum, datum, zeit)]
+    rows = query(['ALK00'], condition=' AND '.join(conditions),
+                 fields=['LKLFSN', 'LKDTER', 'LKZTER', 'LKDTAE', 'LKZTAE'],
+                 querymappings={}, cachingtime=0, ua='husoftm2.lieferscheine')
+    zeilen = []
+    for lieferscheinnr, dter, zter, dtae, ztae in rows:
+        stempel = max([int(dter), int(zter)], [int(dtae), int(ztae)])
+        zeilen.append(("SL%s" % lieferscheinnr, stempel, "%d%06d" % tuple(stempel)))
+    return husoftm2.aenderungen.neue_aenderungen(position, zeilen)
+
+
 # Wir arbeiten im Zusammenhang mit Liefershceinen mit dem Kundenspezifischen Feld LKKZ02.
 # Dies ist standartmässig mit 0 vorbelegt. Wir setzen den Wert nach Verarbeitung auf 0.
 def get_new(limit=20):
@@ -225,6 +367,21 @@ def get_new(limit=20):
     return ret
 
 
+def fetch_new(limit=20):
+    """Liefert unverarbeitete Lieferscheine wie get_lieferschein() - aber alle mit einer Handvoll Abfragen.
+
+    Ersetzt den Aufruf von get_new() gefolgt von get_lieferschein() für jede einzelne Nummer.
+    Verarbeitete Lieferscheine sollten mit mark_processed_many() markiert werden.
+    """
+    conditions = ["LKSTAT<>'X'",
+                  "LKKZ02=0",
+                  "LKLFSN<>0",
+                  ]
+    # Ohne Caching, damit wir keine Lieferscheine in einem veralteten Zustand verarbeiten
+    return [_lieferschein_aufbereiten(lschein)
+            for lschein in get_ls_kb_data(conditions, limit=limit, cachingtime=0)]
+
+
 def mark_processed(lieferscheinnr):
     """Markiert einen Lieferschein, so dass er von get_new() nicht mehr zurücuk gegeben wird."""
     conditions = ["LKLFSN=%s" % sql_quote(remove_prefix(lieferscheinnr, 'SL')),
@@ -234,6 +391,30 @@ def mark_processed(lieferscheinnr):
     return x_en('ALK00', condition=' AND '.join(conditions), ua='husoftm2.lieferscheine')
 
 
+def mark_processed_many(lieferscheinnrs):
+    """Wie mark_processed(), aber für viele Lieferscheine mit einem UPDATE pro 50 Lieferscheinen.
+
+    Gibt die Anzahl der markierten Lieferscheine zurück. Lieferscheine, die nicht existieren, gelöscht
+    oder schon markiert sind, werden nicht mitgezählt - wir verlassen uns dabei auf die Anzahl der
+    geänderten Zeilen, die SoftMexpress zurückmeldet, statt vor und nach dem UPDATE nachzusehen.
+    """
+    markiert = 0
+    lieferscheinnrs = list(lieferscheinnrs)
+    while lieferscheinnrs:
+        batch = [remove_prefix(nr, 'SL') for nr in lieferscheinnrs[:50]]
+        lieferscheinnrs = lieferscheinnrs[50:]
+        conditions = ["LKLFSN IN (%s)" % ','.join([sql_quote(nr) for nr in batch]),
+                      "LKSTAT<>'X'",
+                      "LKKZ02=0"]
+        anzahl = x_en('ALK00', condition=' AND '.join(conditions), ua='husoftm2.lieferscheine',
+                      multiple=True)
+        if anzahl != len(batch):
+            logging.warning("mark_processed_many: %d von %d Lieferscheinen markiert: %r",
+                            anzahl, len(batch), batch)
+        markiert += anzahl
+    return markiert
+
+
 def lieferscheine_auftrag(auftragsnr, header_only=False):
     """Gibt eine Liste mit Lieferscheindicts für einen Auftrag zurück"""
     auftragsnr = remove_prefix(auftragsnr, 'SO')
@@ -259,16 +440,20 @@ def get_lieferschein(lieferscheinnr, header_only=False):
         if len(lscheine) > 1:
             raise RuntimeError('Suche nach %s hat mehr als einen Lieferschein ergeben: %r'
                                % (lieferscheinnr, lscheine))
-        lschein = lscheine[0]
-        infotext = lschein.get('infotext_kunde')
-        if infotext and isinstance(infotext, list):
-            lschein['infotext_kunde'] = ', '.join(infotext)
-        if not lschein.get('datum'):
-            raise RuntimeError('LS %s hat kein Datum: %r' % (lieferscheinnr, lschein))
-        return lschein
+        return _lieferschein_aufbereiten(lscheine[0])
     return {}
 
 
+def _lieferschein_aufbereiten(lschein):
+    """Letzter Schliff für einzeln ausgelieferte Lieferscheine: Infotexte zusammenfassen, Datum prüfen."""
+    infotext = lschein.get('infotext_kunde')
+    if infotext and isinstance(infotext, list):
+        lschein['infotext_kunde'] = ', '.join(infotext)
+    if not lschein.get('datum'):
+        raise RuntimeError('LS %s hat kein Datum: %r' % (lschein['lieferscheinnr'], lschein))
+    return lschein
+
+
 def _timedelta_to_hours(tdelta):
     """Verwandelt ein timedeltaobjekt in Stungen (Integer)"""
     hours = tdelta.days * 24
@@ -276,47 +461,117 @@ def _timedelta_to_hours(tdelta):
     return hours
 
 
-def get_lagerabgang(day):
-    """Liefert im Grunde einen ALN00 Auszug für einen Tag - dient statistischen Zwecken."""
+# Felder für get_lagerabgang() und iter_lagerabgang(). LNSANP brauchen wir als Schlüssel für query_pages().
+_LAGERABGANG_FELDER = ['LNAUFN', 'LNAUPO', 'LNARTN', 'LNKZKO', 'LNKDRG', 'LNKDNR', 'LNLFSN', 'LNMNGL',
+                       'LNDTLF', 'LNDTVS', 'LNMNGF', 'LNDTER', 'LNLWA2', 'LKKDRG', 'LKKDNR', 'LKLFSN',
+                       'LKDTLF', 'LKDTKB', 'LKAUFS', 'LKDTLT', 'AKAUFN', 'AKAUFA', 'AKDTLT', 'AKDTER',
+                       'LNBELP', 'LNDTLT', 'LNSANP']
+# SoftM Freuden! Das Feld LKSANKB kann ausser zwischen Oktober 2005 und November 2007
+# für den join genommen werden, ansonsten kann man LKSANK nehmen.
+_LAGERABGANG_JOINS = [('ALK00', 'LNSANK', 'LKSANK'),
+                      ('AAK00', 'LNAUFN', 'AKAUFN')]
+
+
+def _lagerabgang_bedingung(datumsbedingung):
+    """Bedingungen für Lagerabgänge, `datumsbedingung` schränkt LNDTLF ein."""
     conditions = ["(LKLFSN<>0 OR LNLFSN<>0)",  # durch Umparametrisierung ist mal das und mal das leer ...
                   "AKLGN2='0'",
                   "LNSTAT<>'X'",
                   "LKSTAT<>'X'",
-                  "LNDTLF=%s" % (sql_quote(day.strftime('1%y%m%d')))]
-
-    # SoftM Freuden! Das Feld LKSANKB kann ausser zwischen Oktober 2005 und November 2007
-    # für den join genommen werden, ansonsten kann man LKSANK nehmen.
-    rows = query(['ALN00'], condition=" AND ".join(conditions),
-            fields=['LNAUFN', 'LNAUPO', 'LNARTN', 'LNKZKO', 'LNKDRG', 'LNKDNR', 'LNLFSN', 'LNMNGL', 'LNDTLF',
-                    'LNDTVS', 'LNMNGF', 'LNDTER', 'LNLWA2', 'LKKDRG', 'LKKDNR', 'LKLFSN', 'LKDTLF', 'LKDTKB',
-                    'LKAUFS', 'LKDTLT', 'AKAUFN', 'AKAUFA', 'AKDTLT', 'AKDTER', 'LNBELP', 'LNDTLT'],
-          joins=[('ALK00', 'LNSANK', 'LKSANK'),
-                 ('AAK00', 'LNAUFN', 'AKAUFN')])
-    ret = []
-    for row in rows:
-        data = dict(auftragsnr="SO%s" % row['auftragsnr'],
-                    lieferscheinnr="SL%s" % (int(row['lieferscheinnr']) or int(row['ALN_lieferscheinnr'])),
-                    menge=int(row['menge_fakturierung']),
-                    auftragsart=row['art'],
-                    artnr=row['artnr'],
-                    warenempfaenger="SC%s" % row['warenempfaenger'],
-                    kundennr="SC%s" % row['rechnungsempfaenger'],
-                    setartikel=(int(row['setartikel']) == 1),
-                    wert=int(row['wert'] * 100),
-                    auftrag_positionsnr=row['auftrags_position'],
-                    positionsnr=row['kommibeleg_position'],
-                    vorlauf_h=None, durchlauf_h=None, termintreue_h=None,
-                    datum=row['ALK_lieferschein_date'],
-                   )
-        anliefer_date = row['ALN_anliefer_date'] or row['anliefer_date']
-        versand_date = row['versand_date'] or row['lieferschein_date']
-        if anliefer_date and row['AAK_erfassung_date']:
-            row['vorlauf_h'] = _timedelta_to_hours(anliefer_date - row['AAK_erfassung_date']),
-        if versand_date and anliefer_date:
-            row['termintreue_h'] = _timedelta_to_hours(versand_date - anliefer_date)
-        if versand_date and row['AAK_erfassung_date']:
-            row['durchlauf_h'] = _timedelta_to_hours(versand_date - row['AAK_erfassung_date'])
-        ret.append(data)
+                  datumsbedingung]
+    return " AND ".join(conditions)
+
+
+def _lagerabgang_aufbereiten(row):
+    """Wandelt eine Zeile der Lagerabgangs-Abfrage in ein dict."""
+    data = dict(auftragsnr="SO%s" % row['auftragsnr'],
+                lieferscheinnr="SL%s" % (int(row['lieferscheinnr']) or int(row['ALN_lieferscheinnr'])),
+                menge=int(row['menge_fakturierung']),
+                auftragsart=row['art'],
+                artnr=row['artnr'],
+                warenempfaenger="SC%s" % row['warenempfaenger'],
+                kundennr="SC%s" % row['rechnungsempfaenger'],
+                setartikel=(int(row['setartikel']) == 1),
+                wert=int(row['wert'] * 100),
+                auftrag_positionsnr=row['auftrags_position'],
+                positionsnr=row['kommibeleg_position'],
+                vorlauf_h=None, durchlauf_h=None, termintreue_h=None,
+                datum=row['ALK_lieferschein_date'],
+               )
+    anliefer_date = row['ALN_anliefer_date'] or row['anliefer_date']
+    # LNDTLF hat kein Mapping in fields.py und kommt deshalb unter seinem AS/400 Namen
+    versand_date = row['versand_date'] or softm2date(row['LNDTLF'])
+    if anliefer_date and row['AAK_erfassung_date']:
+        data['vorlauf_h'] = _timedelta_to_hours(anliefer_date - row['AAK_erfassung_date'])
+    if versand_date and anliefer_date:
+        data['termintreue_h'] = _timedelta_to_hours(versand_date - anliefer_date)
+    if versand_date and row['AAK_erfassung_date']:
+        data['durchlauf_h'] = _timedelta_to_hours(versand_date - row['AAK_erfassung_date'])
+    return data
+
+
+def get_lagerabgang(day):
+    """Liefert im Grunde einen ALN00 Auszug für einen Tag - dient statistischen Zwecken."""
+    condition = _lagerabgang_bedingung("LNDTLF=%s" % (sql_quote(day.strftime('1%y%m%d'))))
+    rows = query(['ALN00'], condition=condition, fields=_LAGERABGANG_FELDER, joins=_LAGERABGANG_JOINS)
+    return [_lagerabgang_aufbereiten(row) for row in rows]
+
+
+def _lagerabgang_zeilen(start, end, page_size):
+    """Liefert die Zeilen der Lagerabgangs-Abfrage von start bis einschliesslich end seitenweise."""
+    condition = _lagerabgang_bedingung("LNDTLF BETWEEN %s AND %s" % (sql_quote(start.strftime('1%y%m%d')),
+                                                                      sql_quote(end.strftime('1%y%m%d'))))
+    for rows in query_pages(['ALN00'], condition=condition, fields=_LAGERABGANG_FELDER,
+                            joins=_LAGERABGANG_JOINS, key='LNSANP', page_size=page_size,
+                            cachingtime=60 * 60, ua='husoftm2.lieferscheine.lagerabgang'):
+        for row in rows:
+            yield row
+
+
+def iter_lagerabgang(start, end, page_size=1000):
+    """Liefert die Lagerabgänge von start bis einschliesslich end wie get_lagerabgang(), aber als Generator.
+
+    Statt einer Abfrage pro Tag wird der ganze Zeitraum seitenweise (nach LNSANP absteigend) gelesen,
+    es wird also nie mehr als eine Seite im Speicher gehalten.
+    """
+    for row in _lagerabgang_zeilen(start, end, page_size):
+        yield _lagerabgang_aufbereiten(row)
+
+
+def _kennzahl_buchen(kennzahl, wert):
+    """Bucht einen Wert in eine Kennzahl dict(anzahl, summe, minimum, maximum, mittel) ein."""
+    if wert is None:
+        return
+    kennzahl['anzahl'] += 1
+    kennzahl['summe'] += wert
+    if kennzahl['minimum'] is None or wert < kennzahl['minimum']:
+        kennzahl['minimum'] = wert
+    if kennzahl['maximum'] is None or wert > kennzahl['maximum']:
+        kennzahl['maximum'] = wert
+    kennzahl['mittel'] = float(kennzahl['summe']) / kennzahl['anzahl']
+
+
+def lagerabgang_statistik(start, end, page_size=1000):
+    """Verdichtet die Lagerabgänge von start bis einschliesslich end zu Kennzahlen pro Tag (LNDTLF).
+
+    Rückgabe ist ein dict von datetime.date auf ein dict mit positionen, menge, wert (in Cent) und
+    für vorlauf_h, durchlauf_h und termintreue_h je einem dict mit anzahl, summe, minimum, maximum
+    und mittel. Die Kennzahlen werden beim Lesen fortgeschrieben, die Zeilen selbst nicht aufgehoben.
+    """
+    ret = {}
+    for row in _lagerabgang_zeilen(start, end, page_size):
+        data = _lagerabgang_aufbereiten(row)
+        tag = softm2date(row['LNDTLF'])
+        if tag not in ret:
+            ret[tag] = dict(positionen=0, menge=0, wert=0)
+            for name in ('vorlauf_h', 'durchlauf_h', 'termintreue_h'):
+                ret[tag][name] = dict(anzahl=0, summe=0, minimum=None, maximum=None, mittel=None)
+        statistik = ret[tag]
+        statistik['positionen'] += 1
+        statistik['menge'] += data['menge']
+        statistik['wert'] += data['wert']
+        for name in ('vorlauf_h', 'durchlauf_h', 'termintreue_h'):
+            _kennzahl_buchen(statistik[name], data[name])
     return ret
 
 
@@ -332,6 +587,236 @@ def get_lieferschein_statistics():
     return amounts[0], amounts[1]
 
 
+class KoepfeNachbearbeitenTests(unittest.TestCase):
+    """Nachbearbeitung der Köpfe mit synthetischen Daten - ohne Zugriff auf SoftM."""
+
+    def _daten(self, anzahl):
+        koepfe = {}
+        auftragsnr2satznr = {}
+        kopftexte = {}
+        kopfdaten = {}
+        for i in range(anzahl):
+            auftragsnr = 1000000 + i
+            koepfe[i] = dict(kundennr='SC%d' % (i % 7), lieferadresse=dict(kundennr='SC%d' % (i % 3)))
+            auftragsnr2satznr[auftragsnr] = i
+            if i % 2:
+                kopftexte['SO%d' % auftragsnr] = ['Text %d' % i]
+            if i % 5 == 0:
+                kopfdaten['SO%d' % auftragsnr] = dict(guid='guid%d' % i)
+        return koepfe, auftragsnr2satznr, kopftexte, kopfdaten
+
+    def test_nachbearbeiten(self):
+        koepfe, auftragsnr2satznr, kopftexte, kopfdaten = self._daten(21)
+        _koepfe_nachbearbeiten(koepfe, auftragsnr2satznr, kopftexte, kopfdaten)
+        self.assertEqual(koepfe[0], dict(kundennr='SC0', guid_auftrag='guid0'))
+        self.assertEqual(koepfe[1], dict(kundennr='SC1', infotext_kunde=['Text 1']))
+        self.assertEqual(koepfe[3], dict(kundennr='SC3', lieferadresse=dict(kundennr='SC0'),
+                                         infotext_kunde=['Text 3']))
+
+
+class LsKbAufbereitenTests(unittest.TestCase):
+    """get_ls_kb_data() mit synthetischen ALK00/ALN00 Zeilen - ohne Zugriff auf SoftM.
+
+    Die Nachbearbeitung der Köpfe darf nur einmal laufen und pro 50er Batch dürfen nur die beiden
+    Abfragen für Lieferadressen und Positionen dazukommen - egal wie viele Batches es sind.
+    """
+
+    def setUp(self):
+        global query, _koepfe_nachbearbeiten
+        self._original = (query, _koepfe_nachbearbeiten, husoftm2.texte.query, husoftm2.sachbearbeiter.query)
+        self.abfragen = []
+        self.nachbearbeitungen = 0
+        nachbearbeiten = _koepfe_nachbearbeiten
+
+        def nachbearbeiten_zaehlen(*args):
+            self.nachbearbeitungen += 1
+            return nachbearbeiten(*args)
+
+        query = husoftm2.texte.query = husoftm2.sachbearbeiter.query = self._query
+        _koepfe_nachbearbeiten = nachbearbeiten_zaehlen
+
+    def tearDown(self):
+        global query, _koepfe_nachbearbeiten
+        query, _koepfe_nachbearbeiten, husoftm2.texte.query, husoftm2.sachbearbeiter.query = self._original
+        husoftm2.texte.vergiss_texte()
+        husoftm2.sachbearbeiter._sachbearbeiter.clear()
+
+    def _query(self, tables, condition=None, **kwargs):
+        if not isinstance(tables, list):
+            tables = [tables]
+        self.abfragen.append(tables[0])
+        if tables[0] == 'ALK00':
+            return [self._kopf(satznr) for satznr in range(1, self.anzahl + 1)]
+        if tables[0] == 'ALN00':
+            satznrs = condition.split('IN (')[1].rstrip(')').split(',')
+            return [self._position(int(satznr)) for satznr in satznrs]
+        if tables[0] == 'XSB00':
+            return [dict(id='1', name='Sachbearbeiter')]
+        return []
+
+    def _kopf(self, satznr):
+        return dict(satznr=satznr, auftragsnr=1000000 + satznr, auftragsnr_kunde='', lager=100,
+                    ALK_erfassung=None, ALK_aenderung=None, ALK_lieferschein=datetime.datetime(2011, 1, 3),
+                    anliefer_date=None, rechnungsempfaenger=17200, warenempfaenger=17200,
+                    kommibelegnr=2000000 + satznr, kommibeleg_date=None, lieferscheinnr=4000000 + satznr,
+                    laenderkennzeichen='D', ALK00_dfsl='')
+
+    def _position(self, satznr):
+        return dict(satznr_kopf=satznr, auftragsnr=1000000 + satznr, kommibelegnr=2000000 + satznr,
+                    auftrags_position=1, kommibeleg_position=1, artnr='14600', menge=3, ALN00_dfsl='',
+                    sachbearbeiter_bearbeitung=1)
+
+    def _lieferscheine(self, anzahl):
+        self.anzahl = anzahl
+        self.nachbearbeitungen = 0
+        del self.abfragen[:]
+        return get_ls_kb_data(["LKLFSN<>0"], cachingtime=0)
+
+    def test_batches(self):
+        for anzahl in (1000, 10000):
+            lieferscheine = self._lieferscheine(anzahl)
+            self.assertEqual(len(lieferscheine), anzahl)
+            self.assertEqual(sum(len(lieferschein['positionen']) for lieferschein in lieferscheine), anzahl)
+            self.assertEqual(self.nachbearbeitungen, 1)
+            self.assertEqual(self.abfragen.count('ALK00'), 1)
+            self.assertEqual(self.abfragen.count('ALN00'), anzahl / 50)
+            self.assertEqual(self.abfragen.count('XAD00'), anzahl / 50)
+
+
+class MarkProcessedManyTests(unittest.TestCase):
+    """mark_processed_many() mit gestubbtem x_en - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query, x_en
+        self._original = (query, x_en)
+        self.updates = []
+
+        def update(tablename, condition, ua='', multiple=False):
+            self.updates.append((tablename, condition, multiple))
+            # Lieferscheinnummern, die auf 9 enden, gibt es nicht
+            nrs = condition.split('IN (')[1].split(')')[0].split(',')
+            return len([nr for nr in nrs if not nr.strip("'").endswith('9')])
+
+        def abfrage(*args, **kwargs):
+            self.fail("mark_processed_many() soll ALK00 nicht lesen")
+
+        query, x_en = abfrage, update
+
+    def tearDown(self):
+        global query, x_en
+        query, x_en = self._original
+
+    def test_mark_processed_many(self):
+        self.assertEqual(mark_processed_many([]), 0)
+        self.assertEqual(self.updates, [])
+        self.assertEqual(mark_processed_many(['SL%d' % (4000000 + i) for i in range(120)]), 108)
+        self.assertEqual(len(self.updates), 3)
+        self.assertEqual([update[0] for update in self.updates], ['ALK00'] * 3)
+        self.assertTrue(all(update[2] for update in self.updates))
+        self.assertTrue("LKLFSN IN ('4000000'," in self.updates[0][1])
+        self.assertTrue("LKKZ02=0" in self.updates[0][1])
+
+
+class AenderungenTests(unittest.TestCase):
+    """aenderungen() mit synthetischen ALK00 Zeilen - ohne Zugriff auf SoftM."""
+
+    def setUp(self):
+        global query
+        self._original = (query, husoftm2.aenderungen.speicher)
+        self._verzeichnis = tempfile.mkdtemp()
+        husoftm2.aenderungen.speicher = husoftm2.aenderungen.DateiSpeicher(self._verzeichnis)
+        self.zeilen = []
+
+        def antwort(tables, condition=None, **kwargs):
+            self.condition = condition
+            return self.zeilen
+
+        query = antwort
+
+    def tearDown(self):
+        global query
+        query, husoftm2.aenderungen.speicher = self._original
+        shutil.rmtree(self._verzeichnis)
+
+    def test_aenderungen(self):
+        self.zeilen = [(4000001, 1110126, 120000, 0, 0),
+                       (4000002, 1110125, 90000, 1110126, 130501)]
+        lieferscheinnrs, position = aenderungen('test', seit=datetime.date(2011, 1, 26))
+        self.assertTrue("(LKDTER>1110126 OR (LKDTER=1110126 AND LKZTER>=0)" in self.condition)
+        self.assertEqual(lieferscheinnrs, ['SL4000001', 'SL4000002'])
+        self.assertEqual(position['stempel'], [1110126, 130501])
+        husoftm2.aenderungen.bestaetige('test', position)
+
+        # Bestätigte Lieferscheine kommen nicht erneut, nur die später geänderten
+        self.zeilen = [(4000002, 1110125, 90000, 1110126, 130501),
+                       (4000003, 1110126, 130501, 0, 0),
+                       (4000004, 1110126, 140000, 0, 0)]
+        lieferscheinnrs, position = aenderungen('test')
+        self.assertTrue("(LKDTER=1110126 AND LKZTER>=130501)" in self.condition)
+        self.assertEqual(lieferscheinnrs, ['SL4000003', 'SL4000004'])
+        self.assertEqual(position['stempel'], [1110126, 140000])
+
+
+class LagerabgangTests(unittest.TestCase):
+    """Verdichtung der Lagerabgänge mit synthetischen Zeilen - ohne Zugriff auf SoftM."""
+
+    def _zeile(self, satznr, tag, versand_date):
+        return dict(satznr=satznr, LNDTLF=tag, auftragsnr=1, lieferscheinnr=5, ALN_lieferscheinnr=0,
+                    menge_fakturierung=3, art='', artnr='14600', warenempfaenger=17200,
+                    rechnungsempfaenger=17200, setartikel=0, wert=1.5, auftrags_position=1,
+                    kommibeleg_position=1, ALK_lieferschein_date=None, anliefer_date=None,
+                    ALN_anliefer_date=datetime.date(2011, 1, 3), versand_date=versand_date,
+                    AAK_erfassung_date=datetime.date(2011, 1, 1))
+
+    def test_statistik(self):
+        zeilen = [self._zeile(3, '1110103', None),
+                  self._zeile(2, '1110103', datetime.date(2011, 1, 4)),
+                  self._zeile(1, '1110104', None)]
+        # Seiten mit je zwei Zeilen liefern
+        seiten = [zeilen[:2], zeilen[2:]]
+
+        def seitenweise(*_args, **_kwargs):
+            return iter(seiten)
+
+        global query_pages
+        original = query_pages
+        query_pages = seitenweise
+        try:
+            statistik = lagerabgang_statistik(datetime.date(2011, 1, 1), datetime.date(2011, 1, 31))
+        finally:
+            query_pages = original
+        self.assertEqual(sorted(statistik.keys()), [datetime.date(2011, 1, 3), datetime.date(2011, 1, 4)])
+        tag = statistik[datetime.date(2011, 1, 3)]
+        self.assertEqual((tag['positionen'], tag['menge'], tag['wert']), (2, 6, 300))
+        self.assertEqual(tag['termintreue_h'], dict(anzahl=2, summe=24, minimum=0, maximum=24, mittel=12.0))
+        self.assertEqual(tag['durchlauf_h']['mittel'], 60.0)
+        self.assertEqual(statistik[datetime.date(2011, 1, 4)]['vorlauf_h']['anzahl'], 1)
+
+
+class AbfragepoolTests(unittest.TestCase):
+    """Der Abfrage-Pool arbeitet beliebig viele Abfragen mit MAX_PARALLELE_ABFRAGEN Threads ab."""
+
+    def setUp(self):
+        global query
+        self._query = query
+
+        def echo(**kwargs):
+            if kwargs['condition'] == 'kaputt':
+                raise RuntimeError(kwargs['condition'])
+            return [kwargs['condition']]
+        query = echo
+
+    def tearDown(self):
+        global query
+        query = self._query
+
+    def test_pool(self):
+        abfragen = [_parallele_query(condition=i) for i in range(500)]
+        self.assertEqual([abfrage() for abfrage in abfragen], [[i] for i in range(500)])
+        self.assertEqual(len(_abfragethreads), MAX_PARALLELE_ABFRAGEN)
+        self.assertRaises(RuntimeError, _parallele_query(condition='kaputt'))
+
+
 def _selftest():
     """Test basic functionality"""
     # Viele Texte: SL300300
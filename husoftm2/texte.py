@@ -4,7 +4,7 @@
 texte.py - Zugrif auf Auftragstexte (AAT00) in SoftM.
 
 Für einzelne Aufträge sollte `auftragstextdaten()` verwendet werden, `txt_auslesen()` ist für Bulk-Abfragen
-gedacht.
+gedacht. Die aufbereiteten Texte werden pro Auftrag zwischengespeichert, `vergiss_texte()` leert den Cache.
 
 Created by Maximillian Dornseif on 2010-12-11.
 Copyright (c) 2010, 2011 HUDORA. All rights reserved.
@@ -12,6 +12,8 @@ Copyright (c) 2010, 2011 HUDORA. All rights reserved.
 
 from husoftm2.backend import query
 from husoftm2.tools import remove_prefix
+import time
+import unittest
 import warnings
 
 
@@ -57,8 +59,26 @@ def texte_trennen(texte):
     return ', '.join([x for x in rettexte if x.strip()]), retdict
 
 
+# Texte werden nach der Erfassung so gut wie nie geändert. Deshalb halten wir die aufbereiteten Texte
+# pro Auftragsnummer TEXTCACHE_MAXALTER Sekunden lang vor und fragen nur fehlende Aufträge ab.
+TEXTCACHE_MAXALTER = 60 * 60 * 12
+TEXTCACHE_MAXEINTRAEGE = 50000
+_textcache = {}  # "SO..." -> (zeitpunkt, postexte, kopftexte, posdaten, kopfdaten)
+
+
+def vergiss_texte(auftragsnrs=None):
+    """Entfernt Aufträge (ohne Parameter alle) aus dem Textcache, z.B. nachdem Texte geändert wurden."""
+    if auftragsnrs is None:
+        _textcache.clear()
+    for auftragsnr in auftragsnrs or []:
+        _textcache.pop("SO%s" % remove_prefix(auftragsnr, 'SO'), None)
+
+
 def txt_auslesen(auftragsnrs, postexte=None, kopftexte=None, kopfdaten=None, posdaten=None):
-    """Gibt Positions und Kopftexte für eine Liste von Auftragsnummern zurück."""
+    """Gibt Positions und Kopftexte für eine Liste von Auftragsnummern zurück.
+
+    Bereits gelesene Aufträge kommen aus dem Textcache, nur die übrigen werden abgefragt.
+    """
 
     # Die Clients können dicts mit vorbelegten Daten mitgeben. Das ist vor allem da nützlich, wo
     # Jobs relativ viele Auftruage in Batches abarbeiten.
@@ -66,88 +86,171 @@ def txt_auslesen(auftragsnrs, postexte=None, kopftexte=None, kopfdaten=None, pos
     posdaten = posdaten or {}
     kopftexte = kopftexte or {}
     kopfdaten = kopfdaten or {}
-    # Wir arbeiten auf einer Kopie der Auftragsnummern, da wir von der Liste batches abschneiden.
-    allauftrnr = auftragsnrs[:]
-    while allauftrnr:
-        # In 50er Schritten Texte lesen, 'SO'-Kürzel entfernen.
-        # Wir erwarten auf jeden Fall String-Parameter.
-        batch = [remove_prefix(x, 'SO') for x in allauftrnr[:50]]
-        allauftrnr = allauftrnr[50:]
-        # Texte aus SoftM einlesen
-        condition = 'ATAUFN IN (%s)' % ','.join((str(x) for x in batch))
-        for row in query(['AAT00'], ordering=['ATTART', 'ATLFNR'], condition=condition, ua='husoftm2.texte'):
-            # Jeden der eingelesenen Texte nach Textart klassifizieren.
-            row['textart'] = int(row['textart'])
-            auftragsnr = "SO%s" % remove_prefix(row['auftragsnr'], 'SO')
-            # Textzeilen die leer sind oder nur Trennzeichen enthalten, ignorieren wir.
-            if not row['text'].strip('=*_- '):
-                continue
-
-            # Wir behandeln hier nur Texte, die auf Auftragsbestätigungen, Lieferscheinen oder Rechnungen
-            # auftauchen sollen. Allerdings drucken wir diese dann auch auf beiden Belegarten auf - keine
-            # weiteren Unterscheidungen.
-            if row['andruck_re'] or row['andruck_ls'] or row['andruck_ab']:
-                if row['andruck_re'] > 1 or row['andruck_ls'] > 3:
-                    raise NotImplementedError(row)
-
-                # Wir haben gelegentlich Texte mit `andruck_ab == 2` die offensichtlich nicht als
-                # Kundenbelege sollen. Der Wert 2 in diesem Feld ist gänzlich undokumentiert,
-                # wir ignorieren bis auf weiteres einfach diese Zeilen.
-                if row['andruck_ab'] > 1:
-                    continue
-
-                # Texte wo andruck_ls=2 steht soll man laut SoftM "nur auf KB drucken".
-                # Die Inhalte sind manchmal grenzwertig ... an dieser stelle kann man die aussortieren,
-                # machen wir aber zur zeit nicht.
-                if row['andruck_ls'] == 1 and (not row['andruck_re']) and (not row['andruck_ab']):
-                    pass
-
-                # Die Statistische Warennummer wird als Positionstext mit der Nummer 5 transportiert
-                # In Produktivdaten haben wir die aber bisher noch nicht gesehen.
-                if row['textart'] == 5:
-                    postexte.setdefault(auftragsnr, {}
-                           ).setdefault(row['auftragsposition'], []
-                           ).append("Statistische Warennummer: %s" % row['text'].strip())
-                # Die Textarten 2, 7 und 8 sind verschiedenen Positionstexte:
-                # * 2 Abweichende Artikelbezeichnung
-                # * 7 Auftragstexte vor Position
-                # * 8 Auftragstexte nach Position
-                # Wir fassen alle drei Textarten in einem einzigen Feld zusammen
-                elif row['auftragsposition'] > 0 and row['textart'] in (2, 7, 8):
-                    postexte.setdefault(auftragsnr, {}
-                           ).setdefault(row['auftragsposition'], []
-                           ).append(row['text'].strip())
-                # Textart 7 bei Position 0 ist eine Faxnummer. Warum auch immer. Wir ignorieren das.
-                # Das Feld ist **sehr oft** gefüllt.
-                elif row['auftragsposition'] == 0 and row['textart'] == 7:
-                    pass
-                # Bei Position 0 sind Textart 8 und 9 Fuß- und Kopftexte für den gesammten Auftrag.
-                # Wir fassen die in einem einzigen Feld zusammen.
-                elif row['auftragsposition'] == 0 and row['textart'] in (8, 9):
-                    kopftexte.setdefault(auftragsnr, []).append(row['text'])
-                else:
-                    # Andere Textarten sind uns bisher nicht untergekommen.
-                    print row
-                    raise NotImplementedError
-            # Wenn der Text eigentlich nirgends angedruckt werden soll, dann ist es entweder ein Warntext
-            # bei der Auftragserfassung, oder ein Verschlüsseltes Datenfeld.
-            else:
-                if int(row['auftragsposition'] == 0):
-                    # Erfassungstexte sind Texte, die bei der Auftragserfassung angeziegt werden, aber auf
-                    # keinem Beleg erscheinen (kein druckkennzeichen) - die ignorieren wir hier.
-                    # Die gesonderten Datenfelder, die mit #:VARNAME: beginnen, verwenden wir aber weiter
-                    _erfassungstexte, daten = texte_trennen([row['text']])
-                    if daten:
-                        kopfdaten.setdefault(auftragsnr, {}).update(daten)
-                else:  # row['auftragsposition'] > 0:
-                    erfassungstexte, daten = texte_trennen([row['text']])
-                    if daten:
-                        posdaten.setdefault(auftragsnr, {}
-                                            ).setdefault(row['auftragsposition'], {}
-                                            ).update(daten)
+
+    jetzt = time.time()
+    eintraege = {}
+    fehlend = []
+    for auftragsnr in set(["SO%s" % remove_prefix(x, 'SO') for x in auftragsnrs]):
+        eintrag = _textcache.get(auftragsnr)
+        if eintrag and jetzt - eintrag[0] < TEXTCACHE_MAXALTER:
+            eintraege[auftragsnr] = eintrag
+        else:
+            fehlend.append(auftragsnr)
+
+    if len(_textcache) + len(fehlend) > TEXTCACHE_MAXEINTRAEGE:
+        _textcache.clear()
+    fehlend.sort()
+    while fehlend:
+        # In 50er Schritten Texte lesen
+        batch = fehlend[:50]
+        fehlend = fehlend[50:]
+        neu = {}, {}, {}, {}
+        _texte_einlesen([remove_prefix(x, 'SO') for x in batch], *neu)
+        for auftragsnr in batch:
+            eintrag = (jetzt, neu[0].get(auftragsnr, {}), neu[1].get(auftragsnr, []),
+                       neu[2].get(auftragsnr, {}), neu[3].get(auftragsnr, {}))
+            _textcache[auftragsnr] = eintraege[auftragsnr] = eintrag
+
+    # Ergebnisse in die (evtl. vorbelegten) dicts übernehmen. Wir kopieren, damit Änderungen der
+    # Aufrufer nicht im Cache landen. Leere Einträge legen wir - wie die Abfrage selbst - nicht an.
+    for auftragsnr, eintrag in eintraege.items():
+        _zeitpunkt, auftrag_postexte, auftrag_kopftexte, auftrag_posdaten, auftrag_kopfdaten = eintrag
+        for position, texte in auftrag_postexte.items():
+            postexte.setdefault(auftragsnr, {}).setdefault(position, []).extend(texte)
+        if auftrag_kopftexte:
+            kopftexte.setdefault(auftragsnr, []).extend(auftrag_kopftexte)
+        for position, daten in auftrag_posdaten.items():
+            posdaten.setdefault(auftragsnr, {}).setdefault(position, {}).update(daten)
+        if auftrag_kopfdaten:
+            kopfdaten.setdefault(auftragsnr, {}).update(auftrag_kopfdaten)
     return postexte, kopftexte, posdaten, kopfdaten
 
 
+# Aktionen für die Klassifikation der AAT00 Zeilen, siehe _textaktion()
+(_IGNORIEREN, _POSTEXT, _WARENNUMMER, _KOPFTEXT, _KOPFDATEN, _POSDATEN, _FALSCHES_ANDRUCK,
+ _UNBEKANNT) = range(8)
+_textaktionen = {}  # (textart, cmp(auftragsposition, 0), andruck_re, andruck_ls, andruck_ab) -> Aktion
+
+
+def _textaktion(textart, position, andruck_re, andruck_ls, andruck_ab):
+    """Legt fest, was mit einer AAT00 Zeile passiert. `position` ist cmp(auftragsposition, 0).
+
+    Die Entscheidung hängt nur von Textart, Position und Druckkennzeichen ab. _texte_einlesen() merkt sich
+    das Ergebnis in _textaktionen, so dass pro Zeile nur noch ein dict-Zugriff nötig ist.
+
+    >>> _textaktion('8', 0, 1, 0, 0) == _KOPFTEXT
+    True
+    """
+    textart = int(textart)
+    # Wir behandeln hier nur Texte, die auf Auftragsbestätigungen, Lieferscheinen oder Rechnungen
+    # auftauchen sollen. Allerdings drucken wir diese dann auch auf beiden Belegarten auf - keine
+    # weiteren Unterscheidungen.
+    if andruck_re or andruck_ls or andruck_ab:
+        if andruck_re > 1 or andruck_ls > 3:
+            return _FALSCHES_ANDRUCK
+
+        # Wir haben gelegentlich Texte mit `andruck_ab == 2` die offensichtlich nicht als
+        # Kundenbelege sollen. Der Wert 2 in diesem Feld ist gänzlich undokumentiert,
+        # wir ignorieren bis auf weiteres einfach diese Zeilen.
+        if andruck_ab > 1:
+            return _IGNORIEREN
+
+        # Texte wo andruck_ls=2 steht soll man laut SoftM "nur auf KB drucken".
+        # Die Inhalte sind manchmal grenzwertig ... an dieser stelle kann man die aussortieren,
+        # machen wir aber zur zeit nicht.
+
+        # Die Statistische Warennummer wird als Positionstext mit der Nummer 5 transportiert
+        # In Produktivdaten haben wir die aber bisher noch nicht gesehen.
+        if textart == 5:
+            return _WARENNUMMER
+        # Die Textarten 2, 7 und 8 sind verschiedenen Positionstexte:
+        # * 2 Abweichende Artikelbezeichnung
+        # * 7 Auftragstexte vor Position
+        # * 8 Auftragstexte nach Position
+        # Wir fassen alle drei Textarten in einem einzigen Feld zusammen
+        elif position > 0 and textart in (2, 7, 8):
+            return _POSTEXT
+        # Textart 7 bei Position 0 ist eine Faxnummer. Warum auch immer. Wir ignorieren das.
+        # Das Feld ist **sehr oft** gefüllt.
+        elif position == 0 and textart == 7:
+            return _IGNORIEREN
+        # Bei Position 0 sind Textart 8 und 9 Fuß- und Kopftexte für den gesammten Auftrag.
+        # Wir fassen die in einem einzigen Feld zusammen.
+        elif position == 0 and textart in (8, 9):
+            return _KOPFTEXT
+        # Andere Textarten sind uns bisher nicht untergekommen.
+        return _UNBEKANNT
+    # Wenn der Text eigentlich nirgends angedruckt werden soll, dann ist es entweder ein Warntext
+    # bei der Auftragserfassung, oder ein Verschlüsseltes Datenfeld.
+    # Erfassungstexte sind Texte, die bei der Auftragserfassung angeziegt werden, aber auf
+    # keinem Beleg erscheinen (kein druckkennzeichen) - die ignorieren wir hier.
+    # Die gesonderten Datenfelder, die mit #:VARNAME: beginnen, verwenden wir aber weiter
+    if position == 0:
+        return _KOPFDATEN
+    return _POSDATEN
+
+
+def _textdaten(text):
+    """Wie texte_trennen([text])[1], aber ohne Umweg über Listen für den häufigen Fall."""
+    if not text.startswith('#:'):
+        return {}
+    teile = text.split(':')
+    if teile[1] != 'guid':
+        # Fehlerbehandlung wie gehabt
+        return texte_trennen([text])[1]
+    return {str(teile[1]): ':'.join(teile[2:])}
+
+
+def _texte_einlesen(batch, postexte, kopftexte, posdaten, kopfdaten):
+    """Liest die Texte der Auftragsnummern in batch aus der AAT00 und sortiert sie in die dicts ein."""
+    # Texte aus SoftM einlesen
+    condition = 'ATAUFN IN (%s)' % ','.join((str(x) for x in batch))
+    _klassifizieren(query(['AAT00'], ordering=['ATTART', 'ATLFNR'], condition=condition, ua='husoftm2.texte'),
+                    postexte, kopftexte, posdaten, kopfdaten)
+
+
+def _klassifizieren(rows, postexte, kopftexte, posdaten, kopfdaten):
+    """Sortiert AAT00 Zeilen nach Textart in die dicts ein."""
+    aktionen = _textaktionen
+    auftragsnrs = {}
+    for row in rows:
+        text = row['text']
+        # Textzeilen die leer sind oder nur Trennzeichen enthalten, ignorieren wir.
+        if not text.strip('=*_- '):
+            continue
+        position = row['auftragsposition']
+        key = (row['textart'], cmp(position, 0), row['andruck_re'], row['andruck_ls'], row['andruck_ab'])
+        aktion = aktionen.get(key)
+        if aktion is None:
+            aktion = aktionen[key] = _textaktion(*key)
+        if aktion == _IGNORIEREN:
+            continue
+        if aktion >= _FALSCHES_ANDRUCK:
+            row['textart'] = int(row['textart'])
+            if aktion == _FALSCHES_ANDRUCK:
+                raise NotImplementedError(row)
+            print row
+            raise NotImplementedError
+
+        auftragsnr = auftragsnrs.get(row['auftragsnr'])
+        if auftragsnr is None:
+            auftragsnr = auftragsnrs[row['auftragsnr']] = "SO%s" % remove_prefix(row['auftragsnr'], 'SO')
+        if aktion == _POSTEXT:
+            postexte.setdefault(auftragsnr, {}).setdefault(position, []).append(text.strip())
+        elif aktion == _KOPFTEXT:
+            kopftexte.setdefault(auftragsnr, []).append(text)
+        elif aktion == _KOPFDATEN:
+            if text.startswith('#:'):
+                kopfdaten.setdefault(auftragsnr, {}).update(_textdaten(text))
+        elif aktion == _POSDATEN:
+            if text.startswith('#:'):
+                posdaten.setdefault(auftragsnr, {}).setdefault(position, {}).update(_textdaten(text))
+        else:  # _WARENNUMMER
+            postexte.setdefault(auftragsnr, {}
+                   ).setdefault(position, []
+                   ).append("Statistische Warennummer: %s" % text.strip())
+
+
 def texte_auslesen(auftragsnrs, postexte=None, kopftexte=None):
     """Kompatibilitätslayer zu txt_auslesen()."""
     warnings.warn("use txt_auslesen() instead of texte_auslesen()",
@@ -166,6 +269,43 @@ def auftragstextdaten(auftragsnr):
             kopfdaten.get(auftragsnr, {}))
 
 
+class TexteTests(unittest.TestCase):
+    """Klassifikation der AAT00 Zeilen ohne Zugriff auf SoftM."""
+
+    def _zeile(self, auftragsnr, textart, position, andruck, text):
+        andruck_re, andruck_ls, andruck_ab = andruck
+        return dict(auftragsnr=auftragsnr, textart=textart, auftragsposition=position, text=text,
+                    andruck_re=andruck_re, andruck_ls=andruck_ls, andruck_ab=andruck_ab)
+
+    def test_klassifizieren(self):
+        rows = [self._zeile(1160001, '8', 0, (1, 1, 1), u'Bitte Lieferschein beilegen'),
+                self._zeile(1160001, '7', 0, (1, 1, 1), u'Fax 02191 60912-50'),
+                self._zeile(1160001, '7', 0, (0, 0, 0), u'Kunde hat angerufen'),
+                self._zeile(1160001, '1', 0, (0, 0, 0), u'#:guid:abc:1'),
+                self._zeile(1160001, '8', 2, (1, 1, 1), u'   Ihre Artikelnummer 4711   '),
+                self._zeile(1160001, '2', 3, (1, 1, 1), u'Abweichende Bezeichnung'),
+                self._zeile(1160001, '7', 1, (0, 0, 0), u'#:guid:def'),
+                self._zeile(1160001, '9', 0, (1, 2, 0), u'Zahlbar sofort '),
+                self._zeile(1160001, '8', 0, (0, 0, 2), u'Interne Notiz'),
+                self._zeile(1160001, '8', 0, (1, 1, 1), u'=========='),
+                self._zeile(1160001, '5', 4, (1, 1, 1), u'95030075'),
+                self._zeile('SO1160002', '8', 2, (1, 0, 0), u'Zweiter Auftrag'),
+                self._zeile('SO1160002', '7', 2, (0, 0, 0), u'Erfassungstext')]
+        ergebnis = {}, {}, {}, {}
+        _klassifizieren(rows, *ergebnis)
+        self.assertEqual(ergebnis, ({'SO1160001': {2: [u'Ihre Artikelnummer 4711'],
+                                                   3: [u'Abweichende Bezeichnung'],
+                                                   4: [u'Statistische Warennummer: 95030075']},
+                                     'SO1160002': {2: [u'Zweiter Auftrag']}},
+                                    {'SO1160001': [u'Bitte Lieferschein beilegen', u'Zahlbar sofort ']},
+                                    {'SO1160001': {1: {'guid': u'def'}}},
+                                    {'SO1160001': {'guid': u'abc:1'}}))
+        self.assertRaises(NotImplementedError, _klassifizieren,
+                          [self._zeile(1160001, '3', 0, (1, 0, 0), u'Unbekannt')], {}, {}, {}, {})
+        self.assertRaises(NotImplementedError, _klassifizieren,
+                          [self._zeile(1160001, '8', 0, (2, 0, 0), u'Kaputt')], {}, {}, {}, {})
+
+
 def _test():
     """Einfache Selbsttests."""
     from pprint import pprint
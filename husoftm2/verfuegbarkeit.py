@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+verfuegbarkeit.py - Available-to-Promise Simulation über offene Aufträge. Teil von huSoftM.
+
+Beantwortet Fragen wie "Wenn wir diese N Aufträge annehmen, welche bestehenden Aufträge rutschen nach
+hinten?" ohne für jedes Szenario erneut SoftM abzufragen. Dazu werden Buchbestände, Bestellmengen und
+offene Auftragsmengen einmalig geladen (siehe atp_simulation()) und im Speicher gehalten.
+
+    sim = atp_simulation(lager=100)
+    sim.simuliere([(50, '14600', datetime.date(2011, 2, 1))])
+    sim.uebernehme([(50, '14600', datetime.date(2011, 2, 1))])
+
+Die Zuteilung erfolgt in der Reihenfolge der Liefertermine. Bei gleichem Liefertermin werden bestehende
+Aufträge vor simulierten Aufträgen bedient. Bestehende Aufträge kennen wir nur zusammengefasst pro Artikel
+und Liefertermin, so wie auftragsmengen_alle_artikel() sie liefert. Setartikel werden - in bestehenden
+wie in simulierten Aufträgen - in ihre Komponenten zerlegt, beide Bedarfe treffen also auf denselben
+Bestand.
+
+Created by agent on 2026-10-19.
+Copyright (c) 2026 HUDORA. All rights reserved.
+"""
+
+from husoftm2.bestaende import buchbestaende, bestellmengen_alle_artikel, auftragsmengen_alle_artikel
+import bisect
+import datetime
+import husoftm2.artikel
+import time
+import unittest
+
+
+def _allokiere(bestand, zugaenge, bedarfe):
+    """Teilt Bestand und Zugänge in Terminreihenfolge den Bedarfen zu.
+
+    `zugaenge` ist eine sortierte Liste von (ordinal, menge), `bedarfe` eine sortierte Liste von
+    (ordinal, rang, menge, referenz) Tupeln. Gibt für jeden Bedarf ein (termin, fehlmenge) Tupel zurück.
+    termin ist die Ordinalzahl, zu der der Bedarf vollständig gedeckt ist, oder None.
+
+    >>> _allokiere(10, [(5, 20)], [(1, 0, 5, 'a'), (2, 0, 10, 'b'), (8, 0, 30, 'c')])
+    [(1, 0), (5, 0), (None, 15)]
+    """
+    verfuegbar = bestand
+    # Wurden für einen früheren Bedarf spätere Zugänge herangezogen, ist der Rest erst ab deren Termin da.
+    bereit = None
+    i = 0
+    ret = []
+    for ordinal, _rang, menge, _referenz in bedarfe:
+        # Alle Zugänge bis zum Liefertermin einbuchen
+        while i < len(zugaenge) and zugaenge[i][0] <= ordinal:
+            verfuegbar += zugaenge[i][1]
+            i += 1
+        # Reicht das nicht, rutscht der Bedarf auf den Termin späterer Zugänge
+        while verfuegbar < menge and i < len(zugaenge):
+            verfuegbar += zugaenge[i][1]
+            bereit = zugaenge[i][0]
+            i += 1
+        if verfuegbar >= menge:
+            ret.append((max(ordinal, bereit or 0), 0))
+        else:
+            ret.append((None, menge - max(verfuegbar, 0)))
+        verfuegbar -= menge
+    return ret
+
+
+class ATPSimulation(object):
+    """Im Speicher gehaltenes Modell von Beständen, Zugängen und Bedarfen für ATP-Simulationen.
+
+    `bestaende` ist ein dict von Artikelnummer auf Buchbestand, `zugaenge` ein dict von Artikelnummer auf
+    {datum: menge} (wie bestellmengen_alle_artikel()) und `bedarfe` ein dict von Artikelnummer auf
+    {datum: (menge, positionen)} (wie auftragsmengen_alle_artikel()). Bedarfe für Setartikel werden
+    dabei wie simulierte Aufträge auf die Komponenten verteilt.
+    """
+
+    def __init__(self, bestaende, zugaenge, bedarfe):
+        self._bestaende = dict(bestaende)
+        self._zugaenge = {}
+        for artnr, mengen in zugaenge.items():
+            self._zugaenge[artnr] = sorted((datum.toordinal(), int(menge)) for datum, menge in mengen.items())
+        self._bedarfe = {}
+        stuecklisten = husoftm2.artikel.stuecklisten(bedarfe.keys())
+        for artnr, mengen in bedarfe.items():
+            for komponenten_menge, komponenten_artnr in stuecklisten[artnr]:
+                self._bedarfe.setdefault(komponenten_artnr, []).extend(
+                    (datum.toordinal(), 0, int(menge) * komponenten_menge, None)
+                    for datum, (menge, _positionen) in mengen.items())
+        for artnr_bedarfe in self._bedarfe.values():
+            artnr_bedarfe.sort()
+        # Ergebnis der Zuteilung ohne simulierte Aufträge, wird pro Artikel bei Bedarf berechnet
+        self._basis = {}
+        self._laufende_nr = 0
+
+    def _zuteilung(self, artnr, bedarfe=None):
+        """Zuteilung für einen Artikel berechnen."""
+        if bedarfe is None:
+            bedarfe = self._bedarfe.get(artnr, [])
+        return _allokiere(self._bestaende.get(artnr, 0), self._zugaenge.get(artnr, []), bedarfe)
+
+    def _basiszuteilung(self, artnr):
+        """Zuteilung für einen Artikel ohne simulierte Aufträge (gecached)."""
+        if artnr not in self._basis:
+            self._basis[artnr] = self._zuteilung(artnr)
+        return self._basis[artnr]
+
+    def _neue_bedarfe(self, auftraege):
+        """Zerlegt (menge, artnr, datum) Tupel in Bedarfe pro (Komponenten-)Artikel."""
+        neu = {}
+        for menge, artnr, datum in auftraege:
+            self._laufende_nr += 1
+            komponenten = husoftm2.artikel.komponentenaufloesung([(menge, artnr)])
+            for komponenten_menge, komponenten_artnr in komponenten:
+                neu.setdefault(komponenten_artnr, []).append((datum.toordinal(), 1, komponenten_menge,
+                                                              (self._laufende_nr, artnr)))
+        return neu
+
+    def simuliere(self, auftraege):
+        """Simuliert die Annahme zusätzlicher Aufträge, ohne das Modell zu verändern.
+
+        `auftraege` ist eine Liste von (menge, artnr, liefer_date) Tupeln. Zurückgegeben wird ein dict
+        pro betroffenem (Komponenten-)Artikel mit den Einträgen
+         * fehlmenge - Menge, die mit Bestand und allen Zugängen nicht gedeckt werden kann
+         * verspaetet - bestehende Bedarfe, die durch die neuen Aufträge später (oder gar nicht mehr)
+           bedient werden können, als dicts mit liefer_date, menge, termin_bisher und termin_neu
+         * auftraege - die simulierten Aufträge als dicts mit liefer_date, menge, termin und fehlmenge
+
+        Die Rechenzeit hängt nur von der Zahl der Bewegungen der betroffenen Artikel ab.
+        """
+        ret = {}
+        for artnr, neue_bedarfe in self._neue_bedarfe(auftraege).items():
+            bedarfe = list(self._bedarfe.get(artnr, []))
+            for bedarf in neue_bedarfe:
+                bisect.insort(bedarfe, bedarf)
+            zuteilung = self._zuteilung(artnr, bedarfe)
+            basis = iter(self._basiszuteilung(artnr))
+
+            verspaetet = []
+            neue_auftraege = []
+            fehlmenge = 0
+            for (ordinal, rang, menge, _referenz), (termin, fehlt) in zip(bedarfe, zuteilung):
+                fehlmenge += fehlt
+                if rang:
+                    neue_auftraege.append(dict(liefer_date=datetime.date.fromordinal(ordinal), menge=menge,
+                                               termin=_ordinal2date(termin), fehlmenge=fehlt))
+                    continue
+                termin_bisher, _fehlt_bisher = basis.next()
+                if termin != termin_bisher and (termin is None or (termin_bisher and termin > termin_bisher)):
+                    verspaetet.append(dict(liefer_date=datetime.date.fromordinal(ordinal), menge=menge,
+                                           termin_bisher=_ordinal2date(termin_bisher),
+                                           termin_neu=_ordinal2date(termin)))
+            ret[artnr] = dict(fehlmenge=fehlmenge, verspaetet=verspaetet, auftraege=neue_auftraege)
+        return ret
+
+    def uebernehme(self, auftraege):
+        """Übernimmt Aufträge dauerhaft in das Modell, z.B. nachdem sie angenommen wurden."""
+        for artnr, neue_bedarfe in self._neue_bedarfe(auftraege).items():
+            bedarfe = self._bedarfe.setdefault(artnr, [])
+            for ordinal, _rang, menge, _referenz in neue_bedarfe:
+                bisect.insort(bedarfe, (ordinal, 0, menge, None))
+            self._basis.pop(artnr, None)
+
+    def termine(self, artnr):
+        """Liefert die aktuelle Zuteilung eines Artikels als Liste von (liefer_date, menge, termin)."""
+        return [(datetime.date.fromordinal(ordinal), menge, _ordinal2date(termin))
+                for (ordinal, _rang, menge, _referenz), (termin, _fehlt)
+                in zip(self._bedarfe.get(artnr, []), self._basiszuteilung(artnr))]
+
+
+def _ordinal2date(ordinal):
+    """Wandelt eine Ordinalzahl in ein datetime.date, None bleibt None."""
+    if ordinal is None:
+        return None
+    return datetime.date.fromordinal(ordinal)
+
+
+def atp_simulation(lager=0, artnrs=None):
+    """Lädt Buchbestände, Bestellmengen und offene Auftragsmengen und gibt eine ATPSimulation zurück.
+
+    Ohne `artnrs` werden alle Artikel geladen. Das kostet drei Abfragen und das Laden des
+    Setartikel-Index - danach kommen Simulationen ohne Zugriff auf SoftM aus.
+    """
+    husoftm2.artikel.lade_setartikel()
+    return ATPSimulation(buchbestaende(artnrs, lager),
+                         bestellmengen_alle_artikel(artnrs, lager),
+                         auftragsmengen_alle_artikel(artnrs, lager))
+
+
+class ATPSimulationTests(unittest.TestCase):
+    """Tests der Simulation mit synthetischen Daten."""
+
+    def setUp(self):
+        # Leerer Setartikel-Index, damit komponentenaufloesung() ohne SoftM auskommt
+        self._geladen = husoftm2.artikel._setartikel_geladen
+        husoftm2.artikel._setartikel_geladen = time.time()
+        self.sim = ATPSimulation({'a': 10},
+                                 {'a': {datetime.date(2011, 2, 1): 20}},
+                                 {'a': {datetime.date(2011, 1, 10): (5, 1),
+                                        datetime.date(2011, 1, 20): (5, 2),
+                                        datetime.date(2011, 2, 10): (15, 1)}})
+
+    def tearDown(self):
+        husoftm2.artikel._setartikel_geladen = self._geladen
+
+    def test_termine(self):
+        self.assertEqual(self.sim.termine('a'),
+                         [(datetime.date(2011, 1, 10), 5, datetime.date(2011, 1, 10)),
+                          (datetime.date(2011, 1, 20), 5, datetime.date(2011, 1, 20)),
+                          (datetime.date(2011, 2, 10), 15, datetime.date(2011, 2, 10))])
+
+    def test_simuliere(self):
+        ret = self.sim.simuliere([(8, 'a', datetime.date(2011, 1, 15))])
+        self.assertEqual(ret['a']['fehlmenge'], 3)
+        self.assertEqual(ret['a']['auftraege'], [dict(liefer_date=datetime.date(2011, 1, 15), menge=8,
+                                                      termin=datetime.date(2011, 2, 1), fehlmenge=0)])
+        self.assertEqual(ret['a']['verspaetet'],
+                         [dict(liefer_date=datetime.date(2011, 1, 20), menge=5,
+                               termin_bisher=datetime.date(2011, 1, 20),
+                               termin_neu=datetime.date(2011, 2, 1)),
+                          dict(liefer_date=datetime.date(2011, 2, 10), menge=15,
+                               termin_bisher=datetime.date(2011, 2, 10), termin_neu=None)])
+        # das Modell selbst bleibt unverändert
+        self.assertEqual(self.sim.termine('a')[-1][2], datetime.date(2011, 2, 10))
+
+    def test_uebernehme(self):
+        self.sim.uebernehme([(8, 'a', datetime.date(2011, 1, 15))])
+        self.assertEqual(self.sim.termine('a')[1], (datetime.date(2011, 1, 15), 8, datetime.date(2011, 2, 1)))
+        self.assertEqual(self.sim.simuliere([(1, 'a', datetime.date(2011, 3, 1))])['a']['fehlmenge'], 4)
+
+
+class ATPSimulationLadenTests(unittest.TestCase):
+    """atp_simulation() lädt alles vorab, Simulationen brauchen keine Abfragen mehr."""
+
+    def setUp(self):
+        global buchbestaende, bestellmengen_alle_artikel, auftragsmengen_alle_artikel
+        self._original = (buchbestaende, bestellmengen_alle_artikel, auftragsmengen_alle_artikel,
+                          husoftm2.artikel.query, husoftm2.artikel._setartikel_geladen,
+                          dict(husoftm2.artikel._setartikel))
+
+        def bestand(_artnrs, _lager):
+            return {'a': 10}
+
+        def leer(_artnrs, _lager):
+            return {}
+
+        def setauftrag(_artnrs, _lager):
+            return {'set': {datetime.date(2011, 1, 10): (2, 1)}}
+        buchbestaende = bestand
+        bestellmengen_alle_artikel = leer
+        auftragsmengen_alle_artikel = setauftrag
+        self.abfragen = []
+
+        def ask00(tables, **kwargs):
+            self.abfragen.append(tables)
+            return [dict(artnr=u'set', menge_im_set=2, komponenten_artnr=u'a')]
+        husoftm2.artikel.query = ask00
+
+    def tearDown(self):
+        global buchbestaende, bestellmengen_alle_artikel, auftragsmengen_alle_artikel
+        (buchbestaende, bestellmengen_alle_artikel, auftragsmengen_alle_artikel, husoftm2.artikel.query,
+         husoftm2.artikel._setartikel_geladen, setartikel) = self._original
+        husoftm2.artikel._setartikel.clear()
+        husoftm2.artikel._setartikel.update(setartikel)
+
+    def test_keine_abfragen(self):
+        sim = atp_simulation()
+        self.assertEqual(self.abfragen, [['ASK00']])
+        ret = sim.simuliere([(3, 'set', datetime.date(2011, 1, 15)), (1, 'b', datetime.date(2011, 1, 15))])
+        sim.uebernehme([(3, 'set', datetime.date(2011, 1, 15))])
+        self.assertEqual(self.abfragen, [['ASK00']])
+        self.assertEqual(ret['a']['fehlmenge'], 0)
+        self.assertEqual(ret['b']['fehlmenge'], 1)
+
+    def test_bestehender_setauftrag(self):
+        sim = atp_simulation()
+        # Der bestehende Auftrag über 2 Sets belegt 4 von 10 Stück der Komponente
+        self.assertEqual(sim.termine('a'), [(datetime.date(2011, 1, 10), 4, datetime.date(2011, 1, 10))])
+        self.assertEqual(sim.termine('set'), [])
+        ret = sim.simuliere([(4, 'set', datetime.date(2011, 1, 5))])
+        self.assertEqual(ret['a']['fehlmenge'], 2)
+        self.assertEqual(ret['a']['verspaetet'], [dict(liefer_date=datetime.date(2011, 1, 10), menge=4,
+                                                       termin_bisher=datetime.date(2011, 1, 10),
+                                                       termin_neu=None)])
+
+
+if __name__ == '__main__':
+    unittest.main()